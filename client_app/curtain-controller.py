@@ -1,103 +1,48 @@
-import ssl
-import socket
+import asyncio
 import json
-import select
-import time
 import random
 import sys
 import os
 
-from wsproto import WSConnection
-from wsproto.connection import ConnectionType
-from wsproto.events import (
-    AcceptConnection,
-    RejectConnection,
-    CloseConnection,
-    Message,
-    Ping,
-    Pong,
-    Request,
-    TextMessage,
-)
+# Add the repository root to the import path
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if root_path not in sys.path:
+    sys.path.insert(0, root_path)
 
-# Add common to import path
-common_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'common'))
-if common_path not in sys.path:
-    sys.path.insert(0, common_path)
+from common.config import *
+from common import cloud_client
+from common import logs
 
-from config import *
-import project_crypto
-
-def main():
-    cloud_socket = project_crypto.construct_ssl_socket(
-        True,
-        "application",
-        "cloud",
-        EXTERNAL_CLOUD_IP,
-        APPLICATION_PORT
-    )
-
-    cloud_websocket = WSConnection(ConnectionType.CLIENT)
-    cloud_socket.sendall(cloud_websocket.send(Request(host=EXTERNAL_CLOUD_IP, target = "server")))
-
-    next_curtain = time.time() - 5
-    incoming_text = ""
+async def move(cloud, position):
     try:
+        command = await cloud.control_curtain(DEVICE_ID, position)
+    except (ConnectionError, ValueError) as e:
+        print(f"Command to move the curtain to {position} failed: {e}")
+        return
+    print(json.dumps({"command": command}))
+
+async def show(readings):
+    async for reading in readings:
+        print(json.dumps(reading))
+
+async def control():
+    async with cloud_client.CloudClient() as cloud:
+        tasks = {asyncio.create_task(show(cloud.subscribe("curtain", msg_type=4)))}
         while True:
-            readable, writable, exceptional = select.select(
-                [cloud_socket],
-                [],
-                [cloud_socket],
-                1
-            )
-
-            for s in readable:
-                in_data = cloud_socket.recv(4096)
-                cloud_websocket.receive_data(in_data)
-
-                for event in cloud_websocket.events():
-                    if isinstance(event, AcceptConnection):
-                        print("Cloud Websocket established")
-                        
-                        subscriptions = {
-                            "subscribe_curtain": True,
-                        }
-                        message = json.dumps(subscriptions)
-                        out_data = cloud_websocket.send(Message(data=message))
-
-                        cloud_socket.sendall(out_data)
-
-                    elif isinstance(event, RejectConnection):
-                        print("Cloud Websocket rejected")
-                        raise Exception("cloud websocket connection rejected")
-                    elif isinstance(event, CloseConnection):
-                        print("Cloud connection closed: code={} reason={}".format(
-                            event.code, event.reason
-                        ))
-                        cloud_socket.send(cloud_websocket.send(event.response()))
-                    elif isinstance(event, Ping):
-                        cloud_socket.send(cloud_websocket.send(event.response()))
-                    elif isinstance(event, TextMessage):
-                        incoming_text += event.data
-                        if event.message_finished:
-                            print(incoming_text)
-                            incoming_text = ""
-                    else:
-                        print("Unsupported event: {event!r}")
-
-            if time.time() >= next_curtain:
-                message = {"control_curtain": random.randint(0, 100)}
-                message = json.dumps(message)
-                out_data = cloud_websocket.send(Message(data=message))
-
-                cloud_socket.sendall(out_data)
-                next_curtain += 5
+            await cloud.wait_connected()
+            task = asyncio.create_task(move(cloud, random.randint(0, 100)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            await asyncio.sleep(5)
 
+def main():
+    logs.setup(LOG_LEVEL)
+    try:
+        asyncio.run(control())
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         print(f"Failed to run application: {e}")
-    
-    finally:
-        cloud_socket.close()
 
 if __name__ == "__main__":
     main()
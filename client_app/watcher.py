@@ -1,89 +1,45 @@
-import ssl
-import socket
+import asyncio
 import json
 import sys
 import os
 
-from wsproto import WSConnection
-from wsproto.connection import ConnectionType
-from wsproto.events import (
-    AcceptConnection,
-    RejectConnection,
-    CloseConnection,
-    Message,
-    Ping,
-    Pong,
-    Request,
-    TextMessage,
-)
+# Add the repository root to the import path
+root_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if root_path not in sys.path:
+    sys.path.insert(0, root_path)
 
-# Add common to import path
-common_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'common'))
-if common_path not in sys.path:
-    sys.path.insert(0, common_path)
+from common.config import *
+from common import cloud_client
+from common import logs
 
-from config import *
-import project_crypto
 
+def show(message):
+    text = json.dumps(message)
+    if len(text) >= 1000:
+        text = json.dumps(message, indent=2)
 
-def main():
-    cloud_socket = project_crypto.construct_ssl_socket(
-        True,
-        "application",
-        "cloud",
-        EXTERNAL_CLOUD_IP,
-        APPLICATION_PORT
-    )
-
-    cloud_websocket = WSConnection(ConnectionType.CLIENT)
-    cloud_socket.sendall(cloud_websocket.send(Request(host=EXTERNAL_CLOUD_IP, target = "server")))
-
-    incoming_text = ""
-    try:
-        while True:
-            in_data = cloud_socket.recv(4096)
-            cloud_websocket.receive_data(in_data)
+    print(text)
 
-            for event in cloud_websocket.events():
-                if isinstance(event, AcceptConnection):
-                    print("Cloud Websocket established")
-                    
-                    subscriptions = {
-                        "subscribe_temperature": True,
-                        "subscribe_motion": True,
-                        "subscribe_door": True,
-                        "subscribe_curtain": True,
-                        "read_motion_history": True,
-                    }
-                    message = json.dumps(subscriptions)
-                    out_data = cloud_websocket.send(Message(data=message))
+async def watch():
+    async with cloud_client.CloudClient() as cloud:
+        # Every reading of every device.
+        readings = cloud.subscribe("watcher")
 
-                    cloud_socket.sendall(out_data)
+        await cloud.wait_connected()
+        try:
+            show({"motion_history": [reading async for reading in cloud.history(2)]})
+        except ConnectionError as e:
+            print(f"Failed to read the motion history: {e}")
 
-                elif isinstance(event, RejectConnection):
-                    print("Cloud Websocket rejected")
-                    raise Exception("cloud websocket connection rejected")
-                elif isinstance(event, CloseConnection):
-                    print("Cloud connection closed: code={} reason={}".format(
-                        event.code, event.reason
-                    ))
-                    cloud_socket.send(cloud_websocket.send(event.response()))
-                elif isinstance(event, Ping):
-                    cloud_socket.send(cloud_websocket.send(event.response()))
-                elif isinstance(event, TextMessage):
-                    incoming_text += event.data
-                    if event.message_finished:
-                        if len(incoming_text) >= 1000:
-                            message = json.loads(incoming_text)
-                            message = json.dumps(message, indent=2)
-                        else:
-                            message = incoming_text
-
-                        print(message)
-                        incoming_text = ""
-                else:
-                    print("Unsupported event: {event!r}")
+        async for reading in readings:
+            show(reading)
 
+def main():
+    logs.setup(LOG_LEVEL)
+    try:
+        asyncio.run(watch())
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         print(f"Failed to run application: {e}")
 
@@ -1,10 +1,19 @@
-import socket
-import ssl
-import select
+import asyncio
 import json
+import base64
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import sys
+import time
+from collections import OrderedDict, deque
+
+import cbor2
 
 from wsproto import WSConnection
-from wsproto.connection import ConnectionType
+from wsproto.connection import ConnectionState, ConnectionType
 from wsproto.events import (
     AcceptConnection,
     CloseConnection,
@@ -12,279 +21,1176 @@ from wsproto.events import (
     Ping,
     Pong,
     Request,
-    TextMessage,
 )
 
 from common.config import *
 from common import project_crypto
+from common import history_store
+from common import broker
+from common import rollups
+from common import device_shadow
+from common import commands
+from common import cloud_bus
+from common import logs
+from common import metrics
+from common import timer_wheel
+from common import wire
 
-def main():
-    temperature_history = open('temperature_history.txt', 'a+')
-    motion_history = open('motion_history.txt', 'a+')
-    door_history = open('door_history.txt', 'a+')
-    curtain_history = open('curtain_history.txt', 'a+')
-
-    gateway_listener = project_crypto.construct_ssl_socket(
-        False,
-        "cloud",
-        "gateway",
-        INTERNAL_CLOUD_IP,
-        GATEWAY_PORT
-    )
+log = logging.getLogger("cloud")
+sample = logs.Sampler(LOG_SAMPLE_EVERY)
+
+READINGS_INGESTED = metrics.counter("cloud_readings_ingested_total", "Readings received from gateways and stored")
+RULE_HITS = metrics.counter("cloud_rule_hits_total", "Gateway rules that fired, as reported by the gateways")
+READINGS_REJECTED = metrics.counter("cloud_readings_rejected_total", "Readings from gateways skipped as malformed")
+REPLAY_DUPLICATES = metrics.counter("cloud_replay_duplicates_total", "Replayed readings skipped as already stored")
+FANOUT_SECONDS = metrics.histogram("cloud_fanout_seconds", "Time to hand one reading to every matching subscriber")
+DELIVERIES = metrics.counter("cloud_deliveries_total", "Readings queued for subscribers")
+SUBSCRIBER_DROPPED = metrics.counter("cloud_subscriber_dropped_total", "Readings and replies dropped or coalesced for slow subscribers")
+SLOW_DISCONNECTS = metrics.counter("cloud_slow_consumer_disconnects_total", "Applications disconnected for reading too slowly")
+PINGS_SENT = metrics.counter("cloud_pings_sent_total", "WebSocket pings sent to quiet connections")
+REAPED = {
+    kind: metrics.counter("cloud_connections_reaped_total", "Connections closed after their idle timeout", {"kind": kind})
+    for kind in ("gateway", "application")
+}
+HISTORY_QUERY_SECONDS = metrics.histogram("cloud_history_query_seconds", "Time spent producing history query replies")
+ROLLUP_QUERY_SECONDS = metrics.histogram("cloud_rollup_query_seconds", "Time spent answering rollup queries")
+COMMAND_RESULTS = {
+    state: metrics.counter("cloud_commands_total", "Commands from applications by what became of them", {"result": state})
+    for state in (commands.SENT, commands.COMPLETED, commands.SUPERSEDED, commands.TIMEOUT, commands.FAILED)
+}
+COMMAND_LATENCY = metrics.histogram(
+    "cloud_command_latency_seconds", "Time from a command's submission to the device reporting its target",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60),
+)
+
+def encode_cursor(positions):
+    return base64.urlsafe_b64encode(json.dumps(positions).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        positions = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"invalid cursor: {e}")
+    if not isinstance(positions, dict) or not all(isinstance(p, int) for p in positions.values()):
+        raise ValueError("invalid cursor")
+    return positions
+
+def check_reading(reading):
+    """Raise ValueError unless reading has the fields and types the history store needs."""
+    if not isinstance(reading, dict):
+        raise ValueError("reading is not an object")
+    msg_type = reading.get("msg_type")
+    device_id = reading.get("device_id")
+    timestamp = reading.get("timestamp")
+    value = reading.get("value")
+
+    if not isinstance(msg_type, int) or isinstance(msg_type, bool):
+        raise ValueError("msg_type must be an integer")
+    if not isinstance(device_id, str) or not device_id:
+        raise ValueError("device_id must be a non-empty string")
+    if not isinstance(timestamp, int) or isinstance(timestamp, bool) or not -2**63 <= timestamp < 2**63:
+        raise ValueError("timestamp must be a 64-bit integer")
+    if not isinstance(value, (int, float)):
+        raise ValueError("value must be a number or a boolean")
+    try:
+        float(value)
+    except OverflowError:
+        raise ValueError("value is out of range")
+
+def as_list(value):
+    """Turn a single msg_type or device_id of a request into a list. None stays None."""
+    if value is None or isinstance(value, list):
+        return value
+    return [value]
+
+def timed(fragments, histogram):
+    """Pass fragments through, observing the total time spent producing them once they run out."""
+    elapsed = 0.0
+    iterator = iter(fragments)
+    while True:
+        start = time.perf_counter()
+        try:
+            fragment = next(iterator)
+        except StopIteration:
+            histogram.observe(elapsed + time.perf_counter() - start)
+            return
+        elapsed += time.perf_counter() - start
+        yield fragment
+
+def stream_history(history, msg_type, name, query, binary=False):
+    """
+    Generate the fragments of a {"<name>_history": [...], "next_cursor": ...}
+    message as (data, message_finished) pairs. The fragments are JSON text, or
+    CBOR with the rows in an indefinite-length array when binary is set.
+
+    query is either True, for the entire history, or a dictionary with the optional
+    keys since, until, device_id, limit and cursor. next_cursor is None once there
+    are no more readings, otherwise it can be sent back as cursor to get the next page.
+    """
+    if not isinstance(query, dict):
+        query = {}
+
+    since = query.get("since")
+    until = query.get("until")
+    device_id = query.get("device_id")
+    limit = query.get("limit")
+    cursor = query.get("cursor")
+
+    for key, value in (("since", since), ("until", until)):
+        if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool)):
+            raise ValueError(f"{key} must be a numeric timestamp")
+    if device_id is not None and not isinstance(device_id, str):
+        raise ValueError("device_id must be a string")
+    if limit is not None and (not isinstance(limit, int) or limit < 0):
+        raise ValueError("limit must be a non-negative integer")
+    if cursor is not None and not isinstance(cursor, str):
+        raise ValueError("cursor must be a string")
+    start = decode_cursor(cursor) if cursor else None
+
+    if binary:
+        empty = b""
+        separator = b""
+        encode = cbor2.dumps
+        # A map with two entries whose first value is an indefinite-length array.
+        opening = b"\xa2" + cbor2.dumps(f"{name}_history") + b"\x9f"
+    else:
+        empty = ""
+        separator = ", "
+        encode = json.dumps
+        opening = f'{{"{name}_history": ['
+
+    # Position of the next unsent reading of every device seen so far.
+    positions = dict(start or {})
+    next_cursor = None
+
+    fragment = [opening]
+    fragment_size = len(opening)
+    count = 0
+
+    for device, position, timestamp, value in history.scan(msg_type, device_id, since, until, start):
+        if limit is not None and count >= limit:
+            next_cursor = encode_cursor(positions)
+            break
+
+        row = encode({
+            "msg_type": msg_type,
+            "device_id": device,
+            "timestamp": timestamp,
+            "value": value,
+        })
+        if count:
+            row = separator + row
+        fragment.append(row)
+        fragment_size += len(row)
+        positions[device] = position + 1
+        count += 1
+
+        if fragment_size >= HISTORY_FRAGMENT_SIZE:
+            yield empty.join(fragment), False
+            fragment = []
+            fragment_size = 0
+
+    if binary:
+        fragment.append(b"\xff" + cbor2.dumps("next_cursor") + cbor2.dumps(next_cursor))
+    else:
+        fragment.append(f'], "next_cursor": {json.dumps(next_cursor)}}}')
+    yield empty.join(fragment), True
+
+class Subscriber:
+    """
+    Outgoing side of an application connection.
+
+    Subscription data is put on a bounded queue which a dedicated task drains
+    into the connection, so an application that reads slowly only delays
+    itself. Replies to requests are queued separately, up to reply_limit of
+    them; beyond that the policy applies to them as well, except that there is
+    nothing to coalesce and "coalesce" drops the oldest reply.
+    """
+
+    def __init__(self, writer, websocket, policy=SLOW_CONSUMER_POLICY, limit=SUBSCRIBER_QUEUE_SIZE,
+                 reply_limit=SUBSCRIBER_REPLY_QUEUE_SIZE):
+        self.writer = writer
+        self.websocket = websocket
+        self.policy = policy
+        self.limit = limit
+        self.reply_limit = reply_limit
+
+        # Queued subscription data as key -> WebSocket frame, oldest first. Keys are
+        # (msg_type, device_id) with the "coalesce" policy so a newer reading
+        # replaces a queued one, and a sequence number otherwise.
+        self.queue = OrderedDict()
+        self.sequence = 0
+        # Messages, or iterators of (data, message_finished) fragments.
+        self.replies = deque()
+
+        # Negotiated when the WebSocket connection is accepted.
+        self.binary = False
+        self.window_bits = None
+
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+
+        address = writer.get_extra_info("peername")
+        self.name = f"{address[0]}:{address[1]}"
+
+    def publish(self, key, encoded):
+        if self.closed:
+            return
+
+        frame = encoded.frame(self.binary, self.window_bits)
+
+        if self.policy == "coalesce":
+            if key in self.queue:
+                self.queue[key] = frame
+                self.dropped += 1
+                SUBSCRIBER_DROPPED.inc()
+                return
+        else:
+            key = self.sequence
+            self.sequence += 1
+
+        if len(self.queue) >= self.limit:
+            if self.policy == "disconnect":
+                self.disconnect_slow()
+                return
+            self.queue.popitem(last=False)
+            self.dropped += 1
+            SUBSCRIBER_DROPPED.inc()
+
+        self.queue[key] = frame
+        self.wakeup.set()
+
+    def reply(self, reply):
+        if self.closed:
+            return
+
+        if len(self.replies) >= self.reply_limit:
+            if self.policy == "disconnect":
+                self.disconnect_slow()
+                return
+            self.replies.popleft()
+            self.dropped += 1
+            SUBSCRIBER_DROPPED.inc()
+
+        self.replies.append(reply)
+        self.wakeup.set()
+
+    def disconnect_slow(self):
+        log.warning("Application %s: disconnecting slow consumer", self.name)
+        SLOW_DISCONNECTS.inc()
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.wakeup.set()
+            self.writer.close()
+
+    def abort(self):
+        """Drop the connection without waiting for queued data to be sent."""
+        self.close()
+        self.writer.transport.abort()
+
+    def ping(self):
+        # Control frames may go between the fragments of a streamed reply.
+        if not self.closed and self.websocket.state == ConnectionState.OPEN:
+            self.writer.write(self.websocket.send(Ping()))
+            PINGS_SENT.inc()
+
+    async def run(self):
+        try:
+            while not self.closed:
+                if not self.queue and not self.replies:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+
+                # Finish replies first. WebSocket messages cannot be interleaved,
+                # so subscription data waits until a streamed reply is complete.
+                if self.replies:
+                    reply = self.replies.popleft()
+                    if isinstance(reply, dict):
+                        reply = [(wire.encode(reply, self.binary), True)]
+
+                    for data, finished in reply:
+                        if self.closed:
+                            return
+                        self.writer.write(self.websocket.send(Message(data=data, message_finished=finished)))
+                        await self.writer.drain()
+                        # Let other connections run between the fragments of large replies.
+                        await asyncio.sleep(0)
+                    continue
+
+                # The frames were built once by the broker and are written as is.
+                frames = []
+                while self.queue:
+                    _, frame = self.queue.popitem(last=False)
+                    frames.append(frame)
+
+                self.writer.write(b"".join(frames))
+                await self.writer.drain()
+        except Exception as e:
+            log.warning("Application %s: %s", self.name, e)
+            self.close()
+
+class GatewaySession:
+    """A connected gateway. gateway_id is learned from its gateway_hello message."""
+
+    def __init__(self, writer, websocket):
+        self.writer = writer
+        self.websocket = websocket
+        self.binary = False
+
+        address = writer.get_extra_info("peername")
+        self.gateway_id = f"{address[0]}:{address[1]}"
+
+    def send(self, message):
+        self.writer.write(self.websocket.send(Message(data=wire.encode(message, self.binary))))
+
+    def ping(self):
+        if self.websocket.state == ConnectionState.OPEN:
+            self.writer.write(self.websocket.send(Ping()))
+            PINGS_SENT.inc()
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        self.writer.transport.abort()
+
+class Keepalive:
+    """
+    Pings a connection that has been quiet for `interval` seconds and calls
+    reap() once it has been quiet for `timeout` seconds; 0 turns either off.
+    The owner calls seen() whenever data arrives. Rather than being moved
+    then, the connection's one timer in the wheel checks how long the
+    connection has really been quiet when it fires, and is set again.
+    """
+
+    __slots__ = ("wheel", "interval", "timeout", "ping", "reap", "last_seen", "timer")
+
+    def __init__(self, wheel, interval, timeout, ping, reap):
+        self.wheel = wheel
+        self.interval = interval
+        self.timeout = timeout
+        self.ping = ping
+        self.reap = reap
+        self.last_seen = wheel.clock()
+        self.timer = None
+        self._arm(self.last_seen, False)
+
+    def seen(self):
+        self.last_seen = self.wheel.clock()
+
+    def _arm(self, now, pinged):
+        deadlines = []
+        if self.interval:
+            deadlines.append(now + self.interval if pinged else self.last_seen + self.interval)
+        if self.timeout:
+            deadlines.append(self.last_seen + self.timeout)
+        if deadlines:
+            self.timer = self.wheel.schedule(min(deadlines) - now, self._check)
+
+    def _check(self):
+        self.timer = None
+        now = self.wheel.clock()
+        idle = now - self.last_seen
+        if self.timeout and idle >= self.timeout:
+            self.reap()
+            return
+
+        pinged = bool(self.interval) and idle >= self.interval
+        if pinged:
+            self.ping()
+        self._arm(now, pinged)
+
+    def stop(self):
+        if self.timer is not None:
+            self.wheel.cancel(self.timer)
+            self.timer = None
+
+class Cloud:
+    """
+    The whole cloud in one process. With CLOUD_WORKERS the work is split
+    between an IngestCloud and several WorkerClouds instead.
+    """
+
+    # Whether this process stores the gateways' readings and runs the
+    # commands, and whether it keeps the rollups and subscriptions that
+    # applications are served from.
+    writes_history = True
+    serves_applications = True
+
+    def __init__(self):
+        group = history_store.GroupCommit(HISTORY_FLUSH_RECORDS, HISTORY_FSYNC, HISTORY_FSYNC_INTERVAL)
+        self.history = history_store.HistoryStore(
+            HISTORY_DIR, HISTORY_CACHE_RECORDS, HISTORY_CACHE_SECONDS, group, readonly=not self.writes_history,
+        )
+
+        self.shadow = device_shadow.DeviceShadow()
+        count = self.shadow.rebuild(self.history, MSG_TYPE_NAMES)
+        log.info("Loaded %d last known readings", count)
+
+        if self.serves_applications:
+            self.rollups = rollups.Rollups(ROLLUP_KINDS, ROLLUP_RESOLUTIONS, ROLLUP_RETENTION)
+            count = self.rollups.rebuild(self.history)
+            log.info("Rebuilt rollups from %d stored readings", count)
+
+        if self.writes_history:
+            self.commands = commands.CommandManager(
+                self.send_command, self.notify_command, COMMAND_RATE, COMMAND_BURST, COMMAND_TIMEOUT,
+            )
+            for reading in self.shadow.get([4]):
+                self.commands.on_status(reading["device_id"], reading["value"])
+            self.commands_changed = asyncio.Event()
+
+        # Keepalive timers of every connection.
+        self.timers = timer_wheel.TimerWheel(KEEPALIVE_TICK)
+        # Connected applications, for the per-subscriber metrics.
+        self.subscribers = set()
+        # Applications that asked for the reports of gateway rules firing.
+        self.rule_hit_subscribers = set()
+        self.register_metrics()
+
+        # gateway_id -> GatewaySession of every connected gateway.
+        self.gateways = dict()
+        # device_id -> gateway_id of the gateway the device was last heard through.
+        # Kept across gateway disconnects so a reconnecting gateway gets its
+        # devices back without having to wait for new readings.
+        self.device_gateways = dict()
+
+        self.broker = broker.Broker()
+
+    def close(self):
+        self.history.close()
+
+    def register_metrics(self):
+        metrics.gauge("cloud_gateways_connected", "Connected gateways", function=lambda: len(self.gateways))
+        metrics.gauge("cloud_subscribers_connected", "Connected applications", function=lambda: len(self.subscribers))
+        metrics.gauge("cloud_keepalive_timers", "Keepalive timers in the timer wheel", function=lambda: len(self.timers))
+        metrics.gauge(
+            "cloud_subscriber_backlog",
+            "Readings queued for an application",
+            function=lambda: [({"application": subscriber.name}, len(subscriber.queue)) for subscriber in self.subscribers],
+        )
+        if not self.writes_history:
+            return
+
+        group = self.history.group
+        metrics.counter("cloud_history_records_written_total", "Records written to the history store",
+                        function=lambda: group.records_written)
+        metrics.counter("cloud_history_bytes_written_total", "Bytes written to the history store, index included",
+                        function=lambda: group.bytes_written)
+        metrics.counter("cloud_history_flushes_total", "History group flushes", function=lambda: group.flushes)
+        metrics.counter("cloud_history_fsyncs_total", "History group flushes with fsync", function=lambda: group.fsyncs)
+        metrics.counter("cloud_history_flush_seconds_total", "Time spent flushing history",
+                        function=lambda: group.flush_seconds)
+        metrics.gauge("cloud_history_flush_seconds_max", "Longest history flush", function=lambda: group.max_flush_seconds)
+
+    async def flush_history(self):
+        """Flush buffered history writes every HISTORY_FLUSH_INTERVAL_MS."""
+        while True:
+            await asyncio.sleep(HISTORY_FLUSH_INTERVAL_MS / 1000)
+            self.history.flush()
+
+    async def run_timers(self):
+        """Advance the keepalive timer wheel once a tick."""
+        while True:
+            await asyncio.sleep(self.timers.timeout())
+            self.timers.advance()
+
+    async def run_commands(self):
+        """Send rate limited commands and time out unconfirmed ones when they are due."""
+        while True:
+            timeout = self.commands.poll()
+            self.commands_changed.clear()
+            try:
+                await asyncio.wait_for(self.commands_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def submit_command(self, issuer, device_id, target):
+        self.commands.submit(device_id, target, issuer)
+        self.commands_changed.set()
+
+    def send_command(self, command):
+        return self.send_to_device(command.device_id, {
+            "control_curtain": command.target,
+            "device_id": command.device_id,
+            "command_id": command.command_id,
+        })
+
+    def notify_command(self, command, state, fields):
+        if state in COMMAND_RESULTS:
+            COMMAND_RESULTS[state].inc()
+        if state == commands.COMPLETED:
+            COMMAND_LATENCY.observe(fields["latency_ms"] / 1000)
+        elif state == commands.FAILED:
+            log.warning("No gateway connected for %s, dropping command", command.device_id)
+
+        command.issuer.reply({"command": {
+            "id": command.command_id,
+            "device_id": command.device_id,
+            "target": command.target,
+            "state": state,
+            **fields,
+        }})
+
+    def register_gateway(self, session, gateway_id):
+        if self.gateways.get(session.gateway_id) is session:
+            del self.gateways[session.gateway_id]
 
-    print(f"Listening for gateway on {GATEWAY_PORT}")
-    gateway_listener.listen()
-    gateway, gateway_address = gateway_listener.accept()
+        previous = self.gateways.get(gateway_id)
+        if previous is not None and previous is not session:
+            # The gateway reconnected before its old connection timed out.
+            log.info("Gateway %s: replacing previous connection", gateway_id)
+            previous.close()
 
-    print(f"Gateway connected at {gateway_address[0]}:{gateway_address[1]}")
+        session.gateway_id = gateway_id
+        self.gateways[gateway_id] = session
 
-    gateway_ws = WSConnection(ConnectionType.SERVER)
+    def unregister_gateway(self, session):
+        if self.gateways.get(session.gateway_id) is session:
+            del self.gateways[session.gateway_id]
 
-    application_listener = project_crypto.construct_ssl_socket(
-        False,
-        "cloud",
-        "application",
+    def accept(self, session, reading):
+        """Whether a reading from a gateway can be stored. Malformed ones are counted and skipped."""
+        try:
+            check_reading(reading)
+        except ValueError as e:
+            READINGS_REJECTED.inc()
+            if log.isEnabledFor(logging.WARNING) and sample():
+                log.warning("Gateway %s: skipping reading %r: %s", session.gateway_id, reading, e)
+            return False
+        return True
+
+    def ingest(self, session, reading, replayed=False):
+        if not self.accept(session, reading):
+            return
+        self.store(session, reading, replayed)
+
+    def store(self, session, reading, replayed=False):
+        msg_type = reading["msg_type"]
+        device_id = reading["device_id"]
+        timestamp = reading["timestamp"]
+        value = reading["value"]
+
+        self.device_gateways[device_id] = session.gateway_id
+        position = self.history.append(msg_type, device_id, timestamp, value)
+        READINGS_INGESTED.inc()
+        # Replayed curtain statuses predate the commands in flight.
+        if msg_type == 4 and not replayed:
+            self.commands.on_status(device_id, value)
+        self.deliver(reading, position)
+
+    def deliver(self, reading, position):
+        """Add a stored reading to the rollups and last known readings, and publish it to subscribers."""
+        self.rollups.add(reading["msg_type"], reading["device_id"], reading["timestamp"], reading["value"])
+        self.shadow.update(reading)
+
+        start = time.perf_counter()
+        DELIVERIES.inc(self.broker.publish(reading))
+        FANOUT_SECONDS.observe(time.perf_counter() - start)
+
+    def report_rule_hits(self, session, hits):
+        """Record that rules of a gateway fired and pass that on to the interested applications."""
+        RULE_HITS.inc(len(hits))
+        for hit in hits:
+            hit["gateway_id"] = session.gateway_id
+            log.info("Gateway %s: rule %s moved the curtain of %s to %s",
+                     session.gateway_id, hit["rule"], hit["device_id"], hit["control_curtain"])
+        self.publish_rule_hits(hits)
+
+    def publish_rule_hits(self, hits):
+        for subscriber in self.rule_hit_subscribers:
+            subscriber.reply({"rule_hits": hits})
+
+    def ingest_replay(self, session, batch, live=False):
+        """
+        Ingest readings a gateway spooled while the cloud was unreachable. A batch can
+        be replayed more than once if the connection dropped before it was
+        acknowledged, so readings already in the history are skipped, using
+        (device_id, timestamp, msg_type) as their identity. A live batch was
+        spilled under backpressure while connected, so its curtain statuses
+        are current and can complete commands. Malformed readings are skipped,
+        so that the batch is still acknowledged and not replayed forever.
+        """
+        stored = duplicates = rejected = 0
+        for reading in batch:
+            if not self.accept(session, reading):
+                rejected += 1
+                continue
+            if self.history.contains(reading["msg_type"], reading["device_id"], reading["timestamp"]):
+                duplicates += 1
+                REPLAY_DUPLICATES.inc()
+                continue
+            self.store(session, reading, replayed=not live)
+            stored += 1
+
+        log.log(logging.DEBUG if live else logging.INFO,
+                "Gateway %s: replayed %d readings, skipped %d duplicates and %d malformed",
+                session.gateway_id, stored, duplicates, rejected)
+
+    async def handle_gateway(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        log.info("Gateway connected at %s:%s", address[0], address[1])
+
+        websocket = WSConnection(ConnectionType.SERVER)
+        session = GatewaySession(writer, websocket)
+        self.register_gateway(session, session.gateway_id)
+
+        def reap():
+            log.warning("Gateway %s: nothing received for %ss, closing the connection",
+                        session.gateway_id, GATEWAY_IDLE_TIMEOUT)
+            REAPED["gateway"].inc()
+            session.abort()
+
+        keepalive = Keepalive(self.timers, GATEWAY_PING_INTERVAL, GATEWAY_IDLE_TIMEOUT, session.ping, reap)
+
+        assembler = wire.MessageAssembler()
+        try:
+            while True:
+                in_data = await reader.read(4096)
+                if not in_data:
+                    break
+                keepalive.seen()
+                websocket.receive_data(in_data)
+
+                out_data = b""
+                for event in websocket.events():
+                    if isinstance(event, Request):
+                        log.info("Gateway %s: accepting WebSocket connection", session.gateway_id)
+                        subprotocol = wire.choose_subprotocol(event.subprotocols, WIRE_FORMAT)
+                        extensions = wire.server_extensions(WIRE_DEFLATE)
+                        out_data += websocket.send(AcceptConnection(subprotocol=subprotocol, extensions=extensions))
+                        session.binary = wire.is_binary(subprotocol)
+                    elif isinstance(event, CloseConnection):
+                        log.info("Gateway %s: connection closed", session.gateway_id)
+                        out_data += websocket.send(event.response())
+                    elif isinstance(event, Ping):
+                        out_data += websocket.send(event.response())
+                    elif isinstance(event, Pong):
+                        pass
+                    elif wire.is_data_event(event):
+                        if log.isEnabledFor(logging.DEBUG) and sample():
+                            log.debug("Gateway %s: received %r", session.gateway_id, event.data)
+                        message = assembler.feed(event)
+                        if message is not None:
+                            if "gateway_hello" in message:
+                                gateway_id = message["gateway_hello"]["gateway_id"]
+                                log.info("Gateway %s identified as %s", session.gateway_id, gateway_id)
+                                self.register_gateway(session, gateway_id)
+                            elif "rule_hits" in message:
+                                self.report_rule_hits(session, message["rule_hits"])
+                            elif "batch" in message:
+                                if message.get("replay"):
+                                    self.ingest_replay(session, message["batch"], message.get("live", False))
+                                    # The gateway deletes acknowledged readings from its
+                                    # spool, so they must be in the files first.
+                                    self.history.flush()
+                                    session.send({"ack": message["batch_id"]})
+                                else:
+                                    for reading in message["batch"]:
+                                        self.ingest(session, reading)
+                            else:
+                                self.ingest(session, message)
+                    else:
+                        log.warning("Gateway %s: unknown event %r", session.gateway_id, event)
+
+                if out_data:
+                    writer.write(out_data)
+                    await writer.drain()
+        except Exception as e:
+            log.warning("Gateway %s: %s", session.gateway_id, e)
+        finally:
+            log.info("Gateway %s disconnected", session.gateway_id)
+            keepalive.stop()
+            self.unregister_gateway(session)
+            writer.close()
+
+    def send_to_device(self, device_id, message):
+        """Send a command to the gateway that owns device_id. Returns False if it is unreachable."""
+        gateway_id = self.device_gateways.get(device_id)
+        session = self.gateways.get(gateway_id)
+        if session is None:
+            return False
+
+        session.send(message)
+        return True
+
+    def subscribe(self, subscriber, request):
+        """
+        Handle {"subscribe": {"id": ..., "msg_type": ..., "device_id": ..., "where": ...}}.
+        msg_type and device_id may be a single value or a list, and where is a
+        value predicate such as {"gt": 30}. Every key except id is optional.
+        """
+        if not isinstance(request, dict) or not isinstance(request.get("id"), (str, int)):
+            raise ValueError("subscribe needs a string or integer id")
+
+        subscription = self.broker.subscribe(
+            subscriber,
+            request["id"],
+            msg_types=as_list(request.get("msg_type")),
+            device_ids=as_list(request.get("device_id")),
+            where=request.get("where"),
+        )
+        self.send_snapshot(subscriber, subscription)
+
+    def send_snapshot(self, subscriber, subscription):
+        """Send the last known readings matching a new subscription."""
+        readings = self.shadow.get(subscription.msg_types, subscription.device_ids, subscription.predicate)
+        subscriber.reply({"snapshot": {"id": subscription.subscription_id, "readings": readings}})
+
+    def get_state(self, request):
+        """
+        Handle {"get_state": true} or {"get_state": {"msg_type": ..., "device_id": ...}}
+        with the last known reading of every matching device.
+        """
+        if not isinstance(request, dict):
+            request = {}
+        return self.shadow.get(as_list(request.get("msg_type")), as_list(request.get("device_id")))
+
+    def handle_application_message(self, subscriber, message):
+        for msg_type, name in MSG_TYPE_NAMES.items():
+            subscribe = message.get(f"subscribe_{name}")
+            if subscribe is None:
+                continue
+            if subscribe:
+                subscription = self.broker.subscribe(subscriber, f"subscribe_{name}", msg_types=[msg_type])
+                self.send_snapshot(subscriber, subscription)
+            else:
+                self.broker.unsubscribe(subscriber, f"subscribe_{name}")
+
+        if "subscribe" in message:
+            try:
+                self.subscribe(subscriber, message["subscribe"])
+            except ValueError as e:
+                subscriber.reply({"error": f"subscribe: {e}"})
+
+        if "unsubscribe" in message:
+            self.broker.unsubscribe(subscriber, message["unsubscribe"])
+
+        subscribe = message.get("subscribe_rule_hits")
+        if subscribe:
+            self.rule_hit_subscribers.add(subscriber)
+        elif subscribe is not None:
+            self.rule_hit_subscribers.discard(subscriber)
+
+        if message.get("get_state"):
+            subscriber.reply({"state": self.get_state(message["get_state"])})
+
+        for msg_type, name in MSG_TYPE_NAMES.items():
+            query = message.get(f"read_{name}_history")
+            if query is None or query is False:
+                continue
+
+            try:
+                stream = timed(stream_history(self.history, msg_type, name, query, subscriber.binary), HISTORY_QUERY_SECONDS)
+                # Produce the first fragment now so bad queries are reported immediately.
+                first_fragment = next(stream)
+            except ValueError as e:
+                subscriber.reply({"error": f"read_{name}_history: {e}"})
+                continue
+
+            subscriber.reply(itertools.chain([first_fragment], stream))
+
+        for msg_type, name in MSG_TYPE_NAMES.items():
+            query = message.get(f"read_{name}_rollup")
+            if query is None or msg_type not in ROLLUP_KINDS:
+                continue
+
+            start = time.perf_counter()
+            try:
+                if not isinstance(query, dict):
+                    raise ValueError("expected a query object")
+                buckets = self.rollups.query(
+                    msg_type,
+                    query.get("resolution"),
+                    device_id=query.get("device_id"),
+                    since=query.get("since"),
+                    until=query.get("until"),
+                )
+            except ValueError as e:
+                subscriber.reply({"error": f"read_{name}_rollup: {e}"})
+                continue
+
+            ROLLUP_QUERY_SECONDS.observe(time.perf_counter() - start)
+            subscriber.reply({f"{name}_rollup": buckets, "resolution": query["resolution"]})
+
+        if "control_curtain" in message:
+            value = message["control_curtain"]
+            device_id = message.get("device_id", DEVICE_ID)
+            request_id = message.get("request_id")
+
+            if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= 100:
+                reply = {"error": "control_curtain: the position must be an integer from 0 to 100"}
+                if request_id is not None:
+                    reply["request_id"] = request_id
+                subscriber.reply(reply)
+            elif request_id is not None:
+                self.submit_command(RequestIssuer(subscriber, request_id), device_id, value)
+            else:
+                self.submit_command(subscriber, device_id, value)
+
+    async def handle_application(self, reader, writer):
+        address = writer.get_extra_info("peername")
+        log.info("Application connected from %s:%s", address[0], address[1])
+
+        websocket = WSConnection(ConnectionType.SERVER)
+        subscriber = Subscriber(writer, websocket)
+        self.subscribers.add(subscriber)
+        sender = asyncio.create_task(subscriber.run())
+
+        def reap():
+            log.warning("Application %s: nothing received for %ss, closing the connection",
+                        subscriber.name, APPLICATION_IDLE_TIMEOUT)
+            REAPED["application"].inc()
+            subscriber.abort()
+
+        keepalive = Keepalive(self.timers, APPLICATION_PING_INTERVAL, APPLICATION_IDLE_TIMEOUT, subscriber.ping, reap)
+
+        assembler = wire.MessageAssembler()
+        try:
+            while not subscriber.closed:
+                in_data = await reader.read(4096)
+                if not in_data:
+                    break
+                keepalive.seen()
+                websocket.receive_data(in_data)
+
+                out_data = b""
+                for event in websocket.events():
+                    if isinstance(event, Request):
+                        log.info("Application %s: accepting WebSocket connection", subscriber.name)
+                        subprotocol = wire.choose_subprotocol(event.subprotocols, WIRE_FORMAT)
+                        extensions = wire.server_extensions(WIRE_DEFLATE)
+                        out_data += websocket.send(AcceptConnection(subprotocol=subprotocol, extensions=extensions))
+                        subscriber.binary = wire.is_binary(subprotocol)
+                        subscriber.window_bits = wire.deflate_window_bits(extensions)
+                    elif isinstance(event, CloseConnection):
+                        log.info("Application %s: connection closed", subscriber.name)
+                        out_data += websocket.send(event.response())
+                    elif isinstance(event, Ping):
+                        out_data += websocket.send(event.response())
+                    elif isinstance(event, Pong):
+                        pass
+                    elif wire.is_data_event(event):
+                        if log.isEnabledFor(logging.DEBUG) and sample():
+                            log.debug("Application %s: received %r", subscriber.name, event.data)
+                        message = assembler.feed(event)
+                        if message is not None:
+                            self.handle_application_message(subscriber, message)
+                    else:
+                        log.warning("Application %s: unknown event %r", subscriber.name, event)
+
+                if out_data:
+                    writer.write(out_data)
+                    await writer.drain()
+        except Exception as e:
+            log.warning("Application %s: %s", subscriber.name, e)
+        finally:
+            keepalive.stop()
+            self.subscribers.discard(subscriber)
+            self.rule_hit_subscribers.discard(subscriber)
+            self.broker.unsubscribe_all(subscriber)
+            subscriber.close()
+            sender.cancel()
+
+class RequestIssuer:
+    """Issuer of a command sent with a request_id, which every reply about the command carries."""
+
+    __slots__ = ("subscriber", "request_id")
+
+    def __init__(self, subscriber, request_id):
+        self.subscriber = subscriber
+        self.request_id = request_id
+
+    def reply(self, reply):
+        reply["command"]["request_id"] = self.request_id
+        self.subscriber.reply(reply)
+
+class RemoteIssuer:
+    """Stands in for an application connected to a worker as the issuer of a command."""
+
+    __slots__ = ("bus", "worker", "token")
+
+    def __init__(self, bus, worker, token):
+        self.bus = bus
+        self.worker = worker
+        self.token = token
+
+    def reply(self, reply):
+        self.bus.send(self.worker, {"reply": {"token": self.token, "message": reply}})
+
+class IngestCloud(Cloud):
+    """
+    The main process of a multi-process cloud. It takes the gateways'
+    connections, writes the history, runs the commands and passes every
+    stored reading on to the workers over the bus.
+    """
+
+    serves_applications = False
+
+    def __init__(self):
+        super().__init__()
+        self.bus = cloud_bus.BusServer(CLOUD_BUS_PATH, self.on_bus_message)
+        # Readings stored since the last broadcast as
+        # (msg_type, device_id, timestamp, value, position).
+        self.outgoing = []
+
+        metrics.gauge("cloud_workers_connected", "Worker processes connected to the bus",
+                      function=lambda: len(self.bus.workers))
+        metrics.counter("cloud_worker_disconnects_total", "Workers disconnected for falling behind",
+                        function=lambda: self.bus.disconnected)
+
+    def deliver(self, reading, position):
+        # Everything stored from one message of a gateway is sent in one go.
+        if not self.outgoing:
+            asyncio.get_running_loop().call_soon(self.broadcast)
+        self.outgoing.append(
+            (reading["msg_type"], reading["device_id"], reading["timestamp"], reading["value"], position)
+        )
+
+    def broadcast(self):
+        rows, self.outgoing = self.outgoing, []
+        self.bus.broadcast({"readings": rows})
+
+    def publish_rule_hits(self, hits):
+        self.bus.broadcast({"rule_hits": hits})
+
+    def on_bus_message(self, worker, message):
+        command = message.get("command")
+        if command is not None:
+            issuer = RemoteIssuer(self.bus, worker, command["token"])
+            self.submit_command(issuer, command["device_id"], command["target"])
+
+class WorkerCloud(Cloud):
+    """
+    A worker process of a multi-process cloud. It serves applications from its
+    own broker, rollups and last known readings, kept up to date with the
+    readings the main process passes on, and reads the history from disk.
+    Commands are forwarded to the main process, and what becomes of them is
+    passed back.
+    """
+
+    writes_history = False
+
+    def __init__(self, worker, bus):
+        super().__init__()
+        self.worker = worker
+        self.bus = bus
+        # Length of every series when the rollups were rebuilt. The main
+        # process can pass on readings that had already been flushed then.
+        self.rebuilt = {key: series.count for key, series in self.history.series.items()}
+
+        self.tokens = itertools.count(1)
+        # token -> Subscriber of every command whose final state is not known yet.
+        self.issuers = dict()
+
+    def submit_command(self, issuer, device_id, target):
+        token = next(self.tokens)
+        self.issuers[token] = issuer
+        self.bus.write(cloud_bus.encode({"command": {"token": token, "device_id": device_id, "target": target}}))
+
+    async def follow(self, reader):
+        """Apply what the main process sends until it goes away."""
+        while True:
+            try:
+                message = await cloud_bus.receive(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+
+            if "readings" in message:
+                for msg_type, device_id, timestamp, value, position in message["readings"]:
+                    if position < self.rebuilt.get((msg_type, device_id), 0):
+                        continue
+                    self.deliver({
+                        "msg_type": msg_type,
+                        "device_id": device_id,
+                        "timestamp": timestamp,
+                        "value": value,
+                    }, position)
+            elif "rule_hits" in message:
+                self.publish_rule_hits(message["rule_hits"])
+            elif "reply" in message:
+                token = message["reply"]["token"]
+                reply = message["reply"]["message"]
+                if reply["command"]["state"] in commands.FINAL:
+                    issuer = self.issuers.pop(token, None)
+                else:
+                    issuer = self.issuers.get(token)
+                if issuer is not None:
+                    issuer.reply(reply)
+
+async def start_gateway_server(cloud):
+    context = project_crypto.construct_ssl_context(False, "cloud", "gateway")
+    return await asyncio.start_server(
+        cloud.handle_gateway,
         INTERNAL_CLOUD_IP,
-        APPLICATION_PORT
+        GATEWAY_PORT,
+        ssl=context,
     )
 
-    application_listener.listen()
+async def start_application_server(cloud, reuse_port=False):
+    context = project_crypto.construct_ssl_context(False, "cloud", "application")
+    return await asyncio.start_server(
+        cloud.handle_application,
+        INTERNAL_CLOUD_IP,
+        APPLICATION_PORT,
+        ssl=context,
+        backlog=1024,
+        reuse_port=reuse_port,
+    )
 
-    cloud_websocket_message = ""
+async def start_metrics(port):
+    if port is not None:
+        await metrics.start_asyncio_server(METRICS_HOST, port)
+        log.info("Serving metrics on http://%s:%d/metrics", METRICS_HOST, port)
 
-    applications = dict()
+async def serve():
+    """Run the whole cloud in this process."""
+    cloud = Cloud()
+    gateway_server = await start_gateway_server(cloud)
+    application_server = await start_application_server(cloud)
 
-    temperature_listeners = set()
-    motion_listeners = set()
-    door_listeners = set()
-    curtain_listeners = set()
+    flusher = asyncio.create_task(cloud.flush_history())
+    commander = asyncio.create_task(cloud.run_commands())
+    keeper = asyncio.create_task(cloud.run_timers())
+    await start_metrics(CLOUD_METRICS_PORT)
 
-    new_temperature_data = []
-    new_motion_data = []
-    new_door_data = []
-    new_curtain_data = []
+    log.info("Listening for gateway on %d", GATEWAY_PORT)
+    log.info("Listening for applications on %d", APPLICATION_PORT)
     try:
-        while True:
-            listened_sockets = [gateway, application_listener] + list(applications.keys())
-            readable, writable, exceptional = select.select(
-                listened_sockets,
-                [],
-                listened_sockets,
-                1
+        async with gateway_server, application_server:
+            await asyncio.gather(
+                gateway_server.serve_forever(),
+                application_server.serve_forever(),
             )
+    finally:
+        flusher.cancel()
+        commander.cancel()
+        keeper.cancel()
+        cloud.close()
 
-            for socket in readable:
-                if socket is gateway:
-                    in_data = gateway.recv(4096)
-                    gateway_ws.receive_data(in_data)
-
-                    out_data = b""
-                    for event in gateway_ws.events():
-                        if isinstance(event, Request):
-                            print("Gateway: Accepting WebSocket Connection")
-                            out_data += gateway_ws.send(AcceptConnection())
-                        elif isinstance(event, CloseConnection):
-                            print("Gateway: Connection closed")
-                            out_data += gateway_ws.send(event.response())
-                        elif isinstance(event, TextMessage):
-                            print(f"Received Text Message: {event.data}")
-                            cloud_websocket_message += event.data
-                            if event.message_finished:
-                                # Handle complete JSON message
-                                message = json.loads(cloud_websocket_message)
-                                
-                                if message["msg_type"] == 1:
-                                    file = temperature_history
-                                    new_data = new_temperature_data
-                                elif message["msg_type"] == 2:
-                                    file = motion_history
-                                    new_data = new_motion_data
-                                elif message["msg_type"] == 3:
-                                    file = door_history
-                                    new_data = new_door_data
-                                elif message["msg_type"] == 4:
-                                    file = curtain_history
-                                    new_data = new_curtain_data
-                                
-                                device_id = message["device_id"]
-                                timestamp = message["timestamp"]
-                                value = message["value"]
-
-                                file.write(f"{cloud_websocket_message}\n")
-                                file.flush()
-                                new_data.append(message)
-                                
-                                # Clear stored message to prepare to next potentially fragmented message.
-                                cloud_websocket_message = ""
-                        else:
-                            print(f"Unknown event: {event!r}")
-
-                    gateway.sendall(out_data)
-                    continue
+async def serve_ingest():
+    """Run the main process of a multi-process cloud."""
+    cloud = IngestCloud()
+    await cloud.bus.start()
+    gateway_server = await start_gateway_server(cloud)
 
-                elif socket is application_listener:
-                    application, application_address = application_listener.accept()
-                    print(f"Application connected from {application_address[0]}:{application_address[1]}")
+    flusher = asyncio.create_task(cloud.flush_history())
+    commander = asyncio.create_task(cloud.run_commands())
+    keeper = asyncio.create_task(cloud.run_timers())
+    await start_metrics(CLOUD_METRICS_PORT)
 
-                    applications[application] = (WSConnection(ConnectionType.SERVER), "")
-                    continue
+    log.info("Listening for gateway on %d", GATEWAY_PORT)
+    try:
+        async with gateway_server:
+            await gateway_server.serve_forever()
+    finally:
+        flusher.cancel()
+        commander.cancel()
+        keeper.cancel()
+        cloud.bus.close()
+        cloud.close()
+
+async def serve_worker(worker):
+    """Run worker process number `worker` of a multi-process cloud."""
+    reader, writer = await cloud_bus.connect(CLOUD_BUS_PATH, worker)
+    # Readings arriving while the worker rebuilds its state wait on the bus.
+    cloud = WorkerCloud(worker, writer)
+    writer.write(cloud_bus.encode({"ready": True}))
 
-                # Socket must be an application socket.
-                try:
-                    application_socket = socket
-                    application_websocket, application_data = applications[socket]
-                    in_data = application_socket.recv(4096)
-                    application_websocket.receive_data(in_data)
-
-                    out_data = b""
-                    for event in application_websocket.events():
-                        if isinstance(event, Request):
-                            print("Application: Accepting WebSocket Connection")
-                            out_data += application_websocket.send(AcceptConnection())
-                        elif isinstance(event, CloseConnection):
-                            print("Application: Connection closed")
-                            out_data += application_websocket.send(event.response())
-                        elif isinstance(event, TextMessage):
-                            print(f"Application: Received Text Message: {event.data}")
-                            application_data += format(event.data)
-                            if event.message_finished:
-                                print(application_data)
-                                message = json.loads(application_data)
-                                
-                                if "subscribe_temperature" in message:
-                                    if message["subscribe_temperature"]:
-                                        temperature_listeners.add(application_socket)
-                                    else:
-                                        temperature_listeners.discard(application_socket)
-                                if "subscribe_motion" in message:
-                                    if message["subscribe_motion"]:
-                                        motion_listeners.add(application_socket)
-                                    else:
-                                        motion_listeners.discard(application_socket)
-                                if "subscribe_door" in message:
-                                    if message["subscribe_door"]:
-                                        door_listeners.add(application_socket)
-                                    else:
-                                        door_listeners.discard(application_socket)
-                                if "subscribe_curtain" in message:
-                                    if message["subscribe_curtain"]:
-                                        curtain_listeners.add(application_socket)
-                                    else:
-                                        curtain_listeners.discard(application_socket)
-
-                                if "read_temperature_history" in message and message["read_temperature_history"]:
-                                    temperature_history.seek(0)
-                                    history = temperature_history.read()
-                                    temperature_history.seek(0, 2)
-
-                                    history = list(map(lambda s: json.loads(s), history.splitlines()))
-
-                                    history_message = {"temperature_history": history}
-                                    history_message = json.dumps(history_message)
-                                    out_data += application_websocket.send(Message(data=history_message))
-
-                                if "read_motion_history" in message and message["read_motion_history"]:
-                                    motion_history.seek(0)
-                                    history = motion_history.read()
-                                    motion_history.seek(0, 2)
-
-                                    history = list(map(lambda s: json.loads(s), history.splitlines()))
-
-                                    history_message = {"motion_history": history}
-                                    history_message = json.dumps(history_message)
-                                    out_data += application_websocket.send(Message(data=history_message))
-
-                                if "read_door_history" in message and message["read_door_history"]:
-                                    door_history.seek(0)
-                                    history = door_history.read()
-                                    door_history.seek(0, 2)
-
-                                    history = list(map(lambda s: json.loads(s), history.splitlines()))
-
-                                    history_message = {"door_history": history}
-                                    history_message = json.dumps(history_message)
-                                    out_data += application_websocket.send(Message(data=history_message))
-
-                                if "read_curtain_history" in message and message["read_curtain_history"]:
-                                    curtain_history.seek(0)
-                                    history = curtain_history.read()
-                                    curtain_history.seek(0, 2)
-
-                                    history = list(map(lambda s: json.loads(s), history.splitlines()))
-
-                                    history_message = {"curtain_history": history}
-                                    history_message = json.dumps(history_message)
-                                    out_data += application_websocket.send(Message(data=history_message))
-
-                                if "control_curtain" in message:
-                                    value = message["control_curtain"]
-
-                                    gateway_message = {"control_curtain": value}
-                                    gateway_message = json.dumps(message)
-                                    gateway_out_data = gateway_ws.send(Message(data=gateway_message))
-
-                                    gateway.sendall(gateway_out_data)
-
-                                # Clear stored message to prepare to next potentially fragmented message.
-                                application_data = ""
-                                    
-                        else:
-                            print("Application: Unknown event: {event!r}")
-
-                    application_socket.sendall(out_data)
-                except Exception as e:
-                    print(f"Application Exception: {e}")
-
-                    del applications[socket]
-
-                    temperature_listeners.discard(socket)
-                    motion_listeners.discard(socket)
-                    door_listeners.discard(socket)
-                    curtain_listeners.discard(socket)
-
-            listeners_list = [temperature_listeners, motion_listeners, door_listeners, curtain_listeners]
-            new_data_list = [new_temperature_data, new_motion_data, new_door_data, new_curtain_data]
-
-            # Dead sockets is used because modification of the length of an iterator during iteration triggers an exception.
-            dead_sockets = set()
-            for listeners, new_data in zip(listeners_list, new_data_list):
-                for listener_socket in listeners:
-                    try:
-                        listener_websocket, incoming_data = applications[listener_socket]
-                        for data in new_data:
-                            json_string = json.dumps(message)
-                            out_data = listener_websocket.send(Message(data=json_string))
-                            listener_socket.sendall(out_data)
-                    except Exception as e:
-                        if listener_socket not in dead_sockets:
-                            print(f"Application Exception: {e}")
-
-                            del applications[listener_socket]
-                            dead_sockets.add(listener_socket)
-
-            # Remove any dead sockets from the listener sets.
-            temperature_listeners -= dead_sockets
-            motion_listeners -= dead_sockets
-            door_listeners -= dead_sockets
-            curtain_listeners -= dead_sockets
-
-            new_temperature_data = []
-            new_motion_data = []
-            new_door_data = []
-            new_curtain_data = []
+    # Every worker listens on the same port and the kernel spreads the
+    # application connections between them.
+    application_server = await start_application_server(cloud, reuse_port=True)
+    keeper = asyncio.create_task(cloud.run_timers())
+    if CLOUD_METRICS_PORT is not None:
+        await start_metrics(CLOUD_METRICS_PORT + 1 + worker)
 
+    log.info("Worker %d: listening for applications on %d", worker, APPLICATION_PORT)
+    try:
+        async with application_server:
+            await cloud.follow(reader)
+        log.warning("Worker %d: lost the main process", worker)
     finally:
-        gateway.close()
-        gateway_listener.close()
-        application_listener.close()
+        keeper.cancel()
+        writer.close()
+        cloud.close()
+
+def run_process(serve_function, *args):
+    """Run one process of a multi-process cloud until it is sent SIGTERM."""
+    # Ctrl-C reaches every process of the group; supervise() stops the others.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def handle_exception(loop, context):
+        # Python 3.11 reports the connection handlers cancelled on the way
+        # out as failures.
+        if not isinstance(context.get("exception"), asyncio.CancelledError):
+            loop.default_exception_handler(context)
 
-        for application_socket in applications.keys():
-            application_socket.close()
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.set_exception_handler(handle_exception)
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        await serve_function(*args)
 
-        temperature_history.close()
-        motion_history.close()
-        door_history.close()
-        curtain_history.close()
+    try:
+        asyncio.run(run())
+    except asyncio.CancelledError:
+        pass
+
+def supervise():
+    """
+    Run the cloud as one ingest process and CLOUD_WORKERS worker processes,
+    starting again any that stops.
+    """
+    # Forked before any event loop exists, so the processes see the same
+    # configuration as this one.
+    context = multiprocessing.get_context("fork")
+    roles = {"ingest": (serve_ingest,)}
+    for worker in range(CLOUD_WORKERS):
+        roles[f"worker-{worker}"] = (serve_worker, worker)
+
+    processes = dict()
+
+    def start(name):
+        process = context.Process(target=run_process, args=roles[name], name=f"cloud-{name}")
+        process.start()
+        processes[name] = process
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        for name in roles:
+            start(name)
+        log.info("Started the ingest process and %d workers", CLOUD_WORKERS)
+
+        while True:
+            multiprocessing.connection.wait([process.sentinel for process in processes.values()])
+            stopped = [name for name, process in processes.items() if not process.is_alive()]
+            for name in stopped:
+                log.warning("Cloud process %s exited with code %s", name, processes[name].exitcode)
+            # Do not spin when a process fails right away.
+            time.sleep(1)
+            for name in stopped:
+                start(name)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in processes.values():
+            process.join()
+
+def main():
+    logs.setup(LOG_LEVEL)
+    if CLOUD_WORKERS:
+        supervise()
+    else:
+        asyncio.run(serve())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+import struct
+
+from common.predicates import compile_predicate
+from common import wire
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+
+def encode_frame(payload, opcode=OPCODE_TEXT, compressed=False):
+    """
+    Build a complete, unmasked (server to client) WebSocket frame. The frame
+    does not depend on the connection, so it can be written to any number of
+    applications. compressed sets RSV1 for a permessage-deflate payload.
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+
+    first = 0x80 | opcode
+    if compressed:
+        first |= 0x40
+
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", first, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", first, 126, length)
+    else:
+        header = struct.pack("!BBQ", first, 127, length)
+    return header + payload
+
+class EncodedMessage:
+    """
+    A message together with its WebSocket frames. Each frame variant (JSON or
+    CBOR, compressed or not) is built the first time a subscriber asks for it
+    and then shared by every subscriber that uses the same variant.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.frames = dict()
+
+    def frame(self, binary, window_bits=None):
+        key = (binary, window_bits)
+        frame = self.frames.get(key)
+        if frame is None:
+            payload = wire.encode(self.message, binary)
+            if isinstance(payload, str):
+                payload = payload.encode()
+            opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+
+            if window_bits is not None and len(payload) >= wire.DEFLATE_MIN_SIZE:
+                frame = encode_frame(wire.compress(payload, window_bits), opcode, compressed=True)
+            else:
+                frame = encode_frame(payload, opcode)
+            self.frames[key] = frame
+        return frame
+
+class Subscription:
+    def __init__(self, subscriber, subscription_id, msg_types, device_ids, where):
+        self.subscriber = subscriber
+        self.subscription_id = subscription_id
+        # None matches everything.
+        self.msg_types = msg_types
+        self.device_ids = device_ids
+        self.predicate = compile_predicate(where)
+
+    def keys(self):
+        """The (msg_type, device_id) index keys this subscription is stored under."""
+        for msg_type in self.msg_types or [None]:
+            for device_id in self.device_ids or [None]:
+                yield msg_type, device_id
+
+class Broker:
+    """
+    Publishes readings to subscribers.
+
+    Subscriptions are indexed by (msg_type, device_id), with None standing for
+    "any", so finding the subscriptions for a reading is four dictionary
+    lookups no matter how many subscriptions exist. Each reading is wrapped in
+    a single EncodedMessage handed to every subscriber through
+    subscriber.publish(key, encoded), so it is serialized and framed once per
+    wire format rather than once per subscriber.
+    """
+
+    def __init__(self):
+        self.index = dict()
+        # subscriber -> {subscription_id: Subscription}
+        self.subscriptions = dict()
+
+    def subscribe(self, subscriber, subscription_id, msg_types=None, device_ids=None, where=None):
+        """Add or replace a subscription. Raises ValueError for an invalid where clause."""
+        subscription = Subscription(subscriber, subscription_id, msg_types, device_ids, where)
+
+        self.unsubscribe(subscriber, subscription_id)
+        self.subscriptions.setdefault(subscriber, dict())[subscription_id] = subscription
+        for key in subscription.keys():
+            self.index.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscriber, subscription_id):
+        subscriptions = self.subscriptions.get(subscriber)
+        if not subscriptions or subscription_id not in subscriptions:
+            return False
+
+        subscription = subscriptions.pop(subscription_id)
+        if not subscriptions:
+            del self.subscriptions[subscriber]
+
+        for key in subscription.keys():
+            matching = self.index[key]
+            matching.discard(subscription)
+            if not matching:
+                del self.index[key]
+        return True
+
+    def unsubscribe_all(self, subscriber):
+        for subscription_id in list(self.subscriptions.get(subscriber, ())):
+            self.unsubscribe(subscriber, subscription_id)
+
+    def matching_subscribers(self, reading):
+        msg_type = reading["msg_type"]
+        device_id = reading["device_id"]
+        value = reading["value"]
+
+        subscribers = set()
+        for key in ((msg_type, device_id), (msg_type, None), (None, device_id), (None, None)):
+            for subscription in self.index.get(key, ()):
+                if subscription.predicate is None or subscription.predicate(value):
+                    subscribers.add(subscription.subscriber)
+        return subscribers
+
+    def publish(self, reading):
+        """Send a reading to every matching subscriber. Returns the number of subscribers."""
+        subscribers = self.matching_subscribers(reading)
+        if not subscribers:
+            return 0
+
+        encoded = EncodedMessage(reading)
+        key = (reading["msg_type"], reading["device_id"])
+        for subscriber in subscribers:
+            subscriber.publish(key, encoded)
+        return len(subscribers)
@@ -0,0 +1,140 @@
+import heapq
+import itertools
+import time
+
+class _Series:
+    __slots__ = ("value", "timestamp", "pending", "version")
+
+    def __init__(self, reading):
+        # The last reading forwarded.
+        self.value = reading["value"]
+        self.timestamp = reading["timestamp"]
+        # The last reading held back that differs from it, if any.
+        self.pending = None
+        # Told apart from older entries for the series in the settle heap.
+        self.version = 0
+
+class ChangeFilter:
+    """
+    Decides which readings the gateway forwards to the cloud, so that readings
+    that say nothing new do not use the uplink or the cloud's history.
+
+    filters maps msg_type to a dictionary. An empty one forwards a reading only
+    when its value differs from the last one forwarded for the device, which is
+    meant for booleans. {"absolute": a} or {"percent": p} is a deadband: a
+    number is forwarded once it is at least a, or p percent of the last
+    forwarded value, away from it. Readings of other msg_types are always
+    forwarded. Besides that, a reading is forwarded when the last one forwarded
+    for its device is `heartbeat` seconds older, going by reading timestamps.
+
+    A reading held back by a deadband is forwarded anyway when no newer reading
+    arrives from the device for `settle` seconds, so the position a curtain
+    stops at always reaches the cloud. The owner calls poll() when timeout()
+    says so. heartbeat and settle can be set per msg_type as well.
+
+    seen and suppressed count readings per msg_type.
+    """
+
+    def __init__(self, filters, heartbeat=300, settle=2.0, clock=time.monotonic):
+        self.filters = dict()
+        for msg_type, spec in filters.items():
+            unknown = set(spec) - {"absolute", "percent", "heartbeat", "settle"}
+            if unknown:
+                raise ValueError(f"filter for msg_type {msg_type}: unknown keys {', '.join(sorted(unknown))}")
+            if "absolute" in spec and "percent" in spec:
+                raise ValueError(f"filter for msg_type {msg_type}: absolute and percent are exclusive")
+            self.filters[msg_type] = (
+                spec.get("absolute"),
+                spec.get("percent"),
+                spec.get("heartbeat", heartbeat),
+                spec.get("settle", settle),
+            )
+        self.clock = clock
+
+        # (msg_type, device_id) -> _Series
+        self.series = dict()
+        # (deadline, order, key, version) of held back readings.
+        self.settling = []
+        self.order = itertools.count()
+
+        self.seen = {msg_type: 0 for msg_type in self.filters}
+        self.suppressed = {msg_type: 0 for msg_type in self.filters}
+
+    def forward(self, reading):
+        """Whether to forward a reading now."""
+        msg_type = reading["msg_type"]
+        spec = self.filters.get(msg_type)
+        if spec is None:
+            return True
+        absolute, percent, heartbeat, settle = spec
+        self.seen[msg_type] += 1
+
+        key = (msg_type, reading["device_id"])
+        series = self.series.get(key)
+        if series is None:
+            self.series[key] = _Series(reading)
+            return True
+
+        value = reading["value"]
+        if (
+            self._changed(series.value, value, absolute, percent)
+            or (heartbeat is not None and reading["timestamp"] - series.timestamp >= heartbeat)
+        ):
+            self._forwarded(series, reading)
+            return True
+
+        self.suppressed[msg_type] += 1
+        if value == series.value:
+            series.pending = None
+        else:
+            series.pending = reading
+            series.version += 1
+            heapq.heappush(self.settling, (self.clock() + settle, next(self.order), key, series.version))
+        return False
+
+    @staticmethod
+    def _changed(last, value, absolute, percent):
+        if absolute is None and percent is None:
+            return value != last
+        try:
+            difference = abs(value - last)
+        except TypeError:
+            return value != last
+        if absolute is not None:
+            return difference >= absolute
+        return difference >= abs(last) * percent / 100 if last else difference > 0
+
+    def _forwarded(self, series, reading):
+        series.value = reading["value"]
+        series.timestamp = max(series.timestamp, reading["timestamp"])
+        series.pending = None
+
+    def timeout(self):
+        """Seconds until poll() has a held back reading to forward, or None."""
+        while self.settling:
+            deadline, _, key, version = self.settling[0]
+            series = self.series.get(key)
+            if series is not None and series.pending is not None and series.version == version:
+                return max(0.0, deadline - self.clock())
+            heapq.heappop(self.settling)
+        return None
+
+    def poll(self):
+        """Return the held back readings whose devices have been quiet for `settle` seconds."""
+        now = self.clock()
+        readings = []
+        while self.settling and self.settling[0][0] <= now:
+            _, _, key, version = heapq.heappop(self.settling)
+            series = self.series.get(key)
+            if series is None or series.pending is None or series.version != version:
+                continue
+            reading = series.pending
+            self._forwarded(series, reading)
+            # It was counted as suppressed when it arrived.
+            self.suppressed[reading["msg_type"]] -= 1
+            readings.append(reading)
+        return readings
+
+    def stats(self):
+        """{msg_type: (seen, suppressed)}"""
+        return {msg_type: (self.seen[msg_type], self.suppressed[msg_type]) for msg_type in self.filters}
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import struct
+
+import cbor2
+
+log = logging.getLogger("cloud_bus")
+
+# Every message on the bus is a CBOR item preceded by its length.
+HEADER = struct.Struct("!I")
+
+def encode(message):
+    data = cbor2.dumps(message)
+    return HEADER.pack(len(data)) + data
+
+async def receive(reader):
+    """Read one message. Raises asyncio.IncompleteReadError once the other end has closed."""
+    (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return cbor2.loads(await reader.readexactly(size))
+
+async def connect(path, worker, retry=0.1):
+    """
+    Connect worker number `worker` to the bus at path, waiting for the main
+    process to create it. Returns the (reader, writer) pair of the connection.
+    """
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            await asyncio.sleep(retry)
+    writer.write(encode({"worker": worker}))
+    return reader, writer
+
+class BusServer:
+    """
+    The main process's end of the bus between the processes of a
+    multi-process cloud, a Unix socket at path.
+
+    Workers connect with connect() and tell when they have finished starting
+    with {"ready": true}. broadcast() sends a message to every connected worker
+    and encodes it only once; send() sends one to a single worker. Other
+    messages from the workers are passed to on_message(worker, message).
+
+    Messages for a worker that is still starting are buffered. Once it is
+    ready, a worker that falls more than max_buffer bytes behind is
+    disconnected, which makes it exit and start over.
+    """
+
+    def __init__(self, path, on_message, max_buffer=64 * 1024 * 1024):
+        self.path = path
+        self.on_message = on_message
+        self.max_buffer = max_buffer
+        self.server = None
+        # worker -> StreamWriter of its connection
+        self.workers = dict()
+        self.ready = set()
+        self.disconnected = 0
+
+    async def start(self):
+        try:
+            # Left behind by a previous main process.
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.server = await asyncio.start_unix_server(self._handle, self.path)
+
+    async def _handle(self, reader, writer):
+        worker = None
+        try:
+            worker = (await receive(reader))["worker"]
+            previous = self.workers.get(worker)
+            if previous is not None:
+                previous.close()
+            self.workers[worker] = writer
+            self.ready.discard(worker)
+            log.info("Worker %d connected", worker)
+
+            while True:
+                message = await receive(reader)
+                if message.get("ready"):
+                    self.ready.add(worker)
+                    log.info("Worker %d ready", worker)
+                else:
+                    self.on_message(worker, message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if worker is not None and self.workers.get(worker) is writer:
+                del self.workers[worker]
+                self.ready.discard(worker)
+                log.info("Worker %d disconnected", worker)
+            writer.close()
+
+    def _write(self, worker, writer, data):
+        if worker in self.ready and writer.transport.get_write_buffer_size() > self.max_buffer:
+            log.warning("Worker %d: disconnecting, more than %d bytes behind", worker, self.max_buffer)
+            self.disconnected += 1
+            del self.workers[worker]
+            self.ready.discard(worker)
+            writer.close()
+            return
+        writer.write(data)
+
+    def broadcast(self, message):
+        if not self.workers:
+            return
+        data = encode(message)
+        for worker, writer in list(self.workers.items()):
+            self._write(worker, writer, data)
+
+    def send(self, worker, message):
+        writer = self.workers.get(worker)
+        if writer is not None:
+            self._write(worker, writer, encode(message))
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for writer in self.workers.values():
+            writer.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
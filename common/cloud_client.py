@@ -0,0 +1,433 @@
+import asyncio
+import collections
+import itertools
+import logging
+
+from wsproto import WSConnection
+from wsproto.connection import ConnectionType
+from wsproto.utilities import LocalProtocolError, RemoteProtocolError
+from wsproto.events import (
+    AcceptConnection,
+    RejectConnection,
+    CloseConnection,
+    Message,
+    Ping,
+    Request,
+)
+
+from common.config import *
+from common import commands
+from common import project_crypto
+from common import wire
+from common.predicates import compile_predicate
+
+log = logging.getLogger("cloud_client")
+
+def _as_set(value):
+    if value is None:
+        return None
+    return set(value) if isinstance(value, list) else {value}
+
+class Stream:
+    """
+    The readings of one subscription, as an async iterator. It starts with the
+    snapshot the cloud answers the subscription with. After a reconnect, the
+    snapshot only adds readings newer than the ones the stream has yielded, so
+    the iterator carries on with what changed while the client was away.
+
+    An application more than queue_size readings behind loses the oldest ones,
+    counted in dropped. Iteration ends once the subscription is closed.
+    """
+
+    def __init__(self, client, subscription_id, request, queue_size):
+        self.client = client
+        self.subscription_id = subscription_id
+        self.request = request
+        self.msg_types = _as_set(request.get("msg_type"))
+        self.device_ids = _as_set(request.get("device_id"))
+        self.predicate = compile_predicate(request.get("where"))
+
+        self.readings = collections.deque(maxlen=queue_size)
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+        # (msg_type, device_id) -> timestamp of the newest reading queued.
+        self.latest = dict()
+
+    def matches(self, reading):
+        return (
+            (self.msg_types is None or reading["msg_type"] in self.msg_types)
+            and (self.device_ids is None or reading["device_id"] in self.device_ids)
+            and (self.predicate is None or self.predicate(reading["value"]))
+        )
+
+    def put(self, reading, snapshot=False):
+        key = (reading["msg_type"], reading["device_id"])
+        latest = self.latest.get(key)
+        if snapshot and latest is not None and reading["timestamp"] <= latest:
+            return
+        if latest is None or reading["timestamp"] > latest:
+            self.latest[key] = reading["timestamp"]
+
+        if len(self.readings) == self.readings.maxlen:
+            self.dropped += 1
+        self.readings.append(reading)
+        self.ready.set()
+
+    def end(self):
+        self.closed = True
+        self.ready.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.readings:
+            if self.closed:
+                raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+        return self.readings.popleft()
+
+    async def close(self):
+        await self.client.unsubscribe(self.subscription_id)
+
+class CloudClient:
+    """
+    asyncio client for applications of the cloud:
+
+        async with CloudClient() as cloud:
+            hot = cloud.subscribe("hot", msg_type=1, where={"gt": 30})
+            command = await cloud.control_curtain("ESP8266Client", 50)
+            async for reading in hot:
+                ...
+
+    The client connects over mTLS in the background and, when the connection
+    is lost, reconnects with backoff, resuming the TLS session. Incoming data
+    is parsed as it arrives. Subscriptions are sent again on every connection.
+
+    state maps (msg_type, device_id) to the newest reading the client knows of
+    for every device. It is filled from a get_state request on every connection
+    (with sync_state) and kept up to date from snapshots and subscribed
+    readings, so applications do not read the history to know where things
+    stand.
+
+    Requests wait for a connection. Those still waiting for their reply when
+    the connection is lost raise ConnectionError.
+    """
+
+    def __init__(
+        self,
+        host=EXTERNAL_CLOUD_IP,
+        port=APPLICATION_PORT,
+        wire_format=WIRE_FORMAT,
+        deflate=WIRE_DEFLATE,
+        min_delay=APPLICATION_RECONNECT_MIN,
+        max_delay=APPLICATION_RECONNECT_MAX,
+        jitter=RECONNECT_JITTER,
+        sync_state=True,
+        queue_size=10000,
+    ):
+        self.host = host
+        self.wire_format = wire_format
+        self.deflate = deflate
+        self.sync_state = sync_state
+        self.queue_size = queue_size
+        self.connector = project_crypto.Connector(
+            "application", "cloud", host, port, min_delay, max_delay, jitter,
+        )
+
+        self.state = dict()
+        # subscription id -> Stream
+        self.streams = dict()
+        self.request_ids = itertools.count(1)
+        # request_id -> (future, states) of curtain commands
+        self.commands = dict()
+        # reply key, such as "state" or "temperature_history" -> futures of
+        # the requests waiting for it, in the order they were sent.
+        self.replies = collections.defaultdict(collections.deque)
+
+        self.connected = asyncio.Event()
+        self.task = None
+        self.tls = None
+        self.websocket = None
+        self.binary = False
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for stream in self.streams.values():
+            stream.end()
+        self.streams.clear()
+
+    async def wait_connected(self):
+        await self.connected.wait()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.connector.wait())
+            try:
+                tls = await self.connector.open()
+            except OSError as e:
+                log.warning("Failed to connect to cloud: %s, retrying in %.1fs", e, self.connector.wait())
+                continue
+
+            kind = "resumed" if tls.session_reused else "full"
+            log.info("Connected to cloud, TLS handshake took %.1f ms (%s)", self.connector.last_handshake_seconds * 1000, kind)
+            try:
+                await self._session(tls)
+            except (OSError, LocalProtocolError, RemoteProtocolError) as e:
+                self._disconnected(e)
+                delay = self.connector.lost(tls)
+                log.warning("Lost connection to cloud: %s, reconnecting in %.1fs", e, delay)
+            except Exception as e:
+                # A message that failed to decode or to be handled. Start over
+                # rather than leave requests and streams waiting on a dead task.
+                self._disconnected(e)
+                delay = self.connector.lost(tls)
+                log.exception("Error on the cloud connection, reconnecting in %.1fs", delay)
+            except BaseException:
+                self._disconnected(ConnectionError("client closed"))
+                tls.close()
+                raise
+
+    async def _session(self, tls):
+        websocket = WSConnection(ConnectionType.CLIENT)
+        tls.write(websocket.send(Request(
+            host=self.host,
+            target="server",
+            subprotocols=wire.client_subprotocols(self.wire_format),
+            extensions=wire.client_extensions(self.deflate),
+        )))
+        await tls.drain()
+
+        assembler = wire.MessageAssembler()
+        while True:
+            data = await tls.read()
+            if not data:
+                raise ConnectionError("cloud closed the connection")
+            websocket.receive_data(data)
+
+            for event in websocket.events():
+                if isinstance(event, AcceptConnection):
+                    log.info("Cloud WebSocket established (%s)", event.subprotocol or "json")
+                    self.tls = tls
+                    self.websocket = websocket
+                    self.binary = wire.is_binary(event.subprotocol)
+                    self.connector.established()
+                    self._connected()
+                elif isinstance(event, RejectConnection):
+                    raise ConnectionError("cloud websocket connection rejected")
+                elif isinstance(event, CloseConnection):
+                    tls.write(websocket.send(event.response()))
+                    raise ConnectionError(f"cloud closed the websocket: code={event.code} reason={event.reason}")
+                elif isinstance(event, Ping):
+                    tls.write(websocket.send(event.response()))
+                elif wire.is_data_event(event):
+                    message = assembler.feed(event)
+                    if message is not None:
+                        self._dispatch(message)
+                else:
+                    log.warning("Unsupported event: %r", event)
+            await tls.drain()
+
+    def _connected(self):
+        # Subscriptions go first, so their snapshots are compared with what
+        # the streams yielded before the reply to get_state updates state.
+        for stream in self.streams.values():
+            self._write({"subscribe": stream.request})
+        if self.sync_state:
+            self.replies["state"].append(asyncio.get_running_loop().create_future())
+            self._write({"get_state": True})
+        self.connected.set()
+
+    def _disconnected(self, error):
+        self.connected.clear()
+        self.tls = None
+        self.websocket = None
+        error = ConnectionError(f"connection to the cloud lost: {error}")
+        futures = [future for future, _ in self.commands.values()]
+        for waiting in self.replies.values():
+            futures.extend(waiting)
+            waiting.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+                # Futures nobody waits for, like the one of sync_state.
+                future.exception()
+
+    def _write(self, message):
+        self.tls.write(self.websocket.send(Message(data=wire.encode(message, self.binary))))
+
+    def _update_state(self, reading):
+        key = (reading["msg_type"], reading["device_id"])
+        known = self.state.get(key)
+        if known is None or reading["timestamp"] >= known["timestamp"]:
+            self.state[key] = reading
+
+    def _dispatch(self, message):
+        if "msg_type" in message and "value" in message:
+            self._update_state(message)
+            for stream in self.streams.values():
+                if stream.matches(message):
+                    stream.put(message)
+            return
+
+        if "snapshot" in message:
+            snapshot = message["snapshot"]
+            stream = self.streams.get(snapshot["id"])
+            for reading in snapshot["readings"]:
+                self._update_state(reading)
+                if stream is not None:
+                    stream.put(reading, snapshot=True)
+            return
+
+        if "command" in message:
+            command = message["command"]
+            pending = self.commands.get(command.get("request_id"))
+            if pending is not None:
+                future, states = pending
+                if (command["state"] in states or command["state"] in commands.FINAL) and not future.done():
+                    future.set_result(command)
+            return
+
+        if "state" in message:
+            for reading in message["state"]:
+                self._update_state(reading)
+
+        if "error" in message:
+            self._error(message)
+            return
+
+        for key, waiting in self.replies.items():
+            if key in message and waiting:
+                future = waiting.popleft()
+                if not future.done():
+                    future.set_result(message)
+                return
+
+        log.debug("Unexpected message from cloud: %r", message)
+
+    def _error(self, message):
+        error = message["error"]
+        if "request_id" in message:
+            pending = self.commands.get(message["request_id"])
+            if pending is not None and not pending[0].done():
+                pending[0].set_exception(ValueError(error))
+            return
+
+        # Errors name the request, such as "read_door_history: ...", and the
+        # reply to read_door_history is a door_history message.
+        request, _, _ = error.partition(":")
+        waiting = self.replies.get(request.removeprefix("read_"))
+        if waiting:
+            future = waiting.popleft()
+            if not future.done():
+                future.set_exception(ValueError(error))
+        else:
+            log.warning("Cloud reported an error: %s", error)
+
+    async def _request(self, key, message):
+        """Send a request and return the next message with key, the name of its reply."""
+        await self.connected.wait()
+        future = asyncio.get_running_loop().create_future()
+        self.replies[key].append(future)
+        self._write(message)
+        await self.tls.drain()
+        return await future
+
+    def subscribe(self, subscription_id, msg_type=None, device_id=None, where=None, queue_size=None):
+        """
+        Subscribe to the readings with the given msg_type and device_id (a value
+        or a list, None for all) whose value matches the where predicate, such as
+        {"gt": 30}. Returns a Stream. Raises ValueError for a bad predicate.
+        """
+        if not isinstance(subscription_id, (str, int)):
+            raise ValueError("subscription ids are strings or integers")
+        request = {"id": subscription_id}
+        for key, value in (("msg_type", msg_type), ("device_id", device_id), ("where", where)):
+            if value is not None:
+                request[key] = value
+
+        previous = self.streams.pop(subscription_id, None)
+        if previous is not None:
+            previous.end()
+        stream = Stream(self, subscription_id, request, queue_size or self.queue_size)
+        self.streams[subscription_id] = stream
+        if self.connected.is_set():
+            self._write({"subscribe": request})
+        return stream
+
+    async def unsubscribe(self, subscription_id):
+        stream = self.streams.pop(subscription_id, None)
+        if stream is not None:
+            stream.end()
+        if self.connected.is_set():
+            self._write({"unsubscribe": subscription_id})
+            await self.tls.drain()
+
+    async def control_curtain(self, device_id, position, until=commands.FINAL):
+        """
+        Move a curtain to a position from 0 to 100. Returns the cloud's report
+        on the command, such as {"id": 7, "device_id": ..., "target": 50,
+        "state": "completed", "latency_ms": 4210.5}, once its state is one of
+        until (or final). Raises ValueError if the cloud rejects the command.
+        """
+        await self.connected.wait()
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.commands[request_id] = (future, until)
+        try:
+            self._write({"control_curtain": position, "device_id": device_id, "request_id": request_id})
+            await self.tls.drain()
+            return await future
+        finally:
+            del self.commands[request_id]
+
+    async def get_state(self, msg_type=None, device_id=None):
+        """The last known reading of every matching device. Also updates state."""
+        query = {key: value for key, value in (("msg_type", msg_type), ("device_id", device_id)) if value is not None}
+        reply = await self._request("state", {"get_state": query or True})
+        return reply["state"]
+
+    async def history(self, msg_type, since=None, until=None, device_id=None, page_size=1000):
+        """Async generator over the stored readings of a msg_type, read page_size at a time."""
+        name = MSG_TYPE_NAMES[msg_type]
+        query = {"limit": page_size}
+        for key, value in (("since", since), ("until", until), ("device_id", device_id)):
+            if value is not None:
+                query[key] = value
+
+        while True:
+            reply = await self._request(f"{name}_history", {f"read_{name}_history": query})
+            for reading in reply[f"{name}_history"]:
+                yield reading
+            if reply.get("next_cursor") is None:
+                return
+            query["cursor"] = reply["next_cursor"]
+
+    async def rollup(self, msg_type, resolution, since=None, until=None, device_id=None):
+        """The rollup buckets of a msg_type at a resolution such as "1h"."""
+        name = MSG_TYPE_NAMES[msg_type]
+        query = {"resolution": resolution}
+        for key, value in (("since", since), ("until", until), ("device_id", device_id)):
+            if value is not None:
+                query[key] = value
+        reply = await self._request(f"{name}_rollup", {f"read_{name}_rollup": query})
+        return reply[f"{name}_rollup"]
@@ -0,0 +1,145 @@
+import itertools
+import time
+
+# Command states reported to the application that issued a command.
+QUEUED = "queued"           # waiting for the device's rate limit
+SENT = "sent"               # handed to the device's gateway
+COMPLETED = "completed"     # the device reported the target position
+SUPERSEDED = "superseded"   # replaced by a newer command for the same device
+TIMEOUT = "timeout"         # sent, but the device never reported the target
+FAILED = "failed"           # no gateway connected for the device
+
+# States after which nothing more is reported about a command.
+FINAL = (COMPLETED, SUPERSEDED, TIMEOUT, FAILED)
+
+class Command:
+    __slots__ = ("command_id", "device_id", "target", "issuer", "submitted", "sent")
+
+    def __init__(self, command_id, device_id, target, issuer, submitted):
+        self.command_id = command_id
+        self.device_id = device_id
+        self.target = target
+        self.issuer = issuer
+        self.submitted = submitted
+        self.sent = None
+
+class _Device:
+    __slots__ = ("tokens", "refilled", "queued", "in_flight", "position")
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.refilled = now
+        # Newest command waiting for a token, and the command sent last that
+        # the device has not reached yet.
+        self.queued = None
+        self.in_flight = None
+        # Last position the device reported, None until it reports one.
+        self.position = None
+
+class CommandManager:
+    """
+    Curtain position commands from applications to devices.
+
+    Every command gets an ID. Since only the newest target matters, a command
+    replaces the one still queued for the same device, and the command in
+    flight once it is sent. Each device has a token bucket of `burst` commands
+    refilled at `rate` per second; a command without a token waits in the
+    queue (where newer ones replace it) until one is available. A sent command
+    completes when the device reports the target position in a curtain status,
+    or times out after `timeout` seconds.
+
+    send(command) delivers a command and returns False if the device is
+    unreachable. notify(command, state, fields) reports a change of state to
+    the issuer; fields has the ID of the replacing command for SUPERSEDED and
+    the time since submission for COMPLETED. The owner calls poll() at the
+    time it returns, or earlier after submit().
+    """
+
+    def __init__(self, send, notify, rate=1.0, burst=2, timeout=30.0, clock=time.monotonic):
+        self.send = send
+        self.notify = notify
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.clock = clock
+        self.ids = itertools.count(1)
+        # device_id -> _Device
+        self.devices = dict()
+
+    def _device(self, device_id, now):
+        device = self.devices.get(device_id)
+        if device is None:
+            device = _Device(self.burst, now)
+            self.devices[device_id] = device
+        return device
+
+    def submit(self, device_id, target, issuer):
+        """Queue a command, sending it right away if the device has a token. Returns it."""
+        now = self.clock()
+        device = self._device(device_id, now)
+        command = Command(next(self.ids), device_id, target, issuer, now)
+
+        if device.queued is not None:
+            self.notify(device.queued, SUPERSEDED, {"by": command.command_id})
+        device.queued = command
+        self._dispatch(device, now)
+        if device.queued is command:
+            self.notify(command, QUEUED, {})
+        return command
+
+    def on_status(self, device_id, position):
+        """Record a curtain status from a device, completing the command in flight when it matches."""
+        device = self._device(device_id, self.clock())
+        device.position = position
+
+        command = device.in_flight
+        if command is not None and position == command.target:
+            device.in_flight = None
+            self.notify(command, COMPLETED, {"latency_ms": round((self.clock() - command.submitted) * 1000, 1)})
+
+    def poll(self):
+        """
+        Send queued commands whose device has a token again and time out the
+        ones in flight for too long. Returns the seconds until the next of
+        these is due, or None if nothing is waiting.
+        """
+        now = self.clock()
+        deadline = None
+        for device in self.devices.values():
+            if device.queued is not None:
+                self._dispatch(device, now)
+            if device.in_flight is not None and now - device.in_flight.sent >= self.timeout:
+                command = device.in_flight
+                device.in_flight = None
+                self.notify(command, TIMEOUT, {})
+
+            if device.queued is not None:
+                due = (1 - device.tokens) / self.rate
+                deadline = due if deadline is None else min(deadline, due)
+            if device.in_flight is not None:
+                due = device.in_flight.sent + self.timeout - now
+                deadline = due if deadline is None else min(deadline, due)
+        return None if deadline is None else max(0.0, deadline)
+
+    def _dispatch(self, device, now):
+        device.tokens = min(self.burst, device.tokens + (now - device.refilled) * self.rate)
+        device.refilled = now
+        if device.tokens < 1:
+            return
+
+        command = device.queued
+        device.queued = None
+        if not self.send(command):
+            self.notify(command, FAILED, {"error": f"no gateway connected for {command.device_id}"})
+            return
+
+        device.tokens -= 1
+        command.sent = now
+        if device.in_flight is not None:
+            self.notify(device.in_flight, SUPERSEDED, {"by": command.command_id})
+        device.in_flight = command
+        self.notify(command, SENT, {})
+
+        # The device only reports its position while it moves.
+        if device.position == command.target:
+            self.on_status(command.device_id, device.position)
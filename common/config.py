@@ -8,8 +8,203 @@ BROKER_PORT = 1883
 
 DEVICE_ID = "ESP8266Client"
 
+# Identifies this gateway to the cloud. Every site needs its own GATEWAY_ID;
+# the cloud routes commands for a device to the gateway it was last heard through.
+GATEWAY_ID = "gateway-1"
+
 INTERNAL_CLOUD_IP = "10.0.146.211"
 EXTERNAL_CLOUD_IP = "64.181.223.164"
 
 GATEWAY_PORT = 1024
 APPLICATION_PORT = 1025
+
+MSG_TYPE_NAMES = {
+    1: "temperature",
+    2: "motion",
+    3: "door",
+    4: "curtain",
+}
+
+# Directory holding the cloud's binary history store.
+HISTORY_DIR = "history"
+
+# History responses are streamed to applications as WebSocket fragments of
+# roughly this many characters.
+HISTORY_FRAGMENT_SIZE = 16 * 1024
+
+# The newest readings of every (msg_type, device_id) are kept in memory so
+# queries for recent history do not read the disk: at most
+# HISTORY_CACHE_RECORDS readings (17 bytes each) covering no more than
+# HISTORY_CACHE_SECONDS. A HISTORY_CACHE_RECORDS of 0 disables the cache.
+HISTORY_CACHE_RECORDS = 4096
+HISTORY_CACHE_SECONDS = 60 * 60
+
+# History writes are group committed: records are flushed to the files once
+# HISTORY_FLUSH_RECORDS are pending or every HISTORY_FLUSH_INTERVAL_MS,
+# whichever comes first. HISTORY_FSYNC is "none" (leave it to the OS),
+# "interval" (fsync at most every HISTORY_FSYNC_INTERVAL seconds) or
+# "every-batch" (fsync on every flush).
+HISTORY_FLUSH_RECORDS = 256
+HISTORY_FLUSH_INTERVAL_MS = 100
+HISTORY_FSYNC = "none"
+HISTORY_FSYNC_INTERVAL = 1.0
+
+# Rollups kept in memory by the cloud and served by read_<name>_rollup.
+# ROLLUP_KINDS maps msg_type to "numeric" (count/min/max/mean) or "state"
+# (count, closed-to-open events and seconds open). ROLLUP_RETENTION is how many
+# seconds of buckets are kept per resolution, None keeps all of them. The
+# rollups are rebuilt from the history store when the cloud starts.
+ROLLUP_KINDS = {1: "numeric", 2: "state", 3: "state", 4: "state"}
+ROLLUP_RESOLUTIONS = {"1m": 60, "1h": 60 * 60, "1d": 24 * 60 * 60}
+ROLLUP_RETENTION = {"1m": 2 * 24 * 60 * 60, "1h": 90 * 24 * 60 * 60, "1d": None}
+
+# Multi-process cloud. With CLOUD_WORKERS set to a number of processes, the
+# main process only takes the gateways' connections, stores their readings and
+# runs the commands, and passes every reading over a Unix socket at
+# CLOUD_BUS_PATH to the worker processes. The workers share APPLICATION_PORT
+# and each serves its applications from its own subscriptions, rollups and
+# last known readings. History queries read the files the main process writes
+# and see a reading once it has been flushed (HISTORY_FLUSH_INTERVAL_MS).
+# Worker n serves its metrics on CLOUD_METRICS_PORT + 1 + n. 0 runs the whole
+# cloud in one process.
+CLOUD_WORKERS = 0
+CLOUD_BUS_PATH = "cloud_bus.sock"
+
+# Curtain commands from applications. Each device accepts COMMAND_BURST
+# commands at once and COMMAND_RATE per second after that; commands beyond
+# that wait, and only the newest waiting one per device is sent. A command
+# that the device's curtain status has not confirmed after COMMAND_TIMEOUT
+# seconds is reported as timed out.
+COMMAND_RATE = 1.0
+COMMAND_BURST = 2
+COMMAND_TIMEOUT = 30
+
+# Each application gets a bounded queue of outgoing subscription data. When an
+# application reads slower than data arrives the queue fills up and
+# SLOW_CONSUMER_POLICY decides what happens:
+#   "drop-oldest" - discard the oldest queued message.
+#   "coalesce"    - keep only the newest queued reading per (msg_type, device_id).
+#   "disconnect"  - close the connection to the application.
+# Replies to the application's requests, such as history pages, states and
+# command reports, wait in a queue of their own of SUBSCRIBER_REPLY_QUEUE_SIZE
+# replies, to which the policy applies as well ("coalesce" drops the oldest).
+SUBSCRIBER_QUEUE_SIZE = 1024
+SUBSCRIBER_REPLY_QUEUE_SIZE = 256
+SLOW_CONSUMER_POLICY = "drop-oldest"
+
+# Keepalive of the cloud's WebSocket connections. The cloud pings a gateway or
+# application it has heard nothing from for *_PING_INTERVAL seconds, and
+# closes the connection once it has heard nothing, not even a pong, for
+# *_IDLE_TIMEOUT seconds, so half-open connections do not pile up. 0 turns
+# either off. The timers are kept in a timer wheel that advances every
+# KEEPALIVE_TICK seconds, which is also how late a timeout may be noticed.
+GATEWAY_PING_INTERVAL = 20
+GATEWAY_IDLE_TIMEOUT = 60
+APPLICATION_PING_INTERVAL = 30
+APPLICATION_IDLE_TIMEOUT = 90
+KEEPALIVE_TICK = 1.0
+
+# Gateway -> cloud uplink. Readings are sent to the cloud in one message of up
+# to GATEWAY_BATCH_SIZE readings, at most GATEWAY_BATCH_INTERVAL_MS after the
+# first of them arrived. A batch size of 1 sends every reading on its own.
+GATEWAY_BATCH_SIZE = 64
+GATEWAY_BATCH_INTERVAL_MS = 50
+
+# Readings queued beyond GATEWAY_QUEUE_HIGH_WATER are either dropped ("drop")
+# or spilled to the spool and sent once the queue drains ("spill").
+GATEWAY_QUEUE_HIGH_WATER = 10000
+GATEWAY_OVERFLOW_POLICY = "spill"
+
+# While the cloud is unreachable the gateway stores readings in an on-disk spool
+# and replays them in batches of GATEWAY_REPLAY_BATCH_SIZE once it reconnects.
+GATEWAY_SPOOL_DIR = "gateway_spool"
+GATEWAY_SPOOL_SEGMENT_BYTES = 4 * 1024 * 1024
+GATEWAY_REPLAY_BATCH_SIZE = 1000
+
+# Where the gateway gets packets from edge devices. "mqtt" subscribes to the
+# broker at BROKER_HOST:BROKER_PORT. "direct" accepts them itself, without the
+# broker hop: on a built-in MQTT server at GATEWAY_MQTT_PORT (over TLS when
+# GATEWAY_MQTT_CERTFILE and GATEWAY_MQTT_KEYFILE are set, as the Arduino sketch
+# expects on port 8883) and as UDP datagrams of one packet each at
+# GATEWAY_UDP_PORT. Either port can be None. UDP only carries readings;
+# commands are published to devices connected over MQTT.
+GATEWAY_INGEST = "mqtt"
+GATEWAY_LISTEN_HOST = "0.0.0.0"
+GATEWAY_MQTT_PORT = 1883
+GATEWAY_MQTT_CERTFILE = None
+GATEWAY_MQTT_KEYFILE = None
+GATEWAY_UDP_PORT = 1884
+
+# Replay protection. Packets more than GATEWAY_REPLAY_WINDOW seconds older
+# than the newest one from the same device, repeats of any of the last
+# GATEWAY_REPLAY_IDS packets of a device, and packets whose timestamp is more
+# than GATEWAY_REPLAY_MAX_SKEW seconds from the gateway's clock are dropped.
+# At most GATEWAY_REPLAY_DEVICES devices are tracked. A window of None
+# disables the check.
+GATEWAY_REPLAY_WINDOW = 120
+GATEWAY_REPLAY_IDS = 256
+GATEWAY_REPLAY_DEVICES = 10000
+GATEWAY_REPLAY_MAX_SKEW = 300
+
+# Readings the gateway does not forward to the cloud because nothing changed.
+# GATEWAY_FILTERS maps msg_type to {} to forward only changed values (for the
+# booleans), or to {"absolute": a} or {"percent": p} to forward a number only
+# once it moved at least that far from the last one forwarded. For example
+#   {1: {"absolute": 0.5}, 2: {}, 3: {}, 4: {"absolute": 5}}
+# A reading is forwarded regardless when nothing was forwarded for its device
+# for GATEWAY_FILTER_HEARTBEAT seconds, and a held back one once its device
+# has sent nothing newer for GATEWAY_FILTER_SETTLE seconds, so the last value
+# always arrives. Each filter can set its own "heartbeat" and "settle". An
+# empty GATEWAY_FILTERS forwards everything.
+GATEWAY_FILTERS = {}
+GATEWAY_FILTER_HEARTBEAT = 300
+GATEWAY_FILTER_SETTLE = 2.0
+
+# Automations run by the gateway on every verified reading, so that they do not
+# wait for the cloud and an application. Each rule is a dictionary such as
+#   {"name": "close-when-door-opens",
+#    "when": {"msg_type": 3, "device_id": "ESP8266Client", "where": {"eq": True}},
+#    "then": {"control_curtain": 0, "device_id": "ESP8266Client"},
+#    "trigger": "enter", "cooldown": 10}
+# See common/rules.py for the fields. Rule hits are reported to the cloud; up
+# to GATEWAY_RULE_HITS_QUEUE of them are kept while it is unreachable.
+GATEWAY_RULES = []
+GATEWAY_RULE_HITS_QUEUE = 1000
+
+# Packet verification pipeline. With GATEWAY_PIPELINE set to "thread" or
+# "process", packets from devices are verified and decoded in batches of up to
+# GATEWAY_PIPELINE_BATCH_SIZE by a pool of GATEWAY_PIPELINE_WORKERS instead of
+# inline in the read path. At most GATEWAY_PIPELINE_QUEUE_SIZE packets wait
+# for verification; reading from devices pauses while the queue is full.
+# None verifies inline.
+GATEWAY_PIPELINE = None
+GATEWAY_PIPELINE_WORKERS = 4
+GATEWAY_PIPELINE_BATCH_SIZE = 64
+GATEWAY_PIPELINE_QUEUE_SIZE = 10000
+
+# Delay between attempts to reconnect to the cloud, doubling after each failure,
+# for the gateway and for the client applications. Every delay is shortened by
+# a random part of up to RECONNECT_JITTER of it, which spreads out the clients
+# reconnecting after a cloud restart.
+GATEWAY_RECONNECT_MIN = 1
+GATEWAY_RECONNECT_MAX = 60
+APPLICATION_RECONNECT_MIN = 1
+APPLICATION_RECONNECT_MAX = 30
+RECONNECT_JITTER = 0.5
+
+# Wire format of the WebSocket links. "cbor" prefers binary CBOR messages and
+# falls back to JSON for peers that do not support it; "json" always uses JSON.
+# WIRE_DEFLATE enables permessage-deflate compression when the peer supports it.
+WIRE_FORMAT = "cbor"
+WIRE_DEFLATE = True
+
+# Logging and metrics. LOG_LEVEL is a logging level name. Per-message logs are
+# written at DEBUG level, and warnings about single packets or readings at
+# WARNING level, for one in every LOG_SAMPLE_EVERY of them. The
+# gateway and the cloud serve their metrics in the Prometheus text format at
+# http://METRICS_HOST:<port>/metrics; a port of None disables the endpoint.
+LOG_LEVEL = "INFO"
+LOG_SAMPLE_EVERY = 100
+METRICS_HOST = "127.0.0.1"
+GATEWAY_METRICS_PORT = 9100
+CLOUD_METRICS_PORT = 9101
@@ -0,0 +1,54 @@
+class DeviceShadow:
+    """
+    The latest reading of every (msg_type, device_id). A reading only replaces
+    the stored one if it is at least as new, so late readings replayed from a
+    gateway spool do not roll the state back.
+    """
+
+    def __init__(self):
+        # (msg_type, device_id) -> reading
+        self.readings = dict()
+
+    def update(self, reading):
+        key = (reading["msg_type"], reading["device_id"])
+        current = self.readings.get(key)
+        if current is None or reading["timestamp"] >= current["timestamp"]:
+            self.readings[key] = reading
+
+    def rebuild(self, history, msg_types):
+        """Load the latest stored reading of every device. Returns the number of devices."""
+        self.readings = dict()
+        for msg_type in msg_types:
+            for device_id in history.devices(msg_type):
+                series = history.get_series(msg_type, device_id)
+                latest = series.latest() if series is not None else None
+                if latest is None:
+                    continue
+                _, timestamp, value = latest
+                self.update({
+                    "msg_type": msg_type,
+                    "device_id": device_id,
+                    "timestamp": timestamp,
+                    "value": value,
+                })
+        return len(self.readings)
+
+    def get(self, msg_types=None, device_ids=None, predicate=None):
+        """
+        Return the latest readings matching msg_types and device_ids (None
+        matches all) whose value satisfies predicate, ordered by msg_type and device.
+        """
+        if msg_types is not None and device_ids is not None:
+            keys = [(msg_type, device_id) for msg_type in msg_types for device_id in device_ids]
+            readings = [self.readings[key] for key in keys if key in self.readings]
+        else:
+            readings = [
+                reading for (msg_type, device_id), reading in self.readings.items()
+                if (msg_types is None or msg_type in msg_types)
+                and (device_ids is None or device_id in device_ids)
+            ]
+
+        if predicate is not None:
+            readings = [reading for reading in readings if predicate(reading["value"])]
+        readings.sort(key=lambda reading: (reading["msg_type"], reading["device_id"]))
+        return readings
@@ -0,0 +1,605 @@
+import bisect
+import heapq
+import os
+import struct
+import time
+from array import array
+from urllib.parse import quote, unquote
+
+# Every reading is stored as a fixed-width record: timestamp, value and a
+# tag describing how the value should be turned back into a Python object.
+RECORD = struct.Struct("<qdB")
+
+# Records are grouped into blocks. For every complete block the index file
+# holds the smallest and largest timestamp seen in it, which lets a query
+# skip straight to the blocks that overlap the requested range.
+INDEX_ENTRY = struct.Struct("<qq")
+BLOCK_RECORDS = 256
+
+# Segment files hold a fixed number of records so the position of a record
+# maps directly onto a segment file and an offset inside it.
+SEGMENT_RECORDS = BLOCK_RECORDS * 256
+
+KIND_INT = 0
+KIND_FLOAT = 1
+KIND_BOOL = 2
+
+def pack_value(value):
+    if isinstance(value, bool):
+        return float(value), KIND_BOOL
+    elif isinstance(value, int):
+        return float(value), KIND_INT
+    else:
+        return float(value), KIND_FLOAT
+
+def unpack_value(value, kind):
+    if kind == KIND_BOOL:
+        return value != 0.0
+    elif kind == KIND_INT:
+        return int(value)
+    else:
+        return value
+
+class RecentReadings:
+    """
+    Ring buffer holding the most recent readings of a series in memory, in
+    three parallel arrays (17 bytes per reading). It keeps at most capacity
+    readings, and drops readings more than max_age seconds older than the
+    newest one when max_age is set. The readings it holds are always a
+    contiguous range of positions ending at the newest reading.
+    """
+
+    def __init__(self, capacity, max_age=None):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.timestamps = array("q")
+        self.values = array("d")
+        self.kinds = array("B")
+        # Slot of the oldest reading and the number of readings held.
+        self.head = 0
+        self.size = 0
+        # Position after the newest reading.
+        self.end = 0
+        # True while no reading appended since the ring was last emptied has
+        # an older timestamp than the one before it, which lets scans find
+        # their range by bisection.
+        self.ordered = True
+
+    @property
+    def first_position(self):
+        return self.end - self.size
+
+    def _slot(self, index):
+        return (self.head + index) % self.capacity
+
+    def append(self, position, timestamp, value, kind):
+        if position != self.end:
+            self.head = self.size = 0
+            self.timestamps, self.values, self.kinds = array("q"), array("d"), array("B")
+            self.ordered = True
+        elif self.size and timestamp < self.timestamps[self._slot(self.size - 1)]:
+            self.ordered = False
+
+        slot = self._slot(self.size)
+        if slot == len(self.timestamps):
+            self.timestamps.append(timestamp)
+            self.values.append(value)
+            self.kinds.append(kind)
+        else:
+            self.timestamps[slot] = timestamp
+            self.values[slot] = value
+            self.kinds[slot] = kind
+
+        if self.size == self.capacity:
+            self.head = self._slot(1)
+        else:
+            self.size += 1
+        self.end = position + 1
+
+        if self.max_age is not None:
+            oldest = timestamp - self.max_age
+            while self.size > 1 and self.timestamps[self.head] < oldest:
+                self.head = self._slot(1)
+                self.size -= 1
+
+    def _ranges(self, index):
+        """(first slot, end slot, first index) of the slot ranges holding the readings from index on."""
+        first = self._slot(index)
+        end = first + self.size - index
+        if end <= self.capacity:
+            return [(first, end, index)]
+        return [(first, self.capacity, index), (0, end - self.capacity, index + self.capacity - first)]
+
+    def scan(self, since=None, until=None, start=0):
+        """
+        Like Series.scan, for the positions held in memory. The readings are
+        copied before the first one is yielded, so appends while the caller is
+        suspended cannot overwrite them.
+        """
+        base = self.first_position
+        if start - base >= self.size:
+            return
+
+        ranges = []
+        for begin, end, index in self._ranges(max(0, start - base)):
+            if self.ordered:
+                if since is not None:
+                    skip = bisect.bisect_left(self.timestamps, since, begin, end)
+                    index += skip - begin
+                    begin = skip
+                if until is not None:
+                    end = bisect.bisect_right(self.timestamps, until, begin, end)
+            ranges.append((base + index, self.timestamps[begin:end], self.values[begin:end], self.kinds[begin:end]))
+
+        for first, timestamps, values, kinds in ranges:
+            for position, (timestamp, value, kind) in enumerate(zip(timestamps, values, kinds), first):
+                if (since is None or timestamp >= since) and (until is None or timestamp <= until):
+                    yield position, timestamp, unpack_value(value, kind)
+
+class GroupCommit:
+    """
+    Batches the writes of every series in a store into group flushes.
+
+    Appended records stay in the files' buffers until flush_records of them
+    are pending or flush() is called, which the owner does every few
+    milliseconds. fsync_policy is "none", "interval" (fsync at most every
+    fsync_interval seconds, on a flush) or "every-batch". A series flushes the
+    group before reading its own unflushed records back from disk.
+    """
+
+    def __init__(self, flush_records=1, fsync_policy="none", fsync_interval=1.0):
+        if fsync_policy not in ("none", "interval", "every-batch"):
+            raise ValueError(f"unknown fsync policy {fsync_policy!r}")
+        self.flush_records = flush_records
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+
+        self.dirty = set()
+        self.pending = 0
+        self.last_fsync = time.monotonic()
+
+        self.records_written = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.fsyncs = 0
+        self.flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+
+    def written(self, series, size):
+        self.dirty.add(series)
+        self.pending += 1
+        self.records_written += 1
+        self.bytes_written += size
+        if self.pending >= self.flush_records:
+            self.flush()
+
+    def flush(self):
+        if not self.dirty:
+            return
+
+        start = time.monotonic()
+        fsync = self.fsync_policy == "every-batch" or (
+            self.fsync_policy == "interval" and start - self.last_fsync >= self.fsync_interval
+        )
+        for series in self.dirty:
+            series.flush(fsync)
+        self.dirty.clear()
+        self.pending = 0
+
+        elapsed = time.monotonic() - start
+        self.flushes += 1
+        self.flush_seconds += elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        if fsync:
+            self.fsyncs += 1
+            self.last_fsync = start
+
+    def stats(self):
+        """Counters for tuning: bytes written per record and records and latency per flush."""
+        return {
+            "records_written": self.records_written,
+            "bytes_written": self.bytes_written,
+            "flushes": self.flushes,
+            "fsyncs": self.fsyncs,
+            "bytes_per_record": self.bytes_written / self.records_written if self.records_written else 0,
+            "records_per_flush": self.records_written / self.flushes if self.flushes else 0,
+            "flush_ms_avg": self.flush_seconds * 1000 / self.flushes if self.flushes else 0,
+            "flush_ms_max": self.max_flush_seconds * 1000,
+        }
+
+class Series:
+    """
+    All readings of one msg_type from one device. With cache_records set the
+    newest readings are also kept in a RecentReadings ring, and scans read
+    only the older part of their range from disk.
+
+    A readonly series follows files that another process appends to: it never
+    writes, and refresh() takes in the records flushed since the last call.
+    """
+
+    def __init__(self, path, cache_records=0, cache_seconds=None, group=None, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+
+        # Without a group every record is flushed as soon as it is written.
+        self.group = group if group is not None else GroupCommit()
+
+        self.count = 0
+        # Per block (min timestamp, max timestamp). The last entry belongs to
+        # the partially filled tail block when count is not a multiple of
+        # BLOCK_RECORDS.
+        self.blocks = []
+        # Running maximum of the block maximums, used to binary search for the
+        # first block that can contain a timestamp.
+        self.block_prefix_max = []
+        # True while no block starts before the end of an earlier one. Queries
+        # can stop at the first block past the end of the range in that case.
+        # Loading only sees the index, so records out of order inside a block
+        # may leave it True; scans filter every record of a block they read.
+        self.ordered = True
+        self.last_timestamp = None
+
+        self.segment_file = None
+        self.segment_number = None
+        self.index_file = None
+
+        self.recent = RecentReadings(cache_records, cache_seconds) if cache_records else None
+
+        self._load()
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, f"{number:08d}.seg")
+
+    def _load(self):
+        segments = sorted(
+            int(name[:-4]) for name in os.listdir(self.path) if name.endswith(".seg")
+        )
+
+        if segments:
+            last = segments[-1]
+            size = os.path.getsize(self._segment_path(last))
+            records = size // RECORD.size
+            if records * RECORD.size != size and not self.readonly:
+                # A partially written record from a crash; drop it.
+                with open(self._segment_path(last), "r+b") as f:
+                    f.truncate(records * RECORD.size)
+            self.count = last * SEGMENT_RECORDS + records
+
+        index_path = os.path.join(self.path, "index.bin")
+        full_blocks = self.count // BLOCK_RECORDS
+
+        data = b""
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                data = f.read()
+        stored = min(len(data) // INDEX_ENTRY.size, full_blocks)
+        entries = list(INDEX_ENTRY.iter_unpack(data[:stored * INDEX_ENTRY.size]))
+
+        # Rebuild index entries that were lost because the process stopped
+        # between writing a block's last record and its index entry.
+        for block in range(len(entries), full_blocks):
+            timestamps = [timestamp for _, timestamp, _, _ in self._read_block(block)]
+            entries.append((min(timestamps), max(timestamps)))
+
+        if len(data) != len(entries) * INDEX_ENTRY.size and not self.readonly:
+            with open(index_path, "wb") as f:
+                f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+
+        for entry in entries:
+            self._add_block(entry)
+
+        if self.count % BLOCK_RECORDS:
+            timestamps = [timestamp for _, timestamp, _, _ in self._read_block(full_blocks)]
+            self._add_block((min(timestamps), max(timestamps)))
+
+        if self.count:
+            _, self.last_timestamp, _, _ = self._read_record(self.count - 1)
+
+        if self.recent is not None:
+            first = max(0, self.count - self.recent.capacity)
+            for block in range(first // BLOCK_RECORDS, len(self.blocks)):
+                for position, timestamp, value, kind in self._read_block(block):
+                    if position >= first:
+                        self.recent.append(position, timestamp, value, kind)
+
+    def _add_block(self, entry):
+        minimum, maximum = entry
+        if self.blocks and minimum < self.block_prefix_max[-1]:
+            self.ordered = False
+        previous = self.block_prefix_max[-1] if self.block_prefix_max else maximum
+        self.blocks.append(entry)
+        self.block_prefix_max.append(max(previous, maximum))
+
+    def _read_record(self, position):
+        segment, offset = divmod(position, SEGMENT_RECORDS)
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(offset * RECORD.size)
+            timestamp, value, kind = RECORD.unpack(f.read(RECORD.size))
+        return position, timestamp, value, kind
+
+    def _read_block(self, block):
+        """Read every record of a block in a single read call."""
+        if self in self.group.dirty:
+            self.group.flush()
+
+        first = block * BLOCK_RECORDS
+        last = min(first + BLOCK_RECORDS, self.count)
+        segment, offset = divmod(first, SEGMENT_RECORDS)
+        with open(self._segment_path(segment), "rb") as f:
+            f.seek(offset * RECORD.size)
+            data = f.read((last - first) * RECORD.size)
+
+        return [
+            (first + i, timestamp, value, kind)
+            for i, (timestamp, value, kind) in enumerate(RECORD.iter_unpack(data))
+        ]
+
+    def _track(self, position, timestamp, value, kind):
+        """Account for a record added at the end of the series."""
+        self.count = position + 1
+
+        if self.recent is not None:
+            self.recent.append(position, timestamp, value, kind)
+
+        if self.last_timestamp is not None and timestamp < self.last_timestamp:
+            self.ordered = False
+        self.last_timestamp = timestamp
+
+        if position % BLOCK_RECORDS == 0:
+            self._add_block((timestamp, timestamp))
+        else:
+            minimum, maximum = self.blocks[-1]
+            minimum, maximum = min(minimum, timestamp), max(maximum, timestamp)
+            self.blocks[-1] = (minimum, maximum)
+            previous = self.block_prefix_max[-2] if len(self.block_prefix_max) > 1 else maximum
+            self.block_prefix_max[-1] = max(previous, maximum)
+
+    def refresh(self):
+        """Take in the records another process has flushed since the last call. Readonly only."""
+        while True:
+            segment, offset = divmod(self.count, SEGMENT_RECORDS)
+            try:
+                with open(self._segment_path(segment), "rb") as f:
+                    f.seek(offset * RECORD.size)
+                    data = f.read((SEGMENT_RECORDS - offset) * RECORD.size)
+            except FileNotFoundError:
+                return
+
+            # A record being written can be cut short; it is read next time.
+            records = len(data) // RECORD.size
+            position = self.count
+            for timestamp, value, kind in RECORD.iter_unpack(data[:records * RECORD.size]):
+                self._track(position, timestamp, value, kind)
+                position += 1
+            if offset + records < SEGMENT_RECORDS:
+                return
+
+    def append(self, timestamp, value):
+        """Append a reading and return its position in the series."""
+        if self.readonly:
+            raise ValueError("cannot append to a readonly series")
+        position = self.count
+        segment = position // SEGMENT_RECORDS
+
+        if self.segment_number != segment:
+            if self.segment_file:
+                self.segment_file.flush()
+                if self.group.fsync_policy != "none":
+                    os.fsync(self.segment_file.fileno())
+                self.segment_file.close()
+            self.segment_file = open(self._segment_path(segment), "ab")
+            self.segment_number = segment
+
+        value, kind = pack_value(value)
+        self.segment_file.write(RECORD.pack(timestamp, value, kind))
+        size = RECORD.size
+        self._track(position, timestamp, value, kind)
+
+        if self.count % BLOCK_RECORDS == 0:
+            if self.index_file is None:
+                self.index_file = open(os.path.join(self.path, "index.bin"), "ab")
+            self.index_file.write(INDEX_ENTRY.pack(*self.blocks[-1]))
+            size += INDEX_ENTRY.size
+
+        self.group.written(self, size)
+        return position
+
+    def latest(self):
+        """The (position, timestamp, value) with the greatest timestamp, or None if empty."""
+        if not self.count:
+            return None
+        newest = self.block_prefix_max[-1]
+        # Usually the tail block.
+        block = len(self.blocks) - 1
+        while self.blocks[block][1] != newest:
+            block -= 1
+
+        latest = None
+        for position, timestamp, value, kind in self._read_block(block):
+            if timestamp == newest:
+                latest = position, timestamp, unpack_value(value, kind)
+        return latest
+
+    def flush(self, fsync=False):
+        for f in (self.segment_file, self.index_file):
+            if f is not None:
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+
+    def scan(self, since=None, until=None, start=0):
+        """
+        Yield (position, timestamp, value) for every reading with
+        since <= timestamp <= until, starting at position start.
+        Only blocks whose timestamp range overlaps the query are read, and
+        positions held in memory are not read from disk at all.
+        """
+        if self.recent is None:
+            yield from self._scan_blocks(since, until, start, self.count)
+            return
+
+        end = self.recent.first_position
+        if not (yield from self._scan_blocks(since, until, start, end)):
+            return
+        # The ring may have dropped readings while the caller was suspended;
+        # those are read from disk.
+        while self.recent.first_position > end:
+            cached = self.recent.first_position
+            if not (yield from self._scan_blocks(since, until, max(start, end), cached)):
+                return
+            end = cached
+        yield from self.recent.scan(since, until, max(start, end))
+
+    def _scan_blocks(self, since, until, start, end):
+        """
+        scan() for the positions from start up to end, from disk. Returns False
+        if it stopped at a block past until, so nothing later can match.
+        """
+        first_block = start // BLOCK_RECORDS
+        if since is not None:
+            first_block = max(first_block, bisect.bisect_left(self.block_prefix_max, since))
+
+        for block in range(first_block, len(self.blocks)):
+            if block * BLOCK_RECORDS >= end:
+                break
+            minimum, maximum = self.blocks[block]
+            if until is not None and minimum > until:
+                if self.ordered:
+                    return False
+                continue
+            if since is not None and maximum < since:
+                continue
+
+            for position, timestamp, value, kind in self._read_block(block):
+                if position < start:
+                    continue
+                if position >= end:
+                    break
+                if since is not None and timestamp < since:
+                    continue
+                if until is not None and timestamp > until:
+                    continue
+                yield position, timestamp, unpack_value(value, kind)
+        return True
+
+    def close(self):
+        self.group.dirty.discard(self)
+        if self.segment_file:
+            self.segment_file.close()
+            self.segment_file = None
+            self.segment_number = None
+        if self.index_file:
+            self.index_file.close()
+            self.index_file = None
+
+class HistoryStore:
+    """
+    Segment-based history of readings, one Series per (msg_type, device_id).
+    Layout on disk: <root>/<msg_type>/<quoted device_id>/{NNNNNNNN.seg,index.bin}
+
+    Every open series keeps up to cache_records of its newest readings, no more
+    than cache_seconds older than its newest one, in memory. 0 disables this.
+    group is the GroupCommit shared by every series; by default every record
+    is flushed on its own.
+
+    A readonly store reads the history another process writes. Reads see the
+    records that process has flushed by the time they start.
+    """
+
+    def __init__(self, root, cache_records=0, cache_seconds=None, group=None, readonly=False):
+        self.root = root
+        self.cache_records = cache_records
+        self.cache_seconds = cache_seconds
+        self.group = group if group is not None else GroupCommit()
+        self.readonly = readonly
+        self.series = dict()
+        os.makedirs(root, exist_ok=True)
+
+    def _series_path(self, msg_type, device_id):
+        return os.path.join(self.root, str(msg_type), quote(device_id, safe=""))
+
+    def get_series(self, msg_type, device_id, create=False):
+        key = (msg_type, device_id)
+        series = self.series.get(key)
+        if series is None:
+            path = self._series_path(msg_type, device_id)
+            if not create and not os.path.isdir(path):
+                return None
+            series = Series(path, self.cache_records, self.cache_seconds, self.group, self.readonly)
+            self.series[key] = series
+        elif self.readonly:
+            series.refresh()
+        return series
+
+    def devices(self, msg_type):
+        path = os.path.join(self.root, str(msg_type))
+        if not os.path.isdir(path):
+            return []
+        return sorted(unquote(name) for name in os.listdir(path))
+
+    def contains(self, msg_type, device_id, timestamp):
+        """Whether a reading of msg_type from device_id with exactly this timestamp is stored."""
+        series = self.get_series(msg_type, device_id)
+        if series is None:
+            return False
+        for _ in series.scan(timestamp, timestamp):
+            return True
+        return False
+
+    def append(self, msg_type, device_id, timestamp, value):
+        return self.get_series(msg_type, device_id, create=True).append(timestamp, value)
+
+    def scan(self, msg_type, device_id=None, since=None, until=None, start=None):
+        """
+        Yield (device_id, position, timestamp, value) for the readings of
+        msg_type in timestamp order, merging devices when device_id is None.
+        start optionally maps device_id to the first position to read, which
+        is how a paginated query resumes.
+        """
+        device_ids = self.devices(msg_type) if device_id is None else [device_id]
+        start = start or {}
+
+        heap = []
+        for order, device in enumerate(device_ids):
+            series = self.get_series(msg_type, device)
+            if series is None:
+                continue
+            rows = series.scan(since, until, start.get(device, 0))
+            for position, timestamp, value in rows:
+                heap.append((timestamp, order, position, value, device, rows))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            timestamp, order, position, value, device, rows = heap[0]
+            yield device, position, timestamp, value
+
+            for position, timestamp, value in rows:
+                heapq.heapreplace(heap, (timestamp, order, position, value, device, rows))
+                break
+            else:
+                heapq.heappop(heap)
+
+    def query(self, msg_type, device_id=None, since=None, until=None):
+        """
+        Yield readings of msg_type in timestamp order, as the same dictionaries
+        the gateway sends. If device_id is None the readings of every device
+        are merged.
+        """
+        for device, _, timestamp, value in self.scan(msg_type, device_id, since, until):
+            yield {
+                "msg_type": msg_type,
+                "device_id": device,
+                "timestamp": timestamp,
+                "value": value,
+            }
+
+    def flush(self):
+        self.group.flush()
+
+    def close(self):
+        self.group.flush()
+        for series in self.series.values():
+            series.close()
@@ -0,0 +1,173 @@
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from common import packet_codec
+from common import replay_window
+
+# The codec used by the workers of the pool. Each worker process builds its
+# own in _init_worker; threads share one.
+_codec = None
+
+def _init_worker(key):
+    global _codec
+    _codec = packet_codec.PacketCodec(key)
+
+def _verify_batch(payloads):
+    """
+    Verify and decode a batch of raw packets. Returns (readings, ids, errors)
+    where ids are the replay_window packet IDs of the readings, and errors are
+    (reason, message) with reason "hmac" or "decode".
+    """
+    readings = []
+    ids = []
+    errors = []
+    for payload in payloads:
+        try:
+            _codec.verify(payload)
+        except packet_codec.PacketError as e:
+            errors.append(("hmac", str(e)))
+            continue
+        try:
+            msg_type, device_id, timestamp, value = _codec.decode(payload)
+        except packet_codec.PacketError as e:
+            errors.append(("decode", str(e)))
+            continue
+        readings.append({
+            "msg_type": msg_type,
+            "device_id": device_id,
+            "timestamp": timestamp,
+            "value": value,
+        })
+        ids.append(replay_window.packet_id(payload))
+    return readings, ids, errors
+
+class VerifyPipeline:
+    """
+    Verifies and decodes MQTT packets off the gateway's main thread.
+
+    submit() puts raw payloads on a bounded queue and returns immediately
+    unless the queue is full, which pushes back on the MQTT connection. A
+    dispatcher thread takes them off in batches of up to batch_size and hands
+    each batch to a pool of worker threads or processes. Finished readings are
+    collected until the main loop calls drain(); the pipeline can be passed to
+    select() and becomes readable when there are results waiting.
+
+    Process workers verify in parallel. Thread workers mostly move the work out
+    of the read path, since hashing packets this small holds the GIL.
+    """
+
+    def __init__(self, key, mode="thread", workers=4, batch_size=64, queue_size=10000):
+        if mode == "process":
+            self.executor = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(key,))
+        elif mode == "thread":
+            _init_worker(key)
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix="verify")
+        else:
+            raise ValueError(f"unknown pipeline mode {mode!r}")
+
+        self.batch_size = batch_size
+        self.pending = queue.Queue(queue_size)
+        # At most two batches per worker are handed to the pool at once, so
+        # packets wait in the bounded queue rather than inside the executor.
+        self.slots = threading.Semaphore(workers * 2)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+
+        self.results = deque()
+        self.verified = 0
+        self.rejected = 0
+
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_read, False)
+        os.set_blocking(self.wakeup_write, False)
+
+        self.closed = False
+        self.dispatcher = threading.Thread(target=self._dispatch, name="verify-dispatch", daemon=True)
+        self.dispatcher.start()
+
+    def fileno(self):
+        return self.wakeup_read
+
+    def submit(self, payload):
+        self.pending.put(payload)
+
+    def _dispatch(self):
+        while True:
+            payload = self.pending.get()
+            if payload is None:
+                return
+
+            batch = [payload]
+            while len(batch) < self.batch_size:
+                try:
+                    payload = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if payload is None:
+                    self.pending.put(None)
+                    break
+                batch.append(payload)
+
+            self.slots.acquire()
+            with self.lock:
+                self.in_flight += 1
+            future = self.executor.submit(_verify_batch, batch)
+            future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+        try:
+            result = future.result()
+        except Exception as e:
+            result = ([], [], [("decode", f"Verification worker failed: {e}")])
+        self.results.append(result)
+
+        try:
+            os.write(self.wakeup_write, b"\0")
+        except BlockingIOError:
+            # The pipe is full, so the main loop has a wakeup pending anyway.
+            pass
+
+    def drain(self):
+        """Return (readings, ids, errors) for every batch finished since the last call."""
+        try:
+            while os.read(self.wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        readings = []
+        ids = []
+        errors = []
+        while self.results:
+            batch_readings, batch_ids, batch_errors = self.results.popleft()
+            readings.extend(batch_readings)
+            ids.extend(batch_ids)
+            errors.extend(batch_errors)
+
+        self.verified += len(readings)
+        self.rejected += len(errors)
+        return readings, ids, errors
+
+    def stats(self):
+        return {
+            "queue_depth": self.pending.qsize(),
+            "batches_in_flight": self.in_flight,
+            "verified": self.verified,
+            "rejected": self.rejected,
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
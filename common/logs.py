@@ -0,0 +1,30 @@
+import logging
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+def setup(level):
+    """Configure logging for a program. level is a name such as "INFO" or "DEBUG"."""
+    logging.basicConfig(level=level, format=FORMAT)
+
+class Sampler:
+    """
+    Lets one in every `every` calls through. Per-message debug logging is
+    written as
+
+        if log.isEnabledFor(logging.DEBUG) and sample():
+            log.debug(...)
+
+    so that it costs a single level check when debug logging is disabled, and
+    formats only a sample of the messages when it is enabled.
+    """
+
+    def __init__(self, every):
+        self.every = max(1, every)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls >= self.every:
+            self.calls = 0
+            return True
+        return False
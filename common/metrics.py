@@ -0,0 +1,185 @@
+import asyncio
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram buckets for durations in seconds, from 100us to 10s.
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=None, function=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        # Called on every scrape instead of using the stored value. It returns
+        # a number, or a list of (labels, number) for a metric with one sample
+        # per label set (e.g. one per subscriber).
+        self.function = function
+        self.value = 0
+
+    def samples(self):
+        """Yield (name suffix, labels, value)."""
+        value = self.value if self.function is None else self.function()
+        if isinstance(value, (int, float)):
+            yield "", self.labels, value
+            return
+        for labels, sample in value:
+            yield "", {**self.labels, **labels}, sample
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.value += amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # One count per bucket plus one for values above the largest bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            yield "_bucket", {**self.labels, "le": _format_value(bound)}, cumulative
+        yield "_sum", self.labels, self.sum
+        yield "_count", self.labels, self.count
+
+class Registry:
+    """
+    Metrics of one process, rendered in the Prometheus text format. A metric
+    registered again under the same name and labels replaces the old one.
+    """
+
+    def __init__(self):
+        self.metrics = dict()
+
+    def register(self, metric):
+        self.metrics[(metric.name, tuple(sorted(metric.labels.items())))] = metric
+        return metric
+
+    def render(self):
+        families = dict()
+        for metric in list(self.metrics.values()):
+            families.setdefault(metric.name, []).append(metric)
+
+        lines = []
+        for name, metrics in families.items():
+            lines.append(f"# HELP {name} {metrics[0].help}")
+            lines.append(f"# TYPE {name} {metrics[0].kind}")
+            for metric in metrics:
+                for suffix, labels, value in metric.samples():
+                    lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=None, function=None):
+    return REGISTRY.register(Counter(name, help, labels, function))
+
+def gauge(name, help, labels=None, function=None):
+    return REGISTRY.register(Gauge(name, help, labels, function))
+
+def histogram(name, help, labels=None, buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def start_http_server(host, port, registry=REGISTRY):
+    """
+    Serve GET /metrics from a background thread. Suited to programs without an
+    event loop; metric functions are then called from that thread.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+async def start_asyncio_server(host, port, registry=REGISTRY):
+    """
+    Serve GET /metrics on the running event loop, so metric functions run on
+    the same thread as the code that changes what they read.
+    """
+
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/metrics":
+                body = registry.render().encode()
+                status = b"200 OK"
+            else:
+                body = b"not found\n"
+                status = b"404 Not Found"
+
+            writer.write(
+                b"HTTP/1.1 " + status + b"\r\n"
+                + f"Content-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
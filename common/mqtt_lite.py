@@ -0,0 +1,340 @@
+"""
+Minimal MQTT 3.1.1 server. It supports CONNECT, SUBSCRIBE (with + and #
+wildcards), PUBLISH at QoS 0, 1 and 2 (messages are always delivered to
+subscribers at QoS 0), PINGREQ and DISCONNECT, optionally over TLS. There is no
+authentication, retained messages, wills or persistence.
+
+It is embedded in the gateway to take packets straight from edge devices, and
+run on its own by testing/mini_broker.py as a stand-in for Mosquitto.
+"""
+import selectors
+import socket
+import ssl
+import struct
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+def encode_string(value):
+    if isinstance(value, str):
+        value = value.encode()
+    return struct.pack("!H", len(value)) + value
+
+def encode_packet(packet_type, flags, body):
+    return bytes(((packet_type << 4) | flags,)) + encode_length(len(body)) + body
+
+def encode_connect(client_id, keepalive=0):
+    body = encode_string("MQTT") + bytes((4, 0x02)) + struct.pack("!H", keepalive) + encode_string(client_id)
+    return encode_packet(CONNECT, 0, body)
+
+def encode_publish(topic, payload, qos=0, packet_id=0):
+    body = encode_string(topic)
+    if qos:
+        body += struct.pack("!H", packet_id)
+    return encode_packet(PUBLISH, qos << 1, body + payload)
+
+def encode_subscribe(packet_id, topics):
+    body = struct.pack("!H", packet_id) + b"".join(encode_string(topic) + b"\x00" for topic in topics)
+    return encode_packet(SUBSCRIBE, 0x02, body)
+
+def parse_packets(buffer):
+    """
+    Split complete packets off the front of buffer. Returns a list of
+    (type, flags, body) and the number of bytes they used.
+    """
+    packets = []
+    offset = 0
+    while True:
+        if len(buffer) - offset < 2:
+            break
+
+        length = 0
+        multiplier = 1
+        position = offset + 1
+        while True:
+            if position >= len(buffer):
+                return packets, offset
+            byte = buffer[position]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            position += 1
+            if not byte & 0x80:
+                break
+
+        if len(buffer) - position < length:
+            break
+        header = buffer[offset]
+        packets.append((header >> 4, header & 0x0f, bytes(buffer[position:position + length])))
+        offset = position + length
+    return packets, offset
+
+def read_string(body, position):
+    """
+    Read a length-prefixed UTF-8 string at position. Returns it and the
+    position after it. Raises ValueError if it runs past the end of body.
+    """
+    if position + 2 > len(body):
+        raise ValueError("string length past the end of the packet")
+    (length,) = struct.unpack_from("!H", body, position)
+    end = position + 2 + length
+    if end > len(body):
+        raise ValueError("string past the end of the packet")
+    return body[position + 2:end].decode(), end
+
+def read_packet_id(body, position):
+    if position + 2 > len(body):
+        raise ValueError("packet identifier past the end of the packet")
+    return body[position:position + 2], position + 2
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for index, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != "+" and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+# Connections whose next packet would be larger than this are closed.
+MAX_PACKET_SIZE = 256 * 1024
+
+class Connection:
+    def __init__(self, sock, handshaking=False):
+        self.sock = sock
+        self.inbound = bytearray()
+        self.outbound = bytearray()
+        self.filters = set()
+        # Whether the TLS handshake is still in progress.
+        self.handshaking = handshaking
+
+class Broker:
+    """
+    on_publish, if given, is called with (topic, payload) for every message a
+    client publishes, before it is delivered to the subscribers. ssl_context
+    makes clients connect over TLS.
+
+    serve_forever() runs the broker on its own. To drive it from another event
+    loop instead, pass the broker to select() (it is readable when any of its
+    sockets is) and call poll() when it is.
+    """
+
+    def __init__(self, host="127.0.0.1", port=1883, ssl_context=None, on_publish=None):
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.create_server((host, port), backlog=1024)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.ssl_context = ssl_context
+        self.on_publish = on_publish
+        self.connections = dict()
+        self.published = 0
+        self.delivered = 0
+
+    def fileno(self):
+        return self.selector.fileno()
+
+    def serve_forever(self):
+        while True:
+            self.poll(None)
+
+    def poll(self, timeout=0):
+        """Handle the sockets that are ready, waiting up to timeout seconds (None waits forever)."""
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self.listener:
+                self._accept()
+                continue
+
+            connection = self.connections.get(key.fileobj)
+            if connection is None:
+                continue
+            if events & selectors.EVENT_READ:
+                self._read(connection)
+            if events & selectors.EVENT_WRITE and key.fileobj in self.connections:
+                self._write(connection)
+
+    def close(self):
+        for connection in list(self.connections.values()):
+            self._close(connection)
+        self.selector.unregister(self.listener)
+        self.listener.close()
+        self.selector.close()
+
+    def _accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        self.connections[sock] = Connection(sock, self.ssl_context is not None)
+        self.selector.register(sock, selectors.EVENT_READ)
+
+    def _close(self, connection):
+        self.selector.unregister(connection.sock)
+        del self.connections[connection.sock]
+        connection.sock.close()
+
+    def _handshake(self, connection):
+        """Continue the TLS handshake. Returns whether it has finished."""
+        try:
+            connection.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            return False
+        except ssl.SSLWantWriteError:
+            self.selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            return False
+        except OSError:
+            self._close(connection)
+            return False
+
+        connection.handshaking = False
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connection.outbound else 0)
+        self.selector.modify(connection.sock, events)
+        return True
+
+    def _send(self, connection, data):
+        if not connection.outbound and not connection.handshaking:
+            self.selector.modify(connection.sock, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        connection.outbound += data
+
+    def _write(self, connection):
+        if connection.handshaking:
+            if not self._handshake(connection):
+                return
+            if not connection.outbound:
+                return
+        try:
+            sent = connection.sock.send(connection.outbound)
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except OSError:
+            self._close(connection)
+            return
+        del connection.outbound[:sent]
+        if not connection.outbound:
+            self.selector.modify(connection.sock, selectors.EVENT_READ)
+
+    def _read(self, connection):
+        if connection.handshaking and not self._handshake(connection):
+            return
+
+        sock = connection.sock
+        try:
+            data = sock.recv(65536)
+            # TLS can hold decrypted data that no longer shows up as readable.
+            while data and isinstance(sock, ssl.SSLSocket) and sock.pending():
+                data += sock.recv(65536)
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._close(connection)
+            return
+
+        connection.inbound += data
+        packets, used = parse_packets(connection.inbound)
+        del connection.inbound[:used]
+        for packet_type, flags, body in packets:
+            try:
+                handled = self._handle(connection, packet_type, flags, body)
+            except (struct.error, UnicodeDecodeError, IndexError, ValueError):
+                # A malformed packet only costs its sender the connection.
+                handled = False
+            if not handled:
+                self._close(connection)
+                return
+        if len(connection.inbound) > MAX_PACKET_SIZE:
+            self._close(connection)
+
+    def _handle(self, connection, packet_type, flags, body):
+        if packet_type == CONNECT:
+            self._send(connection, encode_packet(CONNACK, 0, b"\x00\x00"))
+        elif packet_type == PUBLISH:
+            self._publish(connection, flags, body)
+        elif packet_type == PUBREL:
+            packet_id, _ = read_packet_id(body, 0)
+            self._send(connection, encode_packet(PUBCOMP, 0, packet_id))
+        elif packet_type == SUBSCRIBE:
+            packet_id, position = read_packet_id(body, 0)
+            topic_filters = []
+            while position < len(body):
+                topic_filter, position = read_string(body, position)
+                if position >= len(body):
+                    raise ValueError("subscription without a QoS")
+                # Skip the requested QoS.
+                position += 1
+                topic_filters.append(topic_filter)
+            connection.filters.update(topic_filters)
+            self._send(connection, encode_packet(SUBACK, 0, packet_id + bytes(len(topic_filters))))
+        elif packet_type == UNSUBSCRIBE:
+            packet_id, position = read_packet_id(body, 0)
+            topic_filters = []
+            while position < len(body):
+                topic_filter, position = read_string(body, position)
+                topic_filters.append(topic_filter)
+            connection.filters.difference_update(topic_filters)
+            self._send(connection, encode_packet(UNSUBACK, 0, packet_id))
+        elif packet_type == PINGREQ:
+            self._send(connection, encode_packet(PINGRESP, 0, b""))
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    def _publish(self, connection, flags, body):
+        qos = (flags >> 1) & 0x03
+        if qos == 3:
+            raise ValueError("invalid QoS")
+        topic, position = read_string(body, 0)
+        if qos:
+            packet_id, position = read_packet_id(body, position)
+            if qos == 1:
+                self._send(connection, encode_packet(PUBACK, 0, packet_id))
+            else:
+                self._send(connection, encode_packet(PUBREC, 0, packet_id))
+
+        payload = body[position:]
+        if self.on_publish is not None:
+            self.on_publish(topic, payload)
+        self.publish(topic, payload)
+
+    def publish(self, topic, payload):
+        """Deliver a message to every subscribed client. Returns how many there were."""
+        self.published += 1
+        message = None
+        delivered = 0
+        for subscriber in list(self.connections.values()):
+            if any(topic_matches(topic_filter, topic) for topic_filter in subscriber.filters):
+                if message is None:
+                    message = encode_publish(topic, payload)
+                self._send(subscriber, message)
+                delivered += 1
+        self.delivered += delivered
+        return delivered
@@ -0,0 +1,151 @@
+import hashlib
+import hmac
+import struct
+
+import cbor2
+
+HMAC_SIZE = 32
+
+# Every packet is the CBOR array [type, device_id, timestamp, value, hmac]
+# where hmac is a 32 byte string. The HMAC covers everything before the
+# hmac's bytes, including the byte string header 0x58 0x20.
+ARRAY_HEADER = b"\x85"
+HMAC_HEADER = b"\x58\x20"
+
+FLOAT64 = struct.Struct(">d")
+
+# SHA-256 block size, the length the HMAC key is padded to.
+BLOCK_SIZE = 64
+
+# cbor2's C extension decodes a whole packet faster than Python code can pick
+# the fields out of it, so the direct decoder is only used with the pure
+# Python cbor2 implementation.
+DIRECT_DECODE = getattr(cbor2.loads, "__module__", "") == "cbor2._decoder"
+
+class PacketError(ValueError):
+    pass
+
+def _encode_head(major, value):
+    major <<= 5
+    if value < 24:
+        return bytes((major | value,))
+    elif value < 1 << 8:
+        return bytes((major | 24, value))
+    elif value < 1 << 16:
+        return bytes((major | 25,)) + value.to_bytes(2, "big")
+    elif value < 1 << 32:
+        return bytes((major | 26,)) + value.to_bytes(4, "big")
+    else:
+        return bytes((major | 27,)) + value.to_bytes(8, "big")
+
+def _encode_value(value):
+    if value is True:
+        return b"\xf5"
+    elif value is False:
+        return b"\xf4"
+    elif isinstance(value, int):
+        if value >= 0:
+            return _encode_head(0, value)
+        return _encode_head(1, -1 - value)
+    elif isinstance(value, float):
+        return b"\xfb" + FLOAT64.pack(value)
+    raise PacketError(f"cannot encode value {value!r}")
+
+class PacketCodec:
+    """
+    Signs, verifies, encodes and decodes edge device packets.
+
+    The HMAC inner and outer hash states are computed once from the key and
+    cloned for every message instead of rehashing the key pads each time.
+    """
+
+    def __init__(self, key):
+        if len(key) > BLOCK_SIZE:
+            key = hashlib.sha256(key).digest()
+        key = key.ljust(BLOCK_SIZE, b"\0")
+        self._inner = hashlib.sha256(bytes(b ^ 0x36 for b in key))
+        self._outer = hashlib.sha256(bytes(b ^ 0x5c for b in key))
+
+    def sign(self, data):
+        inner = self._inner.copy()
+        inner.update(data)
+        outer = self._outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+    def verify(self, packet):
+        """Raise PacketError unless the packet carries a valid HMAC."""
+        if len(packet) < HMAC_SIZE:
+            raise PacketError("Packet too short to contain HMAC.")
+        if not hmac.compare_digest(self.sign(packet[:-HMAC_SIZE]), packet[-HMAC_SIZE:]):
+            raise PacketError("HMAC verification failed")
+
+    def decode(self, packet):
+        """Return (type, device_id, timestamp, value) of an already verified packet."""
+        if DIRECT_DECODE:
+            try:
+                return self._decode_direct(packet)
+            except (PacketError, IndexError, struct.error, UnicodeDecodeError):
+                pass
+
+        try:
+            decoded = cbor2.loads(packet)
+        except Exception as e:
+            raise PacketError(f"Error decoding CBOR: {e}")
+
+        if not isinstance(decoded, list) or len(decoded) != 5:
+            raise PacketError(f"Unexpected CBOR structure: {decoded}")
+        return tuple(decoded[:4])
+
+    @staticmethod
+    def _decode_direct(packet):
+        """
+        Decode the layout the firmware produces: a small type, a short device id,
+        a 32-bit timestamp and a double, boolean or small integer value.
+        Raises PacketError for anything else.
+        """
+        if packet[0] != 0x85 or packet[-HMAC_SIZE - 2:-HMAC_SIZE] != HMAC_HEADER:
+            raise PacketError("unexpected packet layout")
+
+        msg_type = packet[1]
+        length = packet[2] - 0x60
+        if msg_type >= 24 or not 0 <= length < 24:
+            raise PacketError("unexpected packet layout")
+
+        pos = 3 + length
+        device_id = packet[3:pos].decode("utf-8")
+        if packet[pos] != 0x1a:
+            raise PacketError("unexpected timestamp encoding")
+        timestamp = int.from_bytes(packet[pos + 1:pos + 5], "big")
+
+        value = packet[pos + 5:-HMAC_SIZE - 2]
+        first = value[0]
+        if len(value) == 9 and first == 0xfb:
+            value = FLOAT64.unpack_from(value, 1)[0]
+        elif len(value) == 1 and first < 24:
+            value = first
+        elif len(value) == 1 and first in (0xf4, 0xf5):
+            value = first == 0xf5
+        elif len(value) == 2 and first == 0x18:
+            value = value[1]
+        else:
+            raise PacketError("unexpected value encoding")
+        return msg_type, device_id, timestamp, value
+
+    def verify_and_decode(self, packet):
+        self.verify(packet)
+        return self.decode(packet)
+
+    def encode(self, msg_type, device_id, timestamp, value):
+        """Encode and sign a packet in a single pass."""
+        device_id = device_id.encode("utf-8")
+        signed = b"".join((
+            ARRAY_HEADER,
+            _encode_head(0, msg_type),
+            _encode_head(3, len(device_id)),
+            device_id,
+            _encode_head(0, timestamp),
+            _encode_value(value),
+            HMAC_HEADER,
+        ))
+        return signed + self.sign(signed)
@@ -0,0 +1,39 @@
+import operator
+
+# Comparison operators that can be used in a value predicate, e.g.
+# {"gt": 30} or {"ge": 10, "lt": 20}. Every given comparison must hold.
+OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "ge": operator.ge,
+    "lt": operator.lt,
+    "le": operator.le,
+}
+
+def compile_predicate(spec):
+    """
+    Turn a predicate specification into a function of a value.
+    Returns None when spec is None, meaning that every value matches.
+    Raises ValueError for an unknown operator.
+    """
+    if spec is None:
+        return None
+
+    if not isinstance(spec, dict):
+        # A bare value is shorthand for equality.
+        spec = {"eq": spec}
+
+    comparisons = []
+    for name, operand in spec.items():
+        if name not in OPERATORS:
+            raise ValueError(f"unknown operator {name!r}")
+        comparisons.append((OPERATORS[name], operand))
+
+    def predicate(value):
+        try:
+            return all(compare(value, operand) for compare, operand in comparisons)
+        except TypeError:
+            return False
+
+    return predicate
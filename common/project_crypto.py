@@ -1,14 +1,17 @@
+import asyncio
+import random
 import socket
 import ssl
+import time
 
-def construct_ssl_socket(is_client, local_name, remote_name, ip, port):
+def construct_ssl_context(is_client, local_name, remote_name):
     if is_client:
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
     else:
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     # Load the local certificates and keys.
     context.load_cert_chain(
-        certfile=f"crypto/{local_name}-cert.pem", 
+        certfile=f"crypto/{local_name}-cert.pem",
         keyfile=f"crypto/{local_name}-key.pem"
     )
     # Load certificates used for verification.
@@ -16,11 +19,220 @@ def construct_ssl_socket(is_client, local_name, remote_name, ip, port):
     # Enable mTLS
     context.verify_mode = ssl.CERT_REQUIRED
     context.check_hostname = False
+    return context
+
+# (is_client, local_name, remote_name) -> SSLContext
+_contexts = dict()
+
+def get_ssl_context(is_client, local_name, remote_name):
+    """
+    Like construct_ssl_context, but the context is built once per process.
+    Besides not reading the certificates again, a TLS session can only be
+    resumed with the context that created it.
+    """
+    key = (is_client, local_name, remote_name)
+    context = _contexts.get(key)
+    if context is None:
+        context = construct_ssl_context(is_client, local_name, remote_name)
+        _contexts[key] = context
+    return context
+
+def construct_ssl_socket(is_client, local_name, remote_name, ip, port, session=None, timeout=None):
+    """
+    session resumes a TLS session of an earlier connection to the same
+    server. timeout limits connecting and the handshake; the socket returned
+    is blocking.
+    """
+    context = get_ssl_context(is_client, local_name, remote_name)
 
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     if is_client:
-        s.connect((ip, port))
-        return context.wrap_socket(s)
+        s.settimeout(timeout)
+        try:
+            s.connect((ip, port))
+            s = context.wrap_socket(s, session=session)
+        except OSError:
+            s.close()
+            raise
+        s.settimeout(None)
+        return s
     else:
         s.bind((ip, port))
         return context.wrap_socket(s, server_side = True)
+
+class TLSStream:
+    """
+    A client TLS connection over asyncio streams. TLS is done with an
+    ssl.MemoryBIO rather than asyncio's own support, which cannot resume a
+    session. Has the session and session_reused of an SSLSocket.
+    """
+
+    def __init__(self, reader, writer, context, session=None):
+        self.reader = reader
+        self.writer = writer
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.ssl = context.wrap_bio(self.incoming, self.outgoing, session=session)
+
+    @property
+    def session(self):
+        return self.ssl.session
+
+    @property
+    def session_reused(self):
+        return self.ssl.session_reused
+
+    def _flush(self):
+        data = self.outgoing.read()
+        if data:
+            self.writer.write(data)
+
+    async def _receive(self):
+        self._flush()
+        data = await self.reader.read(65536)
+        if not data:
+            self.incoming.write_eof()
+        else:
+            self.incoming.write(data)
+
+    async def handshake(self):
+        while True:
+            try:
+                self.ssl.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                await self._receive()
+        self._flush()
+        await self.writer.drain()
+
+    async def read(self, size=65536):
+        """Read decrypted data. Returns b"" once the server has closed the connection."""
+        while True:
+            try:
+                return self.ssl.read(size)
+            except ssl.SSLWantReadError:
+                await self._receive()
+            except (ssl.SSLZeroReturnError, ssl.SSLEOFError):
+                return b""
+
+    def write(self, data):
+        self.ssl.write(data)
+        self._flush()
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+async def open_tls_stream(local_name, remote_name, ip, port, session=None):
+    """Connect to a server over mTLS with asyncio and return a TLSStream after the handshake."""
+    context = get_ssl_context(True, local_name, remote_name)
+    reader, writer = await asyncio.open_connection(ip, port)
+    stream = TLSStream(reader, writer, context, session)
+    try:
+        await stream.handshake()
+    except BaseException:
+        writer.close()
+        raise
+    return stream
+
+class Connector:
+    """
+    Client connections to one server over mTLS, with reconnects.
+
+    connect() resumes the TLS session of the previous connection when the
+    server still accepts it, which skips the certificate exchange; open() does
+    the same for asyncio and returns a TLSStream. After a
+    failed attempt or when the connection is lost (lost()), the next attempt
+    is due after a delay that doubles from min_delay up to max_delay, less a
+    random part of up to `jitter` of it, so clients that lost the same server
+    do not all come back at once. established() resets the delay once the
+    connection is known to work. wait() is the time until the next attempt.
+
+    attempts, failures, resumed and the handshake times are kept for metrics.
+    """
+
+    def __init__(self, local_name, remote_name, host, port, min_delay=1, max_delay=60, jitter=0.5, timeout=10):
+        self.local_name = local_name
+        self.remote_name = remote_name
+        self.host = host
+        self.port = port
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.timeout = timeout
+
+        self.delay = min_delay
+        self.next_attempt = time.monotonic()
+        self.session = None
+
+        self.attempts = 0
+        self.failures = 0
+        self.connections = 0
+        self.resumed = 0
+        self.handshake_seconds = 0.0
+        self.last_handshake_seconds = None
+
+    def wait(self):
+        return max(0.0, self.next_attempt - time.monotonic())
+
+    def connect(self):
+        """Connect and finish the TLS handshake. Raises OSError after scheduling the next attempt."""
+        self.attempts += 1
+        start = time.perf_counter()
+        try:
+            sock = construct_ssl_socket(
+                True, self.local_name, self.remote_name, self.host, self.port, self.session, self.timeout,
+            )
+        except OSError:
+            self.failures += 1
+            self._schedule()
+            raise
+        self._connected(sock, time.perf_counter() - start)
+        return sock
+
+    async def open(self):
+        """connect() for asyncio. Returns a TLSStream."""
+        self.attempts += 1
+        start = time.perf_counter()
+        try:
+            stream = await asyncio.wait_for(
+                open_tls_stream(self.local_name, self.remote_name, self.host, self.port, self.session),
+                self.timeout,
+            )
+        except OSError:
+            self.failures += 1
+            self._schedule()
+            raise
+        self._connected(stream, time.perf_counter() - start)
+        return stream
+
+    def _connected(self, sock, elapsed):
+        self.connections += 1
+        self.handshake_seconds += elapsed
+        self.last_handshake_seconds = elapsed
+        if sock.session_reused:
+            self.resumed += 1
+
+    def established(self):
+        self.delay = self.min_delay
+
+    def lost(self, sock):
+        """Close a connection that failed, keeping its session, and schedule the next attempt."""
+        try:
+            # TLS 1.3 servers send the session ticket after the handshake, so
+            # the session is only known once the connection has been used.
+            if sock.session is not None:
+                self.session = sock.session
+        except (OSError, ValueError):
+            pass
+        sock.close()
+        self.failures += 1
+        return self._schedule()
+
+    def _schedule(self):
+        delay = self.delay * (1 - self.jitter * random.random())
+        self.next_attempt = time.monotonic() + delay
+        self.delay = min(self.delay * 2, self.max_delay)
+        return delay
@@ -0,0 +1,93 @@
+import time
+from collections import OrderedDict
+
+# Packets are told apart by the last bytes of their HMAC, which an attacker
+# without the key cannot choose.
+ID_SIZE = 8
+
+STALE = "stale"
+DUPLICATE = "duplicate"
+SKEW = "skew"
+
+def packet_id(packet):
+    return bytes(packet[-ID_SIZE:])
+
+class _Device:
+    __slots__ = ("newest", "floor", "ids")
+
+    def __init__(self):
+        # Newest timestamp accepted from the device.
+        self.newest = None
+        # Packets at or before this timestamp can no longer be checked for
+        # duplicates, because the IDs of some of them were forgotten.
+        self.floor = None
+        # packet ID -> timestamp of the most recently accepted packets.
+        self.ids = OrderedDict()
+
+class ReplayWindow:
+    """
+    Rejects replayed and duplicated packets from each device in constant time
+    and bounded memory.
+
+    Every device has a high-water mark, the newest timestamp accepted from it.
+    Packets more than `window` seconds behind it are stale. Packets within the
+    window are checked against the IDs of the last `capacity` packets accepted
+    from the device. When an ID has to be forgotten to make room, packets no
+    newer than it are treated as stale from then on, so a busy device narrows
+    its window rather than letting duplicates through.
+
+    Timestamps more than `max_skew` seconds away from the local clock are
+    rejected, so a device that is not tracked yet (or was forgotten, since at
+    most `max_devices` are kept) cannot have old packets replayed to it, and
+    one packet from the future cannot move the mark past every real one.
+    None disables the clock check.
+    """
+
+    def __init__(self, window=120, capacity=256, max_devices=10000, max_skew=300, clock=time.time):
+        self.window = window
+        self.capacity = capacity
+        self.max_devices = max_devices
+        self.max_skew = max_skew
+        self.clock = clock
+        # device_id -> _Device, least recently heard from first.
+        self.devices = OrderedDict()
+        self.dropped = {STALE: 0, DUPLICATE: 0, SKEW: 0}
+
+    def check(self, device_id, timestamp, packet_id):
+        """
+        Record a verified packet. Returns None if it is accepted, otherwise
+        why it was rejected: STALE, DUPLICATE or SKEW.
+        """
+        reason = self._check(device_id, timestamp, packet_id)
+        if reason is not None:
+            self.dropped[reason] += 1
+        return reason
+
+    def _check(self, device_id, timestamp, packet_id):
+        if self.max_skew is not None and abs(timestamp - self.clock()) > self.max_skew:
+            return SKEW
+
+        device = self.devices.get(device_id)
+        if device is None:
+            device = _Device()
+            self.devices[device_id] = device
+            if len(self.devices) > self.max_devices:
+                self.devices.popitem(last=False)
+        else:
+            self.devices.move_to_end(device_id)
+
+        if device.newest is not None and timestamp < device.newest - self.window:
+            return STALE
+        if device.floor is not None and timestamp <= device.floor:
+            return STALE
+        if packet_id in device.ids:
+            return DUPLICATE
+
+        device.ids[packet_id] = timestamp
+        if len(device.ids) > self.capacity:
+            _, forgotten = device.ids.popitem(last=False)
+            if device.floor is None or forgotten > device.floor:
+                device.floor = forgotten
+        if device.newest is None or timestamp > device.newest:
+            device.newest = timestamp
+        return None
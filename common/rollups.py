@@ -0,0 +1,200 @@
+import bisect
+
+# Bucket statistics, kept as lists to stay small:
+#   numeric: [count, min, max, sum]
+#   state:   [count, events, open_seconds]
+# A state reading is "open" when its value is truthy (motion detected, door
+# open, curtain not fully closed) and an event is a change from closed to open.
+COUNT = 0
+MIN, MAX, SUM = 1, 2, 3
+EVENTS, OPEN_SECONDS = 1, 2
+
+class RollupSeries:
+    """The buckets of one (msg_type, device_id) at every resolution."""
+
+    def __init__(self, kind, resolutions, retention):
+        self.kind = kind
+        # name -> (bucket seconds, retention seconds or None)
+        self.resolutions = {
+            name: (seconds, retention.get(name)) for name, seconds in resolutions.items()
+        }
+        # name -> {bucket start: stats}
+        self.buckets = {name: dict() for name in resolutions}
+        self.newest = None
+
+        # Latest (timestamp, open) of a state series, used to measure open time.
+        self.last_state = None
+
+    def _bucket(self, name, start):
+        buckets = self.buckets[name]
+        stats = buckets.get(start)
+        if stats is None:
+            stats = [0, None, None, 0] if self.kind == "numeric" else [0, 0, 0]
+            buckets[start] = stats
+            self._prune(name)
+        return stats
+
+    def _prune(self, name):
+        seconds, retention = self.resolutions[name]
+        buckets = self.buckets[name]
+        # Pruning scans every bucket, so wait until there are twice as many as
+        # the retention keeps.
+        if retention is None or len(buckets) <= (retention // seconds) * 2:
+            return
+        oldest = self.newest - retention
+        for start in [start for start in buckets if start + seconds <= oldest]:
+            del buckets[start]
+
+    def _expired(self, name, start):
+        seconds, retention = self.resolutions[name]
+        return retention is not None and start + seconds <= self.newest - retention
+
+    def add(self, timestamp, value):
+        if self.newest is None or timestamp > self.newest:
+            self.newest = timestamp
+
+        for name, (seconds, _) in self.resolutions.items():
+            start = timestamp - timestamp % seconds
+            if self._expired(name, start):
+                continue
+            stats = self._bucket(name, start)
+            stats[COUNT] += 1
+
+            if self.kind == "numeric":
+                if stats[MIN] is None or value < stats[MIN]:
+                    stats[MIN] = value
+                if stats[MAX] is None or value > stats[MAX]:
+                    stats[MAX] = value
+                stats[SUM] += value
+
+        if self.kind == "state":
+            self._add_state(timestamp, bool(value))
+
+    def _add_state(self, timestamp, is_open):
+        if self.last_state is None:
+            if is_open:
+                self._count_event(timestamp)
+            self.last_state = (timestamp, is_open)
+            return
+
+        last_timestamp, was_open = self.last_state
+        if timestamp < last_timestamp:
+            # A late reading (e.g. replayed from a gateway spool) is counted but
+            # does not change events or open time, which follow arrival order.
+            return
+
+        if was_open:
+            self._add_open_time(last_timestamp, timestamp)
+        elif is_open:
+            self._count_event(timestamp)
+        self.last_state = (timestamp, is_open)
+
+    def _count_event(self, timestamp):
+        for name, (seconds, _) in self.resolutions.items():
+            start = timestamp - timestamp % seconds
+            if not self._expired(name, start):
+                self._bucket(name, start)[EVENTS] += 1
+
+    def _add_open_time(self, begin, end):
+        """Spread the open interval [begin, end) over the buckets it overlaps."""
+        for name, (seconds, retention) in self.resolutions.items():
+            first = begin if retention is None else max(begin, self.newest - retention)
+            start = first - first % seconds
+            while start < end:
+                overlap = min(end, start + seconds) - max(first, start)
+                if overlap > 0:
+                    self._bucket(name, start)[OPEN_SECONDS] += overlap
+                start += seconds
+
+    def query(self, name, since=None, until=None):
+        """Yield (bucket start, stats) for the buckets of one resolution in time order."""
+        buckets = self.buckets[name]
+        starts = sorted(buckets)
+        seconds = self.resolutions[name][0]
+
+        first = 0 if since is None else bisect.bisect_left(starts, since - seconds + 1)
+        for start in starts[first:]:
+            if until is not None and start > until:
+                break
+            yield start, buckets[start]
+
+def format_bucket(kind, device_id, start, stats):
+    if kind == "numeric":
+        return {
+            "device_id": device_id,
+            "start": start,
+            "count": stats[COUNT],
+            "min": stats[MIN],
+            "max": stats[MAX],
+            "mean": stats[SUM] / stats[COUNT] if stats[COUNT] else None,
+        }
+    return {
+        "device_id": device_id,
+        "start": start,
+        "count": stats[COUNT],
+        "events": stats[EVENTS],
+        "open_seconds": stats[OPEN_SECONDS],
+    }
+
+class Rollups:
+    """
+    Incrementally maintained per-device aggregates of readings in time buckets.
+
+    kinds maps msg_type to "numeric" (count, min, max and mean) or "state"
+    (count, closed-to-open events and seconds open). resolutions maps a name
+    such as "1h" to a bucket length in seconds, and retention maps a name to
+    how many seconds of buckets to keep behind a device's newest reading, or
+    None to keep them all. Open time is counted up to a device's latest reading.
+    """
+
+    def __init__(self, kinds, resolutions, retention):
+        self.kinds = kinds
+        self.resolutions = resolutions
+        self.retention = retention
+        # (msg_type, device_id) -> RollupSeries
+        self.series = dict()
+
+    def add(self, msg_type, device_id, timestamp, value):
+        kind = self.kinds.get(msg_type)
+        if kind is None:
+            return
+
+        key = (msg_type, device_id)
+        series = self.series.get(key)
+        if series is None:
+            series = RollupSeries(kind, self.resolutions, self.retention)
+            self.series[key] = series
+        series.add(timestamp, value)
+
+    def rebuild(self, history):
+        """Recompute every rollup from the history store. Returns the number of readings read."""
+        self.series = dict()
+        count = 0
+        for msg_type in self.kinds:
+            for device_id in history.devices(msg_type):
+                for _, _, timestamp, value in history.scan(msg_type, device_id):
+                    self.add(msg_type, device_id, timestamp, value)
+                    count += 1
+        return count
+
+    def query(self, msg_type, resolution, device_id=None, since=None, until=None):
+        """
+        Return the buckets of msg_type at resolution as dictionaries, ordered by
+        start time and device. Raises ValueError for an unknown resolution.
+        """
+        if resolution not in self.resolutions:
+            raise ValueError(f"unknown resolution {resolution!r}, expected one of {', '.join(self.resolutions)}")
+        for name, value in (("since", since), ("until", until)):
+            if value is not None and not isinstance(value, int):
+                raise ValueError(f"{name} must be an integer timestamp")
+
+        kind = self.kinds[msg_type]
+        rows = []
+        for (series_type, series_device), series in self.series.items():
+            if series_type != msg_type or (device_id is not None and series_device != device_id):
+                continue
+            for start, stats in series.query(resolution, since, until):
+                rows.append(format_bucket(kind, series_device, start, stats))
+
+        rows.sort(key=lambda row: (row["start"], row["device_id"]))
+        return rows
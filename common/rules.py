@@ -0,0 +1,139 @@
+import time
+
+from common.predicates import compile_predicate
+
+# When a rule fires for a device: "enter" when its readings start to match,
+# "every" on every matching reading.
+TRIGGERS = ("enter", "every")
+
+def _as_list(value, kind, name, field):
+    """Turn a single value of `kind` or a list of them into a list. None stays None."""
+    if value is None:
+        return None
+    values = value if isinstance(value, list) else [value]
+    if not values or not all(isinstance(item, kind) and not isinstance(item, bool) for item in values):
+        raise ValueError(f"rule {name!r}: {field} must be a {kind.__name__} or a list of them")
+    return values
+
+class Rule:
+    """One compiled rule. See RuleEngine for the specification it is built from."""
+
+    def __init__(self, spec):
+        if not isinstance(spec, dict) or not isinstance(spec.get("name"), str):
+            raise ValueError(f"every rule needs a name: {spec!r}")
+        self.name = name = spec["name"]
+
+        when = spec.get("when", {})
+        then = spec.get("then")
+        if not isinstance(when, dict):
+            raise ValueError(f"rule {name!r}: when must be an object")
+        if not isinstance(then, dict):
+            raise ValueError(f"rule {name!r}: then must be an object")
+
+        self.msg_types = _as_list(when.get("msg_type"), int, name, "msg_type")
+        self.device_ids = _as_list(when.get("device_id"), str, name, "device_id")
+        try:
+            self.predicate = compile_predicate(when.get("where"))
+        except ValueError as e:
+            raise ValueError(f"rule {name!r}: {e}")
+
+        self.position = then.get("control_curtain")
+        if not isinstance(self.position, int) or isinstance(self.position, bool) or not 0 <= self.position <= 100:
+            raise ValueError(f"rule {name!r}: control_curtain must be an integer from 0 to 100")
+        # None sends the command to the device the reading came from.
+        self.target = then.get("device_id")
+        if self.target is not None and not isinstance(self.target, str):
+            raise ValueError(f"rule {name!r}: the device_id of then must be a string")
+
+        self.trigger = spec.get("trigger", "enter")
+        if self.trigger not in TRIGGERS:
+            raise ValueError(f"rule {name!r}: trigger must be one of {', '.join(TRIGGERS)}")
+        self.cooldown = spec.get("cooldown", 0)
+        if not isinstance(self.cooldown, (int, float)) or self.cooldown < 0:
+            raise ValueError(f"rule {name!r}: cooldown must be a non-negative number of seconds")
+
+        # Devices whose last reading matched, for the "enter" trigger.
+        self.matching = set()
+        # device_id -> when the rule last fired for it.
+        self.fired = dict()
+        self.hits = 0
+
+    def keys(self):
+        """The (msg_type, device_id) index keys this rule is stored under."""
+        for msg_type in self.msg_types or [None]:
+            for device_id in self.device_ids or [None]:
+                yield msg_type, device_id
+
+    def check(self, device_id, value, clock):
+        """Whether a reading from device_id with this value fires the rule."""
+        matches = self.predicate is None or self.predicate(value)
+        if self.trigger == "enter":
+            entered = matches and device_id not in self.matching
+            if matches:
+                self.matching.add(device_id)
+            else:
+                self.matching.discard(device_id)
+            if not entered:
+                return False
+        elif not matches:
+            return False
+
+        now = clock()
+        last = self.fired.get(device_id)
+        if last is not None and now - last < self.cooldown:
+            return False
+        self.fired[device_id] = now
+        self.hits += 1
+        return True
+
+class RuleEngine:
+    """
+    Automations the gateway runs on every verified reading, without a round
+    trip through the cloud. A rule is a dictionary such as
+
+        {"name": "close-when-door-opens",
+         "when": {"msg_type": 3, "device_id": "door-1", "where": {"eq": True}},
+         "then": {"control_curtain": 0, "device_id": "ESP8266Client"},
+         "trigger": "enter", "cooldown": 10}
+
+    when has the optional msg_type, device_id and where of a cloud
+    subscription. then is a curtain command, sent to the device the reading
+    came from when it has no device_id. With the "enter" trigger (the default)
+    a rule fires once when a device's readings start to match, so a door that
+    stays open does not fire it again; with "every" it fires on every matching
+    reading. cooldown is the least number of seconds between two firings for
+    the same device.
+
+    Rules are indexed by (msg_type, device_id) like the cloud's subscriptions,
+    so a reading costs four dictionary lookups plus the rules that name its
+    msg_type and device, however many other rules there are.
+    """
+
+    def __init__(self, specs, clock=time.monotonic):
+        self.clock = clock
+        self.rules = []
+        self.index = dict()
+
+        names = set()
+        for spec in specs:
+            rule = Rule(spec)
+            if rule.name in names:
+                raise ValueError(f"duplicate rule name {rule.name!r}")
+            names.add(rule.name)
+            self.rules.append(rule)
+            for key in rule.keys():
+                self.index.setdefault(key, []).append(rule)
+
+    def evaluate(self, reading):
+        """Return (rule, device_id, position) for every curtain command the reading fires."""
+        msg_type = reading["msg_type"]
+        device_id = reading["device_id"]
+        value = reading["value"]
+
+        commands = []
+        for key in ((msg_type, device_id), (msg_type, None), (None, device_id), (None, None)):
+            for rule in self.index.get(key, ()):
+                if rule.check(device_id, value, self.clock):
+                    target = rule.target if rule.target is not None else device_id
+                    commands.append((rule, target, rule.position))
+        return commands
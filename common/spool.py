@@ -0,0 +1,137 @@
+import os
+import struct
+
+import cbor2
+
+# Each record is a little-endian length followed by that many bytes of CBOR.
+LENGTH = struct.Struct("<I")
+# The checkpoint holds the (segment, offset) of the first unread record.
+CHECKPOINT = struct.Struct("<QQ")
+
+class Spool:
+    """
+    Disk-backed FIFO of messages that survives restarts.
+
+    Messages are appended to numbered segment files. Reading is two-step:
+    peek() returns messages together with the position after them, and
+    commit() moves the checkpointed read position there once the messages have
+    been delivered. Segments that have been read completely are deleted.
+    """
+
+    def __init__(self, directory, segment_bytes):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self.read_position = self._load_checkpoint()
+
+        segments = self._segments()
+        self.write_segment = segments[-1] if segments else self.read_position[0]
+
+        # Count the messages left over from a previous run.
+        self.pending = 0
+        for segment in segments:
+            path = self._segment_path(segment)
+            if segment < self.read_position[0]:
+                os.remove(path)
+                continue
+
+            end = self.read_position[1] if segment == self.read_position[0] else 0
+            with open(path, "rb") as f:
+                f.seek(end)
+                for _, end in self._records(f):
+                    self.pending += 1
+
+            if segment == self.write_segment and end != os.path.getsize(path):
+                # Drop a record that was only partially written before a crash.
+                os.truncate(path, end)
+
+        self.write_file = open(self._segment_path(self.write_segment), "ab")
+
+    def __len__(self):
+        return self.pending
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.spool")
+
+    def _segments(self):
+        return sorted(
+            int(name.split(".")[0]) for name in os.listdir(self.directory) if name.endswith(".spool")
+        )
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, "checkpoint"), "rb") as f:
+                return CHECKPOINT.unpack(f.read(CHECKPOINT.size))
+        except (OSError, struct.error):
+            segments = self._segments()
+            return (segments[0] if segments else 0, 0)
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.directory, "checkpoint")
+        with open(path + ".tmp", "wb") as f:
+            f.write(CHECKPOINT.pack(*self.read_position))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _records(f):
+        """Yield (data, offset after the record) until the end of the file or a torn record."""
+        while True:
+            header = f.read(LENGTH.size)
+            if len(header) < LENGTH.size:
+                return
+            (length,) = LENGTH.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield data, f.tell()
+
+    def append(self, message):
+        if self.write_file.tell() >= self.segment_bytes:
+            self.write_file.close()
+            self.write_segment += 1
+            self.write_file = open(self._segment_path(self.write_segment), "ab")
+
+        data = cbor2.dumps(message)
+        self.write_file.write(LENGTH.pack(len(data)) + data)
+        self.write_file.flush()
+        self.pending += 1
+
+    def peek(self, count):
+        """Return up to count unread messages and the position to commit after delivering them."""
+        messages = []
+        segment, offset = self.read_position
+
+        while len(messages) < count and segment <= self.write_segment:
+            path = self._segment_path(segment)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    for data, offset in self._records(f):
+                        messages.append(cbor2.loads(data))
+                        if len(messages) >= count:
+                            break
+
+            if len(messages) >= count or segment == self.write_segment:
+                break
+            segment, offset = segment + 1, 0
+
+        return messages, (segment, offset)
+
+    def commit(self, position, count):
+        """Mark the count messages returned by peek() together with position as delivered."""
+        old_segment = self.read_position[0]
+        self.read_position = position
+        self.pending = max(0, self.pending - count)
+        self._save_checkpoint()
+
+        for segment in range(old_segment, position[0]):
+            try:
+                os.remove(self._segment_path(segment))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self.write_file.close()
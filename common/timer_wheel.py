@@ -0,0 +1,117 @@
+import time
+
+class Timer:
+    __slots__ = ("expires", "callback", "slot")
+
+    def __init__(self, expires, callback):
+        # Tick at which the timer is due.
+        self.expires = expires
+        self.callback = callback
+        # The wheel slot holding it, None once it has fired or been cancelled.
+        self.slot = None
+
+class TimerWheel:
+    """
+    Timers with a resolution of `tick` seconds in a hierarchical timing wheel,
+    for the many timers of which nearly all are cancelled or pushed back before
+    they are due, like keepalive timeouts.
+
+    The wheel has `levels` levels of `slots` slots (a power of two). A slot of
+    the first level holds the timers due in one tick, and a slot of each
+    further level spans all the slots of the level below. schedule() and
+    cancel() cost a set operation whatever the number of timers. advance()
+    fires the timers of each tick that has passed, and every `slots` ticks
+    moves the timers of the next slot of the level above down to the levels
+    they now belong to. A timer moves down at most levels - 1 times, so
+    expiring it is O(1) as well. Timers further away than the wheel spans
+    wait in its last slot and are placed again when they come down.
+
+    Timers fire up to one tick late and never early. The owner calls advance()
+    about once a tick.
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=4, clock=time.monotonic):
+        if slots < 2 or slots & (slots - 1):
+            raise ValueError("slots must be a power of two")
+        self.tick = tick
+        self.bits = slots.bit_length() - 1
+        self.mask = slots - 1
+        self.clock = clock
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        # The next tick to process. Timers due before it fire with it.
+        self.current = self._ticks(clock())
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _ticks(self, seconds):
+        return int(seconds // self.tick)
+
+    def schedule(self, delay, callback):
+        """Call callback() once delay seconds have passed. Returns a Timer for cancel()."""
+        # Rounded up, so timers never fire early.
+        expires = -int(-(self.clock() + delay) // self.tick)
+        timer = Timer(expires, callback)
+        self._place(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.count -= 1
+
+    def _place(self, timer):
+        ticks = timer.expires - self.current
+        if ticks < 0:
+            # Already due: fires with the next tick processed.
+            slot = self.wheels[0][self.current & self.mask]
+        else:
+            top = len(self.wheels) - 1
+            level = 0
+            while level < top and ticks >> (self.bits * (level + 1)):
+                level += 1
+            expires = timer.expires
+            if ticks >> (self.bits * (top + 1)):
+                expires = self.current + (1 << (self.bits * (top + 1))) - 1
+            slot = self.wheels[level][(expires >> (self.bits * level)) & self.mask]
+        slot.add(timer)
+        timer.slot = slot
+
+    def _cascade(self, level):
+        """Move the timers of the current slot of level down. Returns the slot's index."""
+        index = (self.current >> (self.bits * level)) & self.mask
+        slot = self.wheels[level][index]
+        self.wheels[level][index] = set()
+        for timer in slot:
+            self._place(timer)
+        return index
+
+    def advance(self):
+        """Fire the timers that are due. Returns how many fired."""
+        target = self._ticks(self.clock())
+        fired = 0
+        while self.current <= target:
+            index = self.current & self.mask
+            level = 1
+            if index == 0:
+                while level < len(self.wheels) and self._cascade(level) == 0:
+                    level += 1
+
+            slot = self.wheels[0][index]
+            self.wheels[0][index] = set()
+            # Timers scheduled by the callbacks below for the tick just
+            # processed go into the next one.
+            self.current += 1
+            for timer in slot:
+                timer.slot = None
+                self.count -= 1
+                fired += 1
+                timer.callback()
+        return fired
+
+    def timeout(self):
+        """Seconds until advance() has the next tick to process."""
+        return max(0.0, self.current * self.tick - self.clock())
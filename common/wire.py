@@ -0,0 +1,92 @@
+import json
+import zlib
+
+import cbor2
+
+from wsproto.events import BytesMessage, TextMessage
+from wsproto.extensions import PerMessageDeflate
+
+# WebSocket subprotocols for the gateway <-> cloud and cloud <-> application
+# links. Messages have the same structure in both; "cbor" carries them as
+# CBOR in binary messages and "json" as JSON text. A peer that offers no
+# subprotocol gets JSON, like before the binary mode existed.
+SUBPROTOCOL_CBOR = "blinds.cbor"
+SUBPROTOCOL_JSON = "blinds.json"
+
+# Messages smaller than this are sent uncompressed even when permessage-deflate
+# has been negotiated; compressing them costs more CPU than it saves.
+DEFLATE_MIN_SIZE = 128
+
+def client_subprotocols(wire_format):
+    """Subprotocols offered by a client, in order of preference."""
+    if wire_format == "cbor":
+        return [SUBPROTOCOL_CBOR, SUBPROTOCOL_JSON]
+    return [SUBPROTOCOL_JSON]
+
+def client_extensions(deflate):
+    return [PerMessageDeflate()] if deflate else []
+
+def choose_subprotocol(offered, wire_format):
+    """Pick the subprotocol a server accepts out of those offered by a client."""
+    if wire_format == "cbor" and SUBPROTOCOL_CBOR in offered:
+        return SUBPROTOCOL_CBOR
+    if SUBPROTOCOL_JSON in offered:
+        return SUBPROTOCOL_JSON
+    return None
+
+def server_extensions(deflate):
+    # Without context takeover a compressed message does not depend on earlier
+    # messages, which lets the cloud compress a reading once for every application.
+    return [PerMessageDeflate(server_no_context_takeover=True)] if deflate else []
+
+def deflate_window_bits(extensions):
+    """The negotiated server window bits, or None if permessage-deflate is not in use."""
+    for extension in extensions:
+        if isinstance(extension, PerMessageDeflate) and extension.enabled():
+            return extension.server_max_window_bits
+    return None
+
+def is_binary(subprotocol):
+    return subprotocol == SUBPROTOCOL_CBOR
+
+def encode(message, binary):
+    """Encode a message as the data of a wsproto Message event."""
+    if binary:
+        return cbor2.dumps(message)
+    return json.dumps(message)
+
+def decode(data):
+    if isinstance(data, str):
+        return json.loads(data)
+    return cbor2.loads(data)
+
+def compress(payload, window_bits):
+    """Compress one message payload the way permessage-deflate expects it."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -window_bits)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-4]
+
+class MessageAssembler:
+    """Collects the fragments of incoming text and binary messages."""
+
+    def __init__(self):
+        self.fragments = []
+
+    def feed(self, event):
+        """
+        Add a TextMessage or BytesMessage event. Returns the decoded message once
+        its last fragment has arrived, otherwise None.
+        """
+        self.fragments.append(event.data)
+        if not event.message_finished:
+            return None
+
+        if isinstance(event, TextMessage):
+            data = "".join(self.fragments)
+        else:
+            data = b"".join(self.fragments)
+        self.fragments = []
+        return decode(data)
+
+def is_data_event(event):
+    return isinstance(event, (TextMessage, BytesMessage))
@@ -1,14 +1,15 @@
 import paho.mqtt.client as mqtt
-import cbor2
-import hmac
-import hashlib
 
-import json
+import logging
 import select
+import socket
+import ssl
 import time
+from collections import deque
 
 from wsproto import WSConnection
 from wsproto.connection import ConnectionType
+from wsproto.utilities import LocalProtocolError, RemoteProtocolError
 from wsproto.events import (
     AcceptConnection,
     RejectConnection,
@@ -17,44 +18,202 @@ from wsproto.events import (
     Ping,
     Pong,
     Request,
-    TextMessage,
 )
 
 from common.config import *
 from common import project_crypto
+from common import wire
+from common import spool
+from common import packet_codec
+from common import ingest_pipeline
+from common import logs
+from common import metrics
+from common import mqtt_lite
+from common import replay_window
+from common import rules
+from common import change_filter
+
+log = logging.getLogger("gateway")
+sample = logs.Sampler(LOG_SAMPLE_EVERY)
+
+PACKETS_RECEIVED = metrics.counter("gateway_packets_received_total", "Packets received from edge devices")
+HMAC_FAILURES = metrics.counter("gateway_packet_errors_total", "Packets rejected", {"reason": "hmac"})
+DECODE_FAILURES = metrics.counter("gateway_packet_errors_total", "Packets rejected", {"reason": "decode"})
+REPLAY_DROPPED = {
+    reason: metrics.counter("gateway_packet_errors_total", "Packets rejected", {"reason": reason})
+    for reason in (replay_window.STALE, replay_window.DUPLICATE, replay_window.SKEW)
+}
+READINGS_ACCEPTED = metrics.counter("gateway_readings_total", "Verified readings queued for the cloud")
+UPLINK_DROPPED = metrics.counter("gateway_uplink_dropped_total", "Readings dropped because the uplink queue was full")
+UPLINK_MESSAGES = metrics.counter("gateway_uplink_messages_total", "Messages sent to the cloud")
+UPLINK_BATCH_SIZE = metrics.histogram(
+    "gateway_uplink_batch_size", "Readings per message sent to the cloud", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024),
+)
+CLOUD_CONNECTED = metrics.gauge("gateway_cloud_connected", "Whether the WebSocket to the cloud is established")
+CLOUD_RECONNECTS = metrics.counter("gateway_cloud_connection_failures_total", "Failed or lost connections to the cloud")
+CLOUD_HANDSHAKE_SECONDS = metrics.histogram("gateway_cloud_handshake_seconds", "Time to connect and finish the TLS handshake with the cloud")
+COMMANDS = metrics.counter("gateway_commands_total", "Commands from the cloud published to devices")
+RULE_HITS_DROPPED = metrics.counter("gateway_rule_hits_dropped_total", "Rule hits not reported because too many were waiting")
+
+# Topics edge devices publish their packets on.
+DEVICE_TOPICS = ("blinds/temperature", "blinds/motion", "blinds/door", "blinds/curtain")
 
 cloud_socket = None
 cloud_websocket = None
-cloud_data_to_send = []
+client = None
+uplink = None
+pipeline = None
+direct = None
+replay = None
+rule_engine = None
+reduction = None
+
+class Uplink:
+    """
+    Readings waiting to be sent to the cloud.
+
+    While the cloud is connected readings are queued in memory and taken off in
+    batches of up to GATEWAY_BATCH_SIZE, or fewer once the oldest queued reading
+    has waited GATEWAY_BATCH_INTERVAL_MS. While it is not, and whenever the
+    queue is past GATEWAY_QUEUE_HIGH_WATER with the "spill" policy, readings go
+    to the on-disk spool instead. The spool is replayed in acknowledged batches
+    after reconnecting, and is only cleared once the cloud has confirmed them.
+    Batches of readings spilled while connected are marked live, so the cloud
+    treats their curtain statuses as current.
+
+    Reports of the gateway's rules firing are sent in their own messages. Up to
+    GATEWAY_RULE_HITS_QUEUE of them wait in memory while the cloud is away.
+    """
 
-def verify_and_parse_packet(packet_bytes):
-    """Verify HMAC-SHA256 and return [type, device_id, timestamp, value]."""
-    if len(packet_bytes) < 32:
-        print("Packet too short to contain HMAC.")
+    def __init__(self):
+        self.queue = deque()
+        self.rule_hits = deque()
+        self.spool = spool.Spool(GATEWAY_SPOOL_DIR, GATEWAY_SPOOL_SEGMENT_BYTES)
+        self.oldest = None
+        self.dropped = 0
+        self.connected = False
+
+        # The replay batch waiting for an acknowledgement: (batch_id, position, count).
+        self.replay_in_flight = None
+        # Spooled readings at the front of the spool that were spooled before
+        # the current connection, during an outage or by a previous run.
+        self.stale = 0
+        self.next_batch_id = 0
+
+        if len(self.spool):
+            log.info("Uplink: %d spooled readings from a previous run", len(self.spool))
+
+    def put(self, reading):
+        # Once readings are spooled, newer readings are spooled as well so that
+        # they reach the cloud in order.
+        if self.connected and not len(self.spool) and len(self.queue) < GATEWAY_QUEUE_HIGH_WATER:
+            if not self.queue:
+                self.oldest = time.monotonic()
+            self.queue.append(reading)
+        elif not self.connected or GATEWAY_OVERFLOW_POLICY == "spill":
+            self.spool.append(reading)
+        else:
+            self.dropped += 1
+            UPLINK_DROPPED.inc()
+            if log.isEnabledFor(logging.WARNING) and sample():
+                log.warning("Uplink queue full, dropped reading (%d dropped so far)", self.dropped)
+
+    def put_rule_hit(self, hit):
+        if len(self.rule_hits) >= GATEWAY_RULE_HITS_QUEUE:
+            self.rule_hits.popleft()
+            RULE_HITS_DROPPED.inc()
+        self.rule_hits.append(hit)
+
+    def on_connect(self):
+        self.connected = True
+        self.replay_in_flight = None
+        self.stale = len(self.spool)
+
+    def on_disconnect(self):
+        """Move everything that has not been sent into the spool."""
+        self.connected = False
+        self.replay_in_flight = None
+        while self.queue:
+            self.spool.append(self.queue.popleft())
+        self.oldest = None
+
+    def timeout(self):
+        """Seconds until the next batch is due, or None when there is nothing to send."""
+        if self.rule_hits:
+            return 0
+        if self.queue:
+            if len(self.queue) >= GATEWAY_BATCH_SIZE:
+                return 0
+            return max(0, self.oldest + GATEWAY_BATCH_INTERVAL_MS / 1000 - time.monotonic())
+        if len(self.spool) and self.replay_in_flight is None:
+            return 0
         return None
 
-    cbor_part = packet_bytes[:-32]
-    hmac_part = packet_bytes[-32:]
+    def take_batch(self):
+        """Return the next message to send to the cloud, or None."""
+        if self.rule_hits:
+            hits = list(self.rule_hits)
+            self.rule_hits.clear()
+            return {"rule_hits": hits}
+
+        if self.queue:
+            count = min(len(self.queue), GATEWAY_BATCH_SIZE)
+            batch = [self.queue.popleft() for _ in range(count)]
+            self.oldest = time.monotonic() if self.queue else None
+
+            if GATEWAY_BATCH_SIZE > 1:
+                return {"batch": batch}
+            return batch[0]
+
+        if len(self.spool) and self.replay_in_flight is None:
+            # Batches do not mix stale and live readings.
+            batch, position = self.spool.peek(min(self.stale, GATEWAY_REPLAY_BATCH_SIZE) or GATEWAY_REPLAY_BATCH_SIZE)
+            if not batch:
+                return None
+
+            batch_id = self.next_batch_id
+            self.next_batch_id += 1
+            self.replay_in_flight = (batch_id, position, len(batch))
+            message = {"batch": batch, "replay": True, "batch_id": batch_id}
+            if self.stale:
+                log.info("Uplink: replaying %d spooled readings (%d spooled)", len(batch), len(self.spool))
+            else:
+                message["live"] = True
+            return message
 
-    computed = hmac.new(HMAC_KEY, cbor_part, hashlib.sha256).digest()
-    if not hmac.compare_digest(computed, hmac_part):
-        print("HMAC verification failed")
         return None
 
-    print("HMAC Verified")
+    def on_ack(self, batch_id):
+        if self.replay_in_flight is None or self.replay_in_flight[0] != batch_id:
+            return
+        _, position, count = self.replay_in_flight
+        self.spool.commit(position, count)
+        self.stale = max(0, self.stale - count)
+        self.replay_in_flight = None
+
+    def close(self):
+        self.spool.close()
+
+codec = packet_codec.PacketCodec(HMAC_KEY)
 
+def verify_and_parse_packet(packet_bytes):
+    """Verify HMAC-SHA256 and return [type, device_id, timestamp, value]."""
     try:
-        decoded = cbor2.loads(packet_bytes)
-    except Exception as e:
-        print(f"Error decoding CBOR: {e}")
+        codec.verify(packet_bytes)
+    except packet_codec.PacketError as e:
+        HMAC_FAILURES.inc()
+        if log.isEnabledFor(logging.WARNING) and sample():
+            log.warning("%s", e)
         return None
 
-    if not isinstance(decoded, list) or len(decoded) != 5:
-        print("Unexpected CBOR structure:", decoded)
+    try:
+        return list(codec.decode(packet_bytes))  # [type, device_id, timestamp, value]
+    except packet_codec.PacketError as e:
+        DECODE_FAILURES.inc()
+        if log.isEnabledFor(logging.WARNING) and sample():
+            log.warning("%s", e)
         return None
 
-    return decoded[:-1]  # [type, device_id, timestamp, value]
-
 def encode_command(cmd_type: int, device_id: str, value: int) -> bytes:
     """
     Create a CBOR command packet with HMAC.
@@ -65,140 +224,364 @@ def encode_command(cmd_type: int, device_id: str, value: int) -> bytes:
         raise ValueError("Curtain position must be in [0, 100]")
 
     timestamp = int(time.time())
-    empty_hmac = bytes(32)
-
-    array = [cmd_type, device_id, timestamp, value, empty_hmac]
-    encoded_without_hmac = cbor2.dumps(array)
-
-    checked_bytes = encoded_without_hmac[:-32]
-    mac = hmac.new(HMAC_KEY, checked_bytes, hashlib.sha256).digest()
+    return codec.encode(cmd_type, device_id, timestamp, value)
 
-    full_array = [cmd_type, device_id, timestamp, value, mac]
-    return cbor2.dumps(full_array)
+def publish_command(device_id, value):
+    """Publish a curtain command to a device, through the broker or the built-in server."""
+    payload = encode_command(1, device_id, value)
+    if direct is not None:
+        direct.publish("blinds/commands", payload)
+    else:
+        client.publish("blinds/commands", payload, qos=1)
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
-        print("Connected to MQTT Broker!")
-        client.subscribe("blinds/temperature")
-        client.subscribe("blinds/motion")
-        client.subscribe("blinds/door")
-        client.subscribe("blinds/curtain")   # ACK/status from ESP
+        log.info("Connected to MQTT broker")
+        for topic in DEVICE_TOPICS:   # blinds/curtain carries ACK/status from the ESP
+            client.subscribe(topic)
     else:
-        print(f"Connection failed with code {rc}")
+        log.error("MQTT connection failed with code %d", rc)
 
 def on_message(client, userdata, msg):
-    print(f"\n--- Message on topic: {msg.topic} ({len(msg.payload)} bytes) ---")
-    parsed = verify_and_parse_packet(msg.payload)
+    handle_packet(msg.topic, msg.payload)
+
+def handle_packet(topic, payload):
+    PACKETS_RECEIVED.inc()
+    if pipeline is not None:
+        pipeline.submit(payload)
+        return
+
+    parsed = verify_and_parse_packet(payload)
     if not parsed:
         return
 
     msg_type, device_id, timestamp, value = parsed
+    if log.isEnabledFor(logging.DEBUG) and sample():
+        log.debug("%s: %s from %s at %d: %r", topic, MSG_TYPE_NAMES.get(msg_type, msg_type), device_id, timestamp, value)
 
-    print(f"  Device ID: {device_id}")
-    print(f"  Timestamp: {timestamp}")
-
-    if msg_type == 1:
-        print(f"  Type 1 (Temperature): {value} °C")
-    elif msg_type == 2:
-        print(f"  Type 2 (Motion): {'Detected' if value else 'No Motion'}")
-    elif msg_type == 3:
-        print(f"  Type 3 (Door): {'Open' if value else 'Closed'}")
-    elif msg_type == 4:
-        print(f"  Type 4 (Curtain Position): {value} %")
-    else:
-        print(f"  Unknown type {msg_type} with value: {value}")
-
-    # Add packet to send queue.
-    cloud_data_to_send.append({
+    accept_reading({
         "msg_type": msg_type,
         "device_id": device_id,
         "timestamp": timestamp,
         "value": value,
-    })
+    }, replay_window.packet_id(payload))
+
+def accept_reading(reading, packet_id):
+    """Queue a verified reading for the cloud unless it is a replay."""
+    if replay is not None:
+        reason = replay.check(reading["device_id"], reading["timestamp"], packet_id)
+        if reason is not None:
+            REPLAY_DROPPED[reason].inc()
+            if log.isEnabledFor(logging.DEBUG) and sample():
+                log.debug("Dropped %s packet from %s at %d", reason, reading["device_id"], reading["timestamp"])
+            return
+
+    if rule_engine is not None:
+        for rule, device_id, position in rule_engine.evaluate(reading):
+            log.info("Rule %s fired by %s from %s: curtain of %s to %d",
+                     rule.name, MSG_TYPE_NAMES.get(reading["msg_type"], reading["msg_type"]),
+                     reading["device_id"], device_id, position)
+            publish_command(device_id, position)
+            uplink.put_rule_hit({
+                "rule": rule.name,
+                "reading": reading,
+                "control_curtain": position,
+                "device_id": device_id,
+            })
 
-def main():
-    client = mqtt.Client()
-    client.on_connect = on_connect
-    client.on_message = on_message
-
-    cloud_socket = project_crypto.construct_ssl_socket(
-        True,
-        "gateway",
-        "cloud",
-        EXTERNAL_CLOUD_IP,
-        GATEWAY_PORT
-    )
+    # Add packet to send queue.
+    READINGS_ACCEPTED.inc()
+    if reduction is not None and not reduction.forward(reading):
+        return
+    uplink.put(reading)
+
+class DirectIngest:
+    """
+    Takes packets straight from edge devices instead of through an MQTT broker:
+    on the built-in MQTT server at GATEWAY_MQTT_PORT, which devices can also
+    subscribe to for commands, and as UDP datagrams at GATEWAY_UDP_PORT. Every
+    packet goes through handle_packet like one from the broker.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.udp = None
+
+        if GATEWAY_MQTT_PORT is not None:
+            context = None
+            if GATEWAY_MQTT_CERTFILE is not None:
+                context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                context.load_cert_chain(GATEWAY_MQTT_CERTFILE, GATEWAY_MQTT_KEYFILE)
+            self.server = mqtt_lite.Broker(GATEWAY_LISTEN_HOST, GATEWAY_MQTT_PORT, context, self.on_publish)
+            log.info("Accepting MQTT%s from devices on %s:%d",
+                     " over TLS" if context else "", GATEWAY_LISTEN_HOST, GATEWAY_MQTT_PORT)
+
+        if GATEWAY_UDP_PORT is not None:
+            self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp.bind((GATEWAY_LISTEN_HOST, GATEWAY_UDP_PORT))
+            self.udp.setblocking(False)
+            log.info("Accepting UDP packets from devices on %s:%d", GATEWAY_LISTEN_HOST, GATEWAY_UDP_PORT)
+
+    def sockets(self):
+        return [sock for sock in (self.server, self.udp) if sock is not None]
+
+    def on_publish(self, topic, payload):
+        if topic in DEVICE_TOPICS:
+            handle_packet(topic, payload)
+
+    def read(self, sock):
+        if sock is self.server:
+            self.server.poll()
+            return
+
+        # Read what has arrived, bounded so a flood cannot starve the cloud link.
+        for _ in range(1000):
+            try:
+                payload = self.udp.recv(2048)
+            except BlockingIOError:
+                return
+            handle_packet("udp", payload)
+
+    def publish(self, topic, payload):
+        if self.server is None or not self.server.publish(topic, payload):
+            log.warning("No device subscribed to %s, command dropped", topic)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.udp is not None:
+            self.udp.close()
+
+def register_metrics():
+    metrics.gauge("gateway_uplink_queue_depth", "Readings queued in memory for the cloud", function=lambda: len(uplink.queue))
+    metrics.gauge("gateway_spool_depth", "Readings spooled on disk for the cloud", function=lambda: len(uplink.spool))
+    if rule_engine is not None:
+        metrics.counter("gateway_rule_hits_total", "Commands sent by the gateway's rules",
+                        function=lambda: [({"rule": rule.name}, rule.hits) for rule in rule_engine.rules])
+    if reduction is not None:
+        names = {msg_type: MSG_TYPE_NAMES.get(msg_type, msg_type) for msg_type in reduction.filters}
+        metrics.counter(
+            "gateway_filter_readings_total", "Readings checked by the change filter",
+            function=lambda: [({"msg_type": names[t]}, seen) for t, (seen, _) in reduction.stats().items()],
+        )
+        metrics.counter(
+            "gateway_filter_suppressed_total", "Readings not forwarded to the cloud as nothing changed",
+            function=lambda: [({"msg_type": names[t]}, suppressed) for t, (_, suppressed) in reduction.stats().items()],
+        )
+        metrics.gauge(
+            "gateway_filter_suppression_ratio", "Share of the readings checked by the change filter that were not forwarded",
+            function=lambda: [
+                ({"msg_type": names[t]}, suppressed / seen if seen else 0.0)
+                for t, (seen, suppressed) in reduction.stats().items()
+            ],
+        )
+    if replay is not None:
+        metrics.gauge("gateway_replay_devices", "Devices tracked for replay protection",
+                      function=lambda: len(replay.devices))
+    if direct is not None and direct.server is not None:
+        metrics.gauge("gateway_device_connections", "Devices connected to the built-in MQTT server",
+                      function=lambda: len(direct.server.connections))
+    if pipeline is not None:
+        metrics.gauge("gateway_pipeline_queue_depth", "Packets waiting for verification",
+                      function=lambda: pipeline.pending.qsize())
+        metrics.gauge("gateway_pipeline_batches_in_flight", "Packet batches being verified",
+                      function=lambda: pipeline.in_flight)
+
+def connect_cloud(connector):
+    cloud_socket = connector.connect()
+    CLOUD_HANDSHAKE_SECONDS.observe(connector.last_handshake_seconds)
+    log.info("Connected to cloud, TLS handshake took %.1f ms (%s)", connector.last_handshake_seconds * 1000,
+             "resumed" if cloud_socket.session_reused else "full")
 
     cloud_websocket = WSConnection(ConnectionType.CLIENT)
-    cloud_socket.sendall(cloud_websocket.send(Request(host=EXTERNAL_CLOUD_IP, target="server")))
+    try:
+        cloud_socket.sendall(cloud_websocket.send(Request(
+            host=EXTERNAL_CLOUD_IP,
+            target="server",
+            subprotocols=wire.client_subprotocols(WIRE_FORMAT),
+            extensions=wire.client_extensions(WIRE_DEFLATE),
+        )))
+    except OSError:
+        connector.lost(cloud_socket)
+        raise
+    return cloud_socket, cloud_websocket
 
-    incoming_text = ""
+def main():
+    global client, uplink, pipeline, direct, replay, rule_engine, reduction
+    logs.setup(LOG_LEVEL)
+    uplink = Uplink()
+    if GATEWAY_RULES:
+        rule_engine = rules.RuleEngine(GATEWAY_RULES)
+        log.info("Loaded %d rules", len(rule_engine.rules))
+    if GATEWAY_FILTERS:
+        reduction = change_filter.ChangeFilter(GATEWAY_FILTERS, GATEWAY_FILTER_HEARTBEAT, GATEWAY_FILTER_SETTLE)
+    if GATEWAY_REPLAY_WINDOW is not None:
+        replay = replay_window.ReplayWindow(
+            GATEWAY_REPLAY_WINDOW,
+            GATEWAY_REPLAY_IDS,
+            GATEWAY_REPLAY_DEVICES,
+            GATEWAY_REPLAY_MAX_SKEW,
+        )
+    if GATEWAY_PIPELINE is not None:
+        pipeline = ingest_pipeline.VerifyPipeline(
+            HMAC_KEY,
+            GATEWAY_PIPELINE,
+            GATEWAY_PIPELINE_WORKERS,
+            GATEWAY_PIPELINE_BATCH_SIZE,
+            GATEWAY_PIPELINE_QUEUE_SIZE,
+        )
+
+    if GATEWAY_INGEST == "direct":
+        direct = DirectIngest()
+    elif GATEWAY_INGEST != "mqtt":
+        raise ValueError(f"unknown GATEWAY_INGEST {GATEWAY_INGEST!r}")
+
+    register_metrics()
+    if GATEWAY_METRICS_PORT is not None:
+        metrics.start_http_server(METRICS_HOST, GATEWAY_METRICS_PORT)
+        log.info("Serving metrics on http://%s:%d/metrics", METRICS_HOST, GATEWAY_METRICS_PORT)
+
+    if direct is None:
+        client = mqtt.Client()
+        client.on_connect = on_connect
+        client.on_message = on_message
+
+    cloud_socket = None
+    connector = project_crypto.Connector(
+        "gateway", "cloud", EXTERNAL_CLOUD_IP, GATEWAY_PORT,
+        GATEWAY_RECONNECT_MIN, GATEWAY_RECONNECT_MAX, RECONNECT_JITTER,
+    )
+    metrics.counter("gateway_cloud_connections_total", "TLS connections made to the cloud",
+                    function=lambda: connector.connections)
+    metrics.counter("gateway_cloud_sessions_resumed_total", "Connections to the cloud that resumed a TLS session",
+                    function=lambda: connector.resumed)
     try:
-        print(f"Connecting to MQTT broker at {BROKER_HOST}:{BROKER_PORT}...")
-        client.connect(BROKER_HOST, BROKER_PORT, 60)
+        if client is not None:
+            log.info("Connecting to MQTT broker at %s:%d", BROKER_HOST, BROKER_PORT)
+            client.connect(BROKER_HOST, BROKER_PORT, 60)
 
         while True:
-            readable, writable, exceptional = select.select(
-                [cloud_socket, client.socket()],
-                [cloud_socket],
-                [cloud_socket, client.socket()],
-                1,
-            )
-
-            for socket in readable:
-                if socket is cloud_socket:
-                    in_data = cloud_socket.recv(4096)
-                    cloud_websocket.receive_data(in_data)
-
-                    for event in cloud_websocket.events():
-                        if isinstance(event, AcceptConnection):
-                            print("Cloud Websocket established")
-                        elif isinstance(event, RejectConnection):
-                            print("Cloud Websocket rejected")
-                            raise Exception("cloud websocket connection rejected")
-                        elif isinstance(event, CloseConnection):
-                            print("Cloud connection closed: code={} reason={}".format(
-                                event.code, event.reason
-                            ))
-                            cloud_socket.send(cloud_websocket.send(event.response()))
-                        elif isinstance(event, Ping):
-                            cloud_socket.send(cloud_websocket.send(event.response()))
-                        elif isinstance(event, TextMessage):
-                            incoming_text += event.data
-                            if event.message_finished:
-                                message = json.loads(incoming_text)
-                                
-                                # The only messages coming this way currently will be curtain control message.
-                                if "control_curtain" in message:
-                                    value = message["control_curtain"]
-                                    payload = encode_command(1, DEVICE_ID, value)
-                                    client.publish("blinds/commands", payload, qos=1)
-
-                                incoming_text = ""
-                        else:
-                            print("Unsupported event: {event!r}")
-
-                elif socket is client.socket():
-                    client.loop_read()
-                    client.loop_write()
-                    client.loop_misc()
-
-            for socket in writable:
-                if socket is cloud_socket and len(cloud_data_to_send) != 0:
-                    # Write the first packet in the queue to the WebSocket connection.
-                    data = cloud_data_to_send.pop(0)
-
-                    json_string = json.dumps(data)
-                    out_data = cloud_websocket.send(Message(data=json_string))
-
-                    cloud_socket.sendall(out_data)
+            if cloud_socket is None and connector.wait() == 0:
+                try:
+                    cloud_socket, cloud_websocket = connect_cloud(connector)
+                    assembler = wire.MessageAssembler()
+                    binary = False
+                    cloud_ready = False
+                except OSError as e:
+                    CLOUD_RECONNECTS.inc()
+                    log.warning("Failed to connect to cloud: %s, retrying in %.1fs", e, connector.wait())
+
+            sockets = direct.sockets() if direct is not None else [client.socket()]
+            if cloud_socket is None:
+                timeout = connector.wait()
+            else:
+                sockets.insert(0, cloud_socket)
+                timeout = uplink.timeout() if cloud_ready else None
+                timeout = 1 if timeout is None else timeout
+
+            if pipeline is not None:
+                sockets.append(pipeline)
+            if reduction is not None:
+                due = reduction.timeout()
+                if due is not None:
+                    timeout = min(timeout, due)
+
+            readable, writable, exceptional = select.select(sockets, [], sockets, timeout)
+
+            if reduction is not None:
+                for reading in reduction.poll():
+                    uplink.put(reading)
+
+            try:
+                for ready in readable:
+                    if ready is cloud_socket:
+                        in_data = cloud_socket.recv(4096)
+                        if not in_data:
+                            raise ConnectionError("cloud closed the connection")
+                        cloud_websocket.receive_data(in_data)
+
+                        for event in cloud_websocket.events():
+                            if isinstance(event, AcceptConnection):
+                                log.info("Cloud WebSocket established (%s)", event.subprotocol or "json")
+                                CLOUD_CONNECTED.set(1)
+                                cloud_ready = True
+                                binary = wire.is_binary(event.subprotocol)
+                                connector.established()
+                                uplink.on_connect()
+
+                                hello = wire.encode({"gateway_hello": {"gateway_id": GATEWAY_ID}}, binary)
+                                cloud_socket.sendall(cloud_websocket.send(Message(data=hello)))
+                            elif isinstance(event, RejectConnection):
+                                log.error("Cloud WebSocket rejected")
+                                raise ConnectionError("cloud websocket connection rejected")
+                            elif isinstance(event, CloseConnection):
+                                log.warning("Cloud connection closed: code=%s reason=%s", event.code, event.reason)
+                                cloud_socket.send(cloud_websocket.send(event.response()))
+                                raise ConnectionError("cloud closed the websocket")
+                            elif isinstance(event, Ping):
+                                cloud_socket.send(cloud_websocket.send(event.response()))
+                            elif wire.is_data_event(event):
+                                message = assembler.feed(event)
+                                if message is None:
+                                    continue
+
+                                if "ack" in message:
+                                    uplink.on_ack(message["ack"])
 
+                                if "control_curtain" in message:
+                                    publish_command(message.get("device_id", DEVICE_ID), message["control_curtain"])
+                                    COMMANDS.inc()
+                            else:
+                                log.warning("Unsupported event: %r", event)
+
+                    elif direct is not None and ready in direct.sockets():
+                        direct.read(ready)
+
+                    elif client is not None and ready is client.socket():
+                        client.loop_read()
+                        client.loop_write()
+                        client.loop_misc()
+
+                    elif ready is pipeline:
+                        readings, ids, errors = pipeline.drain()
+                        for reason, error in errors:
+                            (HMAC_FAILURES if reason == "hmac" else DECODE_FAILURES).inc()
+                            if log.isEnabledFor(logging.WARNING) and sample():
+                                log.warning("%s", error)
+                        for reading, packet_id in zip(readings, ids):
+                            accept_reading(reading, packet_id)
+
+                if cloud_socket is not None and cloud_ready and uplink.timeout() == 0:
+                    # Write the next batch of readings as a single WebSocket message.
+                    message = uplink.take_batch()
+                    if message is not None:
+                        out_data = cloud_websocket.send(Message(data=wire.encode(message, binary)))
+                        cloud_socket.sendall(out_data)
+                        UPLINK_MESSAGES.inc()
+                        if "rule_hits" not in message:
+                            UPLINK_BATCH_SIZE.observe(len(message["batch"]) if "batch" in message else 1)
+
+            except (OSError, LocalProtocolError, RemoteProtocolError) as e:
+                if cloud_socket is None:
+                    raise
+                delay = connector.lost(cloud_socket)
+                log.warning("Lost connection to cloud: %s, reconnecting in %.1fs", e, delay)
+                CLOUD_RECONNECTS.inc()
+                CLOUD_CONNECTED.set(0)
+                cloud_socket = None
+                uplink.on_disconnect()
 
     except Exception as e:
-        print(f"Failed to run server: {e}")
+        log.exception("Failed to run gateway: %s", e)
 
     finally:
-        cloud_socket.close()
+        if cloud_socket is not None:
+            cloud_socket.close()
+        if pipeline is not None:
+            pipeline.close()
+        if direct is not None:
+            direct.close()
+        uplink.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,89 @@
+"""
+Import the JSON-lines history files written by older versions of cloud.py
+(temperature_history.txt, motion_history.txt, ...) into the binary history store.
+
+Readings that were already in the store before it started are skipped, so
+running it again imports nothing twice.
+
+Usage: python migrate_history.py [directory containing the *_history.txt files]
+"""
+import json
+import os
+import sys
+
+from common.config import *
+from common import history_store
+
+class StoredBefore:
+    """
+    The readings in the store when the migration started. A reading counts as
+    stored when one with the same timestamp and value was, so distinct readings
+    that share a second are all imported by the first run.
+    """
+
+    def __init__(self, history):
+        self.history = history
+        # (msg_type, device_id) -> number of readings stored before the run
+        self.counts = dict()
+
+    def __contains__(self, reading):
+        key = (reading["msg_type"], reading["device_id"])
+        count = self.counts.get(key)
+        if count is None:
+            series = self.history.get_series(*key)
+            count = self.counts[key] = series.count if series is not None else 0
+        if not count:
+            return False
+
+        # Compare with the value as the store gives it back.
+        value = history_store.unpack_value(*history_store.pack_value(reading["value"]))
+        timestamp = reading["timestamp"]
+        rows = self.history.get_series(*key).scan(since=timestamp, until=timestamp)
+        return any(position < count and stored == value for position, _, stored in rows)
+
+def migrate_file(history, stored, path):
+    imported = 0
+    skipped = 0
+    present = 0
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                reading = json.loads(line)
+                if reading in stored:
+                    present += 1
+                    continue
+                history.append(
+                    reading["msg_type"],
+                    reading["device_id"],
+                    reading["timestamp"],
+                    reading["value"],
+                )
+                imported += 1
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"  Skipping malformed line: {e}")
+                skipped += 1
+    return imported, skipped, present
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else "."
+    group = history_store.GroupCommit(history_store.BLOCK_RECORDS)
+    history = history_store.HistoryStore(HISTORY_DIR, group=group)
+    stored = StoredBefore(history)
+
+    try:
+        for name in MSG_TYPE_NAMES.values():
+            path = os.path.join(source, f"{name}_history.txt")
+            if not os.path.exists(path):
+                print(f"{path}: not found, skipping")
+                continue
+
+            imported, skipped, present = migrate_file(history, stored, path)
+            print(f"{path}: imported {imported} readings, skipped {skipped} malformed and {present} already stored")
+    finally:
+        history.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of packet verification, decoding and encoding.
+
+"before" is the original implementation (a new HMAC object per message, full
+cbor2 decoding and double cbor2 encoding), "after" is common/packet_codec.py.
+Pass --direct to force the direct decoder, which the codec otherwise only uses
+when cbor2 has no C extension.
+
+Usage: python testing/bench_packet_codec.py [--direct] [packets]
+"""
+import hashlib
+import hmac
+import sys
+import os
+import time
+
+import cbor2
+
+# Add common to import path
+common_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'common'))
+if common_path not in sys.path:
+    sys.path.insert(0, common_path)
+
+from config import *
+import packet_codec
+
+def old_verify_and_parse(packet_bytes):
+    if len(packet_bytes) < 32:
+        return None
+    computed = hmac.new(HMAC_KEY, packet_bytes[:-32], hashlib.sha256).digest()
+    if not hmac.compare_digest(computed, packet_bytes[-32:]):
+        return None
+    decoded = cbor2.loads(packet_bytes)
+    if not isinstance(decoded, list) or len(decoded) != 5:
+        return None
+    return decoded[:-1]
+
+def old_encode(kind, device_id, timestamp, value):
+    array = [kind, device_id, timestamp, value, bytes(32)]
+    checked_bytes = cbor2.dumps(array)[:-32]
+    mac = hmac.new(HMAC_KEY, checked_bytes, hashlib.sha256).digest()
+    return cbor2.dumps([kind, device_id, timestamp, value, mac])
+
+def rate(function, arguments):
+    start = time.perf_counter()
+    for args in arguments:
+        function(*args)
+    return len(arguments) / (time.perf_counter() - start)
+
+def main():
+    arguments = [a for a in sys.argv[1:] if a != "--direct"]
+    if "--direct" in sys.argv:
+        packet_codec.DIRECT_DECODE = True
+    count = int(arguments[0]) if arguments else 100000
+    codec = packet_codec.PacketCodec(HMAC_KEY)
+
+    timestamp = int(time.time())
+    values = [(1, 21.5), (2, True), (3, False), (4, 75)]
+    readings = [
+        (kind, DEVICE_ID, timestamp + i, value)
+        for i in range(count)
+        for kind, value in [values[i % len(values)]]
+    ]
+    packets = [(old_encode(*reading),) for reading in readings]
+
+    # Both implementations must agree before their speed means anything.
+    for reading, (packet,) in zip(readings[:100], packets[:100]):
+        assert codec.encode(*reading) == packet
+        assert list(codec.verify_and_decode(packet)) == old_verify_and_parse(packet)
+
+    results = [
+        ("verify+decode", rate(old_verify_and_parse, packets), rate(codec.verify_and_decode, packets)),
+        ("encode", rate(old_encode, readings), rate(codec.encode, readings)),
+    ]
+
+    print(f"{count} packets, {'direct' if packet_codec.DIRECT_DECODE else 'cbor2'} decoding")
+    print(f"{'':15} {'before':>14} {'after':>14} {'speedup':>8}")
+    for name, before, after in results:
+        print(f"{name:15} {before:>10.0f} p/s {after:>10.0f} p/s {after / before:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
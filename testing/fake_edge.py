@@ -1,7 +1,6 @@
 import paho.mqtt.client as mqtt
-import cbor2
-import hmac
-import hashlib
+import argparse
+import socket
 import time
 import random
 import sys
@@ -13,41 +12,22 @@ if common_path not in sys.path:
     sys.path.insert(0, common_path)
 
 from config import *
+import packet_codec
+import replay_window
 
-def compute_hmac(data: bytes) -> bytes:
-    return hmac.new(HMAC_KEY, data, hashlib.sha256).digest()
+codec = packet_codec.PacketCodec(HMAC_KEY)
+replay = replay_window.ReplayWindow(GATEWAY_REPLAY_WINDOW, GATEWAY_REPLAY_IDS, 1, GATEWAY_REPLAY_MAX_SKEW)
 
 def verify_packet(data: bytes):
-    if len(data) < 32:
-        print("Received too-short packet")
+    try:
+        return codec.verify_and_decode(data)
+    except packet_codec.PacketError as e:
+        print(f"{e} (fake_edge)")
         return None
 
-    cbor_part = data[:-32]
-    hmac_part = data[-32:]
-    computed = compute_hmac(cbor_part)
-
-    if not hmac.compare_digest(computed, hmac_part):
-        print("HMAC verification failed (fake_edge)")
-        return None
-
-    decoded = cbor2.loads(data)
-    if not isinstance(decoded, list) or len(decoded) != 5:
-        print("Unexpected CBOR structure:", decoded)
-        return None
-
-    msg_type, dev_id, ts, value, _sig = decoded
-    return msg_type, dev_id, ts, value
-
 def encode_packet(kind: int, value):
     ts = int(time.time())
-    empty_sig = bytes(32)
-
-    arr = [kind, DEVICE_ID, ts, value, empty_sig]
-    encoded_without_hmac = cbor2.dumps(arr)
-    checked_bytes = encoded_without_hmac[:-32]
-    mac = compute_hmac(checked_bytes)
-    full_arr = [kind, DEVICE_ID, ts, value, mac]
-    return cbor2.dumps(full_arr)
+    return codec.encode(kind, DEVICE_ID, ts, value)
 
 def encode_temperature(value: int) -> bytes:
     return encode_packet(1, value)
@@ -73,6 +53,11 @@ def on_message(client, userdata, msg):
         return
 
     msg_type, dev_id, ts, value = parsed
+    reason = replay.check(dev_id, ts, replay_window.packet_id(msg.payload))
+    if reason is not None:
+        print(f"[fake_edge] Dropped {reason} command from {ts}, dropped so far: {replay.dropped}")
+        return
+
     print(f"[fake_edge] Command received:")
     print(f"  type: {msg_type}")
     print(f"  device_id: {dev_id}")
@@ -86,11 +71,24 @@ def on_message(client, userdata, msg):
         print(f"[fake_edge] Published curtain status {value}% to blinds/curtain")
 
 def main():
+    parser = argparse.ArgumentParser(description="Simulated edge device.")
+    parser.add_argument("--host", default=BROKER_HOST, help="MQTT broker, or a gateway with GATEWAY_INGEST = \"direct\"")
+    parser.add_argument("--port", type=int, default=BROKER_PORT)
+    parser.add_argument("--udp", metavar="HOST:PORT", help="send readings as UDP datagrams to a direct ingest gateway")
+    args = parser.parse_args()
+
+    udp_address = None
+    if args.udp:
+        host, port = args.udp.rsplit(":", 1)
+        udp_address = (host, int(port))
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
     client = mqtt.Client()
     client.on_connect = on_connect
     client.on_message = on_message
 
-    client.connect(BROKER_HOST, BROKER_PORT, 60)
+    # Commands always arrive over MQTT.
+    client.connect(args.host, args.port, 60)
 
     next_packet = time.time()
     next_check = time.time()
@@ -111,7 +109,10 @@ def main():
                 packet = encode_door(random.choice([True, False]))
                 category = "blinds/door"
 
-            client.publish(category, packet, qos=1)
+            if udp_address is not None:
+                udp.sendto(packet, udp_address)
+            else:
+                client.publish(category, packet, qos=1)
         if t >= next_check:
             next_check += 0.1
 
@@ -0,0 +1,405 @@
+"""
+End-to-end load test: simulated edge devices -> MQTT broker -> gateway.py ->
+cloud.py -> simulated applications.
+
+The MQTT broker stand-in (testing/mini_broker.py), the gateway and the cloud
+run as subprocesses on localhost, with their ports, spool and history
+directories patched to the test's own. Generator processes publish signed
+temperature packets for --devices devices at --rate readings per second each,
+carrying the time they were sent as the reading's value. Subscriber processes
+subscribe to temperature readings through the cloud and record the
+device -> application latency of every reading they receive.
+
+With --ingest direct-mqtt or direct-udp there is no broker: the gateway runs
+with GATEWAY_INGEST = "direct" and the generators send their packets straight
+to its built-in MQTT server or as UDP datagrams. --cloud-workers N runs the
+cloud with CLOUD_WORKERS = N, and the cloud's CPU time and memory are those of
+all its processes together.
+
+Results (latency percentiles, throughput, and CPU time and peak memory per
+component) are printed and written as JSON to --output.
+
+Usage: python testing/load_test.py [--devices N] [--rate R] [--duration S]
+                                   [--subscribers N] [--output results.json]
+                                   [--ingest broker|direct-mqtt|direct-udp]
+                                   [--cloud-workers N]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if root not in sys.path:
+    sys.path.insert(0, root)
+
+from wsproto import WSConnection
+from wsproto.connection import ConnectionType
+from wsproto.events import AcceptConnection, Message, Ping, Request
+
+from common.config import *
+from common import packet_codec
+from common import project_crypto
+from common import wire
+from common import mqtt_lite
+
+HOST = "127.0.0.1"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+# Run a component with its configuration globals replaced. Arguments:
+# module, then name=value pairs evaluated as Python literals.
+BOOTSTRAP = """
+import ast, sys
+sys.path.insert(0, {root!r})
+module = __import__(sys.argv[1])
+for argument in sys.argv[2:]:
+    name, value = argument.split("=", 1)
+    setattr(module, name, ast.literal_eval(value))
+module.main()
+"""
+
+def start_component(log_dir, name, module, **overrides):
+    arguments = [f"{key}={value!r}" for key, value in overrides.items()]
+    log = open(os.path.join(log_dir, f"{name}.log"), "w")
+    return subprocess.Popen(
+        [sys.executable, "-c", BOOTSTRAP.format(root=root), module, *arguments],
+        cwd=root,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing is listening on port {port}")
+
+def stat_fields(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        # The command name can contain spaces, so split after its closing parenthesis.
+        return f.read().rsplit(")", 1)[1].split()
+
+def process_tree(pid):
+    """pid and the PIDs of all its descendants."""
+    children = dict()
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            parent = int(stat_fields(name)[1])
+        except (OSError, IndexError):
+            continue
+        children.setdefault(parent, []).append(int(name))
+
+    tree = [pid]
+    for member in tree:
+        tree.extend(children.get(member, []))
+    return tree
+
+def cpu_seconds(pid):
+    """CPU time of a process and its descendants."""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            fields = stat_fields(member)
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / CLOCK_TICKS
+
+def peak_rss_mb(pid):
+    """Sum of the peak resident memory of a process and its descendants."""
+    total = 0.0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1]) / 1024
+        except OSError:
+            continue
+    return total
+
+def usage():
+    """CPU seconds and peak resident memory in MB of the calling process."""
+    times = os.times()
+    return times.user + times.system, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def generate(broker_port, udp_port, device_ids, rate, duration, start_at, reports):
+    """
+    Publish one temperature reading per device every 1 / rate seconds, over
+    MQTT or, when udp_port is set, as UDP datagrams.
+    """
+    codec = packet_codec.PacketCodec(HMAC_KEY)
+    if udp_port is None:
+        sock = socket.create_connection((HOST, broker_port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(mqtt_lite.encode_connect(f"load-{os.getpid()}"))
+        sock.recv(4)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    total_rate = rate * len(device_ids)
+    sent = 0
+    while time.time() < start_at:
+        time.sleep(0.001)
+
+    end = start_at + duration
+    while True:
+        now = time.time()
+        if now >= end:
+            break
+
+        due = int((now - start_at) * total_rate) - sent
+        packets = []
+        for _ in range(due):
+            device_id = device_ids[sent % len(device_ids)]
+            packet = codec.encode(1, device_id, int(now), now)
+            if udp_port is None:
+                packets.append(mqtt_lite.encode_publish("blinds/temperature", packet))
+            else:
+                sock.sendto(packet, (HOST, udp_port))
+            sent += 1
+        if packets:
+            sock.sendall(b"".join(packets))
+        time.sleep(0.002)
+
+    sock.close()
+    reports.put((sent, *usage()))
+
+def subscribe(application_port, ready, stop, reports):
+    """Subscribe to temperature readings and record their latency until stop is set."""
+    sock = project_crypto.construct_ssl_socket(True, "application", "cloud", HOST, application_port)
+    sock.settimeout(0.2)
+    websocket = WSConnection(ConnectionType.CLIENT)
+    sock.sendall(websocket.send(Request(
+        host=HOST,
+        target="server",
+        subprotocols=wire.client_subprotocols(WIRE_FORMAT),
+        extensions=wire.client_extensions(WIRE_DEFLATE),
+    )))
+
+    assembler = wire.MessageAssembler()
+    latencies = []
+    while not stop.is_set():
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+
+        received = time.time()
+        websocket.receive_data(data)
+        for event in websocket.events():
+            if isinstance(event, AcceptConnection):
+                request = {"subscribe": {"id": "load", "msg_type": 1}}
+                sock.sendall(websocket.send(Message(data=wire.encode(request, wire.is_binary(event.subprotocol)))))
+            elif isinstance(event, Ping):
+                sock.sendall(websocket.send(event.response()))
+            elif wire.is_data_event(event):
+                message = assembler.feed(event)
+                if message is None:
+                    continue
+                if "snapshot" in message:
+                    ready.release()
+                elif message.get("msg_type") == 1:
+                    latencies.append(received - message["value"])
+
+    sock.close()
+    reports.put((latencies, *usage()))
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(fraction * len(values)))
+    return values[index]
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of the gateway and cloud.")
+    parser.add_argument("--devices", type=int, default=1000, help="simulated edge devices")
+    parser.add_argument("--rate", type=float, default=1.0, help="readings per second per device")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--subscribers", type=int, default=4, help="simulated applications")
+    parser.add_argument("--generators", type=int, default=2, help="load generator processes")
+    parser.add_argument("--drain", type=float, default=3.0, help="seconds to wait for readings in flight")
+    parser.add_argument("--ingest", choices=("broker", "direct-mqtt", "direct-udp"), default="broker",
+                        help="how readings reach the gateway")
+    parser.add_argument("--cloud-workers", type=int, default=0,
+                        help="cloud worker processes (CLOUD_WORKERS); 0 runs the cloud in one process")
+    parser.add_argument("--base-port", type=int, default=21883,
+                        help="broker port; the cloud, the gateway's metrics endpoint and its UDP port use the next"
+                             " five, the cloud's metrics endpoints the ones from base + 10")
+    parser.add_argument("--output", default="load_test_results.json")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory with logs")
+    args = parser.parse_args()
+
+    # The certificates are loaded from crypto/ relative to the working directory.
+    output = os.path.abspath(args.output)
+    os.chdir(root)
+
+    broker_port, gateway_port, application_port = args.base_port, args.base_port + 1, args.base_port + 2
+    udp_port = args.base_port + 5 if args.ingest == "direct-udp" else None
+    work_dir = tempfile.mkdtemp(prefix="load_test_")
+
+    components = dict()
+    try:
+        if args.ingest == "broker":
+            components["broker"] = subprocess.Popen(
+                [sys.executable, os.path.join(root, "testing", "mini_broker.py"), "--host", HOST, "--port", str(broker_port)],
+                stdout=subprocess.DEVNULL,
+            )
+        components["cloud"] = start_component(
+            work_dir, "cloud", "cloud",
+            INTERNAL_CLOUD_IP=HOST,
+            GATEWAY_PORT=gateway_port,
+            APPLICATION_PORT=application_port,
+            HISTORY_DIR=os.path.join(work_dir, "history"),
+            CLOUD_METRICS_PORT=args.base_port + 10,
+            CLOUD_WORKERS=args.cloud_workers,
+            CLOUD_BUS_PATH=os.path.join(work_dir, "cloud_bus.sock"),
+        )
+        if args.ingest == "broker":
+            wait_for_port(broker_port)
+        wait_for_port(application_port)
+
+        # In direct mode the gateway serves MQTT on the broker's port itself.
+        components["gateway"] = start_component(
+            work_dir, "gateway", "gateway",
+            BROKER_HOST=HOST,
+            BROKER_PORT=broker_port,
+            GATEWAY_INGEST="mqtt" if args.ingest == "broker" else "direct",
+            GATEWAY_LISTEN_HOST=HOST,
+            GATEWAY_MQTT_PORT=broker_port,
+            GATEWAY_UDP_PORT=udp_port,
+            EXTERNAL_CLOUD_IP=HOST,
+            GATEWAY_PORT=gateway_port,
+            GATEWAY_SPOOL_DIR=os.path.join(work_dir, "spool"),
+            GATEWAY_METRICS_PORT=args.base_port + 3,
+        )
+
+        ready = multiprocessing.Semaphore(0)
+        stop = multiprocessing.Event()
+        subscriber_reports = multiprocessing.Queue()
+        subscribers = [
+            multiprocessing.Process(target=subscribe, args=(application_port, ready, stop, subscriber_reports))
+            for _ in range(args.subscribers)
+        ]
+        for process in subscribers:
+            process.start()
+        for _ in subscribers:
+            if not ready.acquire(timeout=10):
+                raise RuntimeError("a subscriber did not get its subscription snapshot")
+
+        # Give the gateway time to connect to the broker and the cloud.
+        time.sleep(1.5)
+        if components["gateway"].poll() is not None:
+            raise RuntimeError("the gateway exited, see its log")
+
+        device_ids = [f"load-{i:05d}" for i in range(args.devices)]
+        generator_reports = multiprocessing.Queue()
+        start_at = time.time() + 0.5
+        generators = [
+            multiprocessing.Process(
+                target=generate,
+                args=(broker_port, udp_port, device_ids[i::args.generators], args.rate, args.duration, start_at, generator_reports),
+            )
+            for i in range(args.generators)
+        ]
+        for process in generators:
+            process.start()
+
+        cpu_start = {name: cpu_seconds(process.pid) for name, process in components.items()}
+
+        reports = [generator_reports.get() for _ in generators]
+        for process in generators:
+            process.join()
+        sent = sum(report[0] for report in reports)
+        cpu = {"generators": sum(report[1] for report in reports)}
+        memory = {"generators": max(report[2] for report in reports)}
+
+        time.sleep(args.drain)
+
+        for name, process in components.items():
+            cpu[name] = cpu_seconds(process.pid) - cpu_start[name]
+            memory[name] = peak_rss_mb(process.pid)
+
+        stop.set()
+        latencies = []
+        received = []
+        reports = [subscriber_reports.get(timeout=30) for _ in subscribers]
+        for process in subscribers:
+            process.join()
+        for subscriber_latencies, _, _ in reports:
+            received.append(len(subscriber_latencies))
+            latencies.extend(subscriber_latencies)
+        # Subscriber CPU time includes connecting and subscribing before the load.
+        cpu["subscribers"] = sum(report[1] for report in reports)
+        memory["subscribers"] = max(report[2] for report in reports)
+    finally:
+        for process in components.values():
+            process.terminate()
+        for process in components.values():
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    latencies.sort()
+    elapsed = args.duration + args.drain
+    report = {
+        "config": {
+            "devices": args.devices,
+            "rate_per_device": args.rate,
+            "duration_s": args.duration,
+            "subscribers": args.subscribers,
+            "generators": args.generators,
+            "wire_format": WIRE_FORMAT,
+            "wire_deflate": WIRE_DEFLATE,
+            "gateway_batch_size": GATEWAY_BATCH_SIZE,
+            "gateway_pipeline": GATEWAY_PIPELINE,
+            "ingest": args.ingest,
+            "cloud_workers": args.cloud_workers,
+        },
+        "sent": sent,
+        "received_per_subscriber": received,
+        "delivery_ratio": min(received) / sent if sent and received else None,
+        "sent_per_s": sent / args.duration,
+        "delivered_per_s": sum(received) / elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": latencies[-1] if latencies else None,
+        },
+        # CPU seconds spent during the load phase and peak resident memory.
+        "cpu_s": cpu,
+        "cpu_percent": {name: 100 * seconds / elapsed for name, seconds in cpu.items()},
+        "peak_rss_mb": memory,
+    }
+    for key, value in report["latency_ms"].items():
+        if value is not None:
+            report["latency_ms"][key] = value * 1000
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+    if args.keep:
+        print(f"Logs in {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
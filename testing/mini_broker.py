@@ -0,0 +1,31 @@
+"""
+Minimal MQTT 3.1.1 broker for local testing and benchmarks, standing in for
+Mosquitto. See common/mqtt_lite.py for what it supports.
+
+Usage: python testing/mini_broker.py [--host HOST] [--port PORT]
+"""
+import argparse
+import os
+import sys
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if root not in sys.path:
+    sys.path.insert(0, root)
+
+from common import mqtt_lite
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    broker = mqtt_lite.Broker(args.host, args.port)
+    print(f"MQTT broker listening on {args.host}:{args.port}")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
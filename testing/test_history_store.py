@@ -0,0 +1,76 @@
+"""
+Checks of the history store that need readings appended while a scan is
+suspended, as happens while the cloud streams a history reply.
+
+Run with `python -m pytest testing` or `python testing/test_history_store.py`.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import history_store
+
+def _store(directory, cache_records):
+    # Every record is flushed as it is written, so disk reads see it.
+    return history_store.HistoryStore(directory, cache_records)
+
+def test_scan_reads_readings_evicted_before_the_ring_is_reached():
+    with tempfile.TemporaryDirectory() as directory:
+        store = _store(directory, 300)
+        for timestamp in range(1000):
+            store.append(1, "device", timestamp, float(timestamp))
+
+        series = store.get_series(1, "device")
+        rows = series.scan()
+        seen = [next(rows)[0]]
+        # The ring held positions 700-999 when the scan started.
+        for timestamp in range(1000, 1500):
+            store.append(1, "device", timestamp, float(timestamp))
+        seen.extend(position for position, _, _ in rows)
+
+        # Readings appended meanwhile may follow, but none may be missing.
+        assert seen == list(range(len(seen))) and len(seen) >= 1000
+        store.close()
+
+def test_scan_is_not_affected_by_evictions_inside_the_ring():
+    with tempfile.TemporaryDirectory() as directory:
+        store = _store(directory, 300)
+        # Wrap the ring so its readings are split over two slot ranges.
+        for timestamp in range(1150):
+            store.append(1, "device", timestamp, float(timestamp))
+
+        series = store.get_series(1, "device")
+        rows = series.scan(since=900)
+        seen = [next(rows)]
+        for timestamp in range(1150, 1600):
+            store.append(1, "device", timestamp, float(timestamp))
+        seen.extend(rows)
+
+        positions = [position for position, _, _ in seen]
+        assert positions == list(range(900, 900 + len(positions))) and len(positions) >= 250
+        assert all(value == timestamp for _, timestamp, value in seen)
+        store.close()
+
+def test_paged_query_resumes_after_evictions():
+    with tempfile.TemporaryDirectory() as directory:
+        store = _store(directory, 300)
+        for timestamp in range(1000):
+            store.append(1, "device", timestamp, float(timestamp))
+
+        rows = store.scan(1, "device")
+        first_page = [next(rows) for _ in range(100)]
+        for timestamp in range(1000, 1500):
+            store.append(1, "device", timestamp, float(timestamp))
+        positions = [position for _, position, _, _ in first_page]
+        positions += [position for _, position, _, _ in rows]
+
+        assert positions == list(range(len(positions))) and len(positions) >= 1000
+        store.close()
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")